@@ -0,0 +1,367 @@
+from party_tool import PARTY_TOOL
+from date_range_tool import DATE_RANGE_TOOL
+from get_conversation_by_id_tool import GET_CONVERSATION_BY_ID
+from milvus_search_tool import MILVUS_SEARCH_TOOL, MILVUS_BATCH_SEARCH_TOOL
+from tool_executor import submit_tool_call, submit_tool_call_to_loop, tool_call_hash
+from chat_streaming import stream_chat_completion
+from tool_result_serializer import serialize_tool_result, estimate_tokens
+from context_window import ContextWindow, count_message_tokens
+from tracing import trace_turn, span
+from rate_limiter import create_chat_completion
+from config import config
+import logging
+import concurrent.futures
+import functools
+import json
+import uuid
+
+logger = logging.getLogger("llm_api")
+
+DEFAULT_SYSTEM_PROMPT = """You are a helpful AI assistant. You can help users search through conversation records using date ranges, party names, or conversation IDs."""
+
+# Max number of completions per turn, to prevent infinite tool loops
+AGENT_MAX_ITERATIONS = int(config.get("agent_max_iterations", 5))
+
+AGENT_TOOLS = [PARTY_TOOL, DATE_RANGE_TOOL, GET_CONVERSATION_BY_ID, MILVUS_SEARCH_TOOL, MILVUS_BATCH_SEARCH_TOOL]
+
+MAX_ITERATIONS_WARNING = "The assistant reached the maximum number of tool calls allowed. The response may be incomplete."
+
+# Function to check if a model supports function calling
+def model_supports_function_calling(model_name):
+    # List of models known to support function calling
+    # Update this list as OpenAI releases new models or changes capabilities
+    function_calling_models = [
+        model for model in [
+            "gpt-4", "gpt-4-turbo", "gpt-4-vision-preview", "gpt-4-1106-preview",
+            "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-4o",
+            "gpt-3.5-turbo", "gpt-3.5-turbo-1106", "gpt-3.5-turbo-0613",
+            "o1-preview", "o1-mini", "o3-mini"
+        ] if model in model_name
+    ]
+    return len(function_calling_models) > 0
+
+def client_supports_tools(client, model):
+    """
+    Whether a model accepts tools: asked of the server for Ollama, from a known list for OpenAI.
+    """
+    if hasattr(client, "supports_tools"):
+        return client.supports_tools(model)
+    return model_supports_function_calling(model)
+
+def record_completion(completion_span, usage, api_messages, content, tool_calls):
+    """
+    Record token counts and sizes of a completion on its span.
+    """
+    if usage is not None:
+        completion_span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+    else:
+        # Streams often carry no usage; estimate the way the context window does
+        completion_span.set(
+            prompt_tokens=sum(count_message_tokens(message) for message in api_messages),
+            completion_tokens=estimate_tokens(content or ""),
+            tokens_estimated=True
+        )
+    completion_span.set(result_bytes=len(content or ""), tool_calls=len(tool_calls))
+
+class Session:
+    """
+    State of one conversation: display history, the token-budgeted API
+    history and the tool calls seen in the current turn.
+
+    Sessions are plain data so any session store can save them; the last
+    turn's trace is kept in memory only.
+    """
+
+    def __init__(self, session_id=None, system_prompt=DEFAULT_SYSTEM_PROMPT, provider="openai", model=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.system_prompt = system_prompt
+        self.provider = provider
+        self.model = model
+        self.messages = []
+        self.context_window = ContextWindow()
+        self.seen_tool_calls = set()
+        self.completed = False
+        self.last_trace = None
+        # Revision of the stored copy this session was loaded from; kept by the session store
+        self.version = 0
+
+    def clear(self):
+        """
+        Forget the conversation, keeping the settings.
+        """
+        self.messages = []
+        self.context_window.clear()
+        self.seen_tool_calls = set()
+        self.completed = False
+
+    def to_dict(self):
+        return {
+            "session_id": self.session_id,
+            "system_prompt": self.system_prompt,
+            "provider": self.provider,
+            "model": self.model,
+            "messages": self.messages,
+            "context_window": self.context_window.to_dict(),
+            "completed": self.completed
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(
+            session_id=data["session_id"],
+            system_prompt=data.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
+            provider=data.get("provider", "openai"),
+            model=data.get("model")
+        )
+        session.messages = data.get("messages", [])
+        session.context_window = ContextWindow.from_dict(data.get("context_window", {}))
+        session.completed = data.get("completed", False)
+        return session
+
+class AgentEngine:
+    """
+    The chat agent loop, independent of any UI.
+
+    A turn assembles the prompt from the session's context window, calls the
+    model, runs requested tools on the shared tool executor and repeats until
+    the model answers without tools or max_iterations is reached. Progress is
+    reported to on_event as dicts with a "type":
+
+        iteration   {"iteration", "max_iterations"}
+        content     {"content"}: accumulated text while streaming
+        assistant   {"content", "streamed"}: an assistant message is complete
+        tool_call   {"id", "name", "arguments", "duplicate"}
+        tool_result {"id", "name", "content"}
+        warning     {"message"}
+        log         {"level", "message"}: only when debug is set
+
+    One engine serves any number of sessions concurrently; all per-conversation
+    state lives on the Session passed to run_turn.
+    """
+
+    def __init__(self, db_conn, tools=None, max_iterations=AGENT_MAX_ITERATIONS):
+        self.db_conn = db_conn
+        self.tools = AGENT_TOOLS if tools is None else tools
+        self.max_iterations = max_iterations
+        self._tool_loop = None
+        self._async_db_conn = None
+
+    def run_tools_on(self, loop, async_db_conn):
+        """
+        Run tool calls as coroutines on an event loop instead of the tool thread pool.
+
+        Args:
+            loop: Running event loop
+            async_db_conn: AsyncMongoClient bound to that loop
+        """
+        self._tool_loop = loop
+        self._async_db_conn = async_db_conn
+
+    def submit_tool(self, function_name, arguments):
+        """
+        Start a tool call; returns a concurrent.futures.Future of its results.
+        """
+        if self._tool_loop is not None:
+            return submit_tool_call_to_loop(function_name, arguments, self._async_db_conn, self._tool_loop)
+        return submit_tool_call(function_name, arguments, self.db_conn)
+
+    def run_turn(self, session, prompt, client, model, provider="openai", system_prompt=None,
+                 stream=True, on_event=None, debug=False):
+        """
+        Answer one user message.
+
+        Args:
+            session (Session): Conversation to continue; updated in place
+            prompt (str): The user's message
+            client: OpenAI-compatible client
+            model (str): Model name
+            provider (str): "openai" or "ollama", for tracing
+            system_prompt (str): Overrides the session's system prompt
+            stream (bool): Stream the completions
+            on_event (callable): Called with each progress event
+            debug (bool): Also emit log events, including full prompts
+
+        Returns:
+            dict: content (the last assistant message), iterations, and
+            truncated if the turn stopped at max_iterations
+
+        Raises:
+            Errors from the LLM client; tool errors are returned to the model instead
+        """
+        emit = on_event or (lambda _event: None)
+
+        def log(level, message):
+            getattr(logger, level.lower())(message)
+            if debug:
+                emit({"type": "log", "level": level, "message": message})
+
+        session.completed = False
+        session.seen_tool_calls = set()
+        session.messages.append({"role": "user", "content": prompt})
+        context_window = session.context_window
+        context_window.add({"role": "user", "content": prompt})
+
+        supports_function_calling = client_supports_tools(client, model)
+        tools = self.tools if supports_function_calling else None
+        if not supports_function_calling:
+            log("WARNING", f"Model {model} may not support function calling. Using without tools.")
+
+        assistant_response = None
+        current_iteration = 0
+        truncated = False
+        with trace_turn("turn", provider=provider, model=model) as turn_trace:
+            session.last_trace = turn_trace
+
+            while current_iteration < self.max_iterations:
+                current_iteration += 1
+                with span(f"iteration {current_iteration}", "iteration"):
+                    emit({"type": "iteration", "iteration": current_iteration, "max_iterations": self.max_iterations})
+                    log("INFO", f"Starting conversation iteration {current_iteration}/{self.max_iterations}")
+
+                    # Rebuild the prompt from the context window, folding old turns if over budget
+                    api_messages = context_window.build(system_prompt if system_prompt is not None else session.system_prompt)
+
+                    log("INFO", f"{provider} call with model {model}")
+                    if debug:
+                        log("DEBUG", f"Messages for API call: {json.dumps(api_messages, indent=2)}")
+
+                    # Chat calls share the provider's rate limits and go ahead of batch work
+                    create = functools.partial(create_chat_completion, client, provider,
+                                               sum(count_message_tokens(message) for message in api_messages))
+
+                    # Tool calls started so far this iteration, in request order
+                    pending_calls = []
+
+                    def start_tool_call(tool_call):
+                        function_name = tool_call["function"]["name"]
+                        try:
+                            arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+                            if not isinstance(arguments, dict):
+                                raise ValueError("arguments must be a JSON object")
+                        except ValueError as e:
+                            # Cut off by finish_reason "length" or malformed; report it like a failed tool
+                            log("WARNING", f"Invalid arguments for tool {function_name}: {e}")
+                            future = concurrent.futures.Future()
+                            future.set_result(f"Error: invalid arguments for {function_name}: {e}")
+                            pending_calls.append((tool_call["id"], function_name, {}, future))
+                            return
+
+                        # Repeated calls still need a tool message; the result cache answers them
+                        call_hash = tool_call_hash(function_name, arguments)
+                        duplicate = call_hash in session.seen_tool_calls
+                        if duplicate:
+                            log("WARNING", f"Duplicate tool call: {function_name} with args {arguments}")
+                        session.seen_tool_calls.add(call_hash)
+
+                        log("INFO", f"Executing tool: {function_name}")
+                        emit({"type": "tool_call", "id": tool_call["id"], "name": function_name,
+                              "arguments": arguments, "duplicate": duplicate})
+                        future = self.submit_tool(function_name, arguments)
+                        pending_calls.append((tool_call["id"], function_name, arguments, future))
+
+                    if stream:
+                        # Start each tool as soon as its arguments are complete
+                        with span("chat.completions", "completion", model=model, streamed=True,
+                                  request_bytes=len(json.dumps(api_messages))) as completion_span:
+                            streamed = stream_chat_completion(
+                                client,
+                                model,
+                                api_messages,
+                                tools=tools,
+                                on_content=lambda content: emit({"type": "content", "content": content}),
+                                on_tool_call=start_tool_call,
+                                create=create
+                            )
+                            assistant_response = streamed["content"]
+                            tool_calls = streamed["tool_calls"]
+                            record_completion(completion_span, streamed["usage"], api_messages, assistant_response, tool_calls)
+                        log("INFO", f"LLM stream completed (finish_reason: {streamed['finish_reason']})")
+                    else:
+                        with span("chat.completions", "completion", model=model, streamed=False,
+                                  request_bytes=len(json.dumps(api_messages))) as completion_span:
+                            if tools:
+                                response = create(model=model, messages=api_messages, tools=tools)
+                            else:
+                                response = create(model=model, messages=api_messages)
+                            assistant_message = response.choices[0].message
+                            record_completion(completion_span, getattr(response, "usage", None), api_messages,
+                                              assistant_message.content, assistant_message.tool_calls or [])
+                        log("INFO", f"LLM response received (finish_reason: {response.choices[0].finish_reason})")
+
+                        assistant_response = assistant_message.content
+                        tool_calls = [
+                            {
+                                "id": tool_call.id,
+                                "type": "function",
+                                "function": {
+                                    "name": tool_call.function.name,
+                                    "arguments": tool_call.function.arguments
+                                }
+                            } for tool_call in (assistant_message.tool_calls or [])
+                        ] if supports_function_calling else []
+
+                        for tool_call in tool_calls:
+                            start_tool_call(tool_call)
+
+                    if assistant_response:
+                        emit({"type": "assistant", "content": assistant_response, "streamed": stream})
+
+                    # The assistant message carries its tool_calls so the results can refer to them
+                    assistant_api_message = {
+                        "role": "assistant",
+                        "content": assistant_response or ""
+                    }
+                    if tool_calls:
+                        assistant_api_message["tool_calls"] = tool_calls
+                    context_window.add(assistant_api_message)
+
+                    if assistant_response:
+                        session.messages.append({"role": "assistant", "content": assistant_response})
+
+                    # If no tool calls, we're done with this turn
+                    if not tool_calls:
+                        log("INFO", "No tool calls requested, conversation complete")
+                        break
+
+                    log("INFO", f"Model requested {len(tool_calls)} tool calls")
+
+                    # Append results in the order the model requested the calls
+                    for tool_call_id, function_name, arguments, future in pending_calls:
+                        with span(function_name, "wait"):
+                            results = future.result()
+
+                        if isinstance(results, list):
+                            log("INFO", f"Tool {function_name} returned {len(results)} results")
+                        else:
+                            log("INFO", f"Tool {function_name} execution completed")
+
+                        # Compact JSON within the tool's token budget instead of the raw repr
+                        with span(function_name, "serialize") as serialize_span:
+                            tool_content = serialize_tool_result(function_name, results, arguments)
+                            serialize_span.set(result_bytes=len(tool_content), result_tokens=estimate_tokens(tool_content))
+
+                        context_window.add({
+                            "role": "tool",
+                            "tool_call_id": tool_call_id,
+                            "content": tool_content
+                        })
+                        session.messages.append({
+                            "role": "tool",
+                            "name": function_name,
+                            "content": tool_content
+                        })
+                        emit({"type": "tool_result", "id": tool_call_id, "name": function_name, "content": tool_content})
+                        if debug:
+                            log("DEBUG", f"Tool {function_name} results: {tool_content[:500]}...")
+
+                    if current_iteration >= self.max_iterations:
+                        truncated = True
+                        log("WARNING", MAX_ITERATIONS_WARNING)
+                        emit({"type": "warning", "message": MAX_ITERATIONS_WARNING})
+
+        session.completed = True
+        return {
+            "content": assistant_response or "",
+            "iterations": current_iteration,
+            "truncated": truncated
+        }
@@ -0,0 +1,307 @@
+from concurrent.futures import ThreadPoolExecutor
+from agent_engine import AgentEngine, Session, DEFAULT_SYSTEM_PROMPT
+from session_store import get_session_store, SessionConflict, SESSION_STORE
+from ollama_provider import get_ollama_client
+from data_layer import create_mongo_client, get_async_mongo_client, pool_metrics
+import background_services
+import rate_limiter
+from openai import OpenAI
+from config import config
+import contextlib
+import argparse
+import asyncio
+import weakref
+import logging
+import json
+import sys
+import re
+
+logger = logging.getLogger("llm_api")
+
+AGENT_SERVER_HOST = config.get("agent_server_host", "127.0.0.1")
+AGENT_SERVER_PORT = int(config.get("agent_server_port", 8765))
+# Turns running at once; each holds a thread while it waits on the model and tools
+AGENT_SERVER_MAX_TURNS = int(config.get("agent_server_max_turns", 32))
+MAX_REQUEST_BYTES = 1024 * 1024
+
+STATUS_TEXT = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 404: "Not Found",
+               405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+SESSION_PATH = re.compile(r"^/sessions/([0-9a-f]{32})(/messages)?$")
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+async def read_request(reader):
+    """
+    Parse one HTTP/1.1 request.
+
+    Returns:
+        tuple: (method, path, JSON object body or None)
+
+    Raises:
+        HttpError: 400 for a malformed request line, Content-Length or body;
+            413 for a body over MAX_REQUEST_BYTES
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError as e:
+        raise HttpError(400, "Malformed request line") from e
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError as e:
+        raise HttpError(400, "Malformed Content-Length") from e
+    if length < 0:
+        raise HttpError(400, "Malformed Content-Length")
+    if length > MAX_REQUEST_BYTES:
+        raise HttpError(413, "Request body too large")
+    body = None
+    if length:
+        try:
+            body = json.loads(await reader.readexactly(length))
+        except json.JSONDecodeError as e:
+            raise HttpError(400, "Request body must be JSON") from e
+        if not isinstance(body, dict):
+            raise HttpError(400, "Request body must be a JSON object")
+    return method, target.split("?", 1)[0], body
+
+class AgentServer:
+    """
+    HTTP and server-sent events front end for the agent engine.
+
+    All requests are handled on one event loop. Turns run on a bounded
+    thread pool, because the LLM clients and tools block. Their events
+    are passed back to the loop and streamed to the client. Turns on the
+    same session run one at a time; turns on different sessions run
+    concurrently. Sessions live in a pluggable store (see session_store.py).
+
+    Endpoints:
+        POST   /sessions                  create a session
+        GET    /sessions/{id}             session settings and messages
+        DELETE /sessions/{id}             forget a session
+        POST   /sessions/{id}/messages    run a turn; streams events unless "stream" is false
+        GET    /healthz
+    """
+
+    def __init__(self, engine, store, max_turns=AGENT_SERVER_MAX_TURNS):
+        self.engine = engine
+        self.store = store
+        self._turns = ThreadPoolExecutor(max_workers=max_turns, thread_name_prefix="turn")
+        # A session's lock lives while a turn on it is running or waiting
+        self._session_locks = weakref.WeakValueDictionary()
+        self._clients = {}
+        self.active_turns = 0
+
+    def client(self, provider):
+        """
+        Shared LLM client for a provider.
+        """
+        if provider not in self._clients:
+            if provider == "ollama":
+                self._clients[provider] = get_ollama_client(config["ollama_host"])
+            elif provider == "openai":
+                self._clients[provider] = OpenAI(api_key=config["openai_api_key"], max_retries=0)
+            else:
+                raise HttpError(400, f"Unknown provider: {provider}")
+        return self._clients[provider]
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await read_request(reader)
+            await self.route(method, path, body or {}, writer)
+        except HttpError as e:
+            await self.respond(writer, e.status, {"error": str(e)})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Agent server error: {str(e)}")
+            await self.respond(writer, 500, {"error": str(e)})
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body, writer):
+        loop = asyncio.get_running_loop()
+        if path == "/healthz" and method == "GET":
+            return await self.respond(writer, 200, {
+                "status": "ok",
+                "active_turns": self.active_turns,
+                "mongo_pools": pool_metrics.snapshot(),
+                "rate_limits": rate_limiter.all_stats()
+            })
+        if path == "/sessions" and method == "POST":
+            session = Session(
+                system_prompt=body.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
+                provider=body.get("provider", "openai"),
+                model=body.get("model")
+            )
+            await loop.run_in_executor(None, self.store.put, session)
+            return await self.respond(writer, 201, self.describe(session))
+
+        match = SESSION_PATH.match(path)
+        if not match:
+            raise HttpError(404, f"No route for {path}")
+        session_id, messages = match.groups()
+        if messages:
+            if method != "POST":
+                raise HttpError(405, "Use POST to send a message")
+            return await self.post_message(session_id, body, writer)
+        if method == "GET":
+            session = await self.load(session_id)
+            return await self.respond(writer, 200, {**self.describe(session), "messages": session.messages})
+        if method == "DELETE":
+            if not await loop.run_in_executor(None, self.store.delete, session_id):
+                raise HttpError(404, f"No session {session_id}")
+            self._session_locks.pop(session_id, None)
+            return await self.respond(writer, 204, None)
+        raise HttpError(405, f"{method} is not supported on {path}")
+
+    async def load(self, session_id):
+        session = await asyncio.get_running_loop().run_in_executor(None, self.store.get, session_id)
+        if session is None:
+            raise HttpError(404, f"No session {session_id}")
+        return session
+
+    def describe(self, session):
+        return {
+            "session_id": session.session_id,
+            "provider": session.provider,
+            "model": session.model,
+            "system_prompt": session.system_prompt
+        }
+
+    async def post_message(self, session_id, body, writer):
+        prompt = body.get("content")
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise HttpError(400, "content is required")
+        stream = body.get("stream", True)
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = self._session_locks[session_id] = asyncio.Lock()
+        async with lock:
+            # Loaded under the lock so a turn sees the previous turn's result
+            session = await self.load(session_id)
+            provider = body.get("provider", session.provider)
+            model = body.get("model") or session.model or (
+                config["default_model"] if provider == "ollama" else config["default_openai_model"]
+            )
+            client = self.client(provider)
+
+            loop = asyncio.get_running_loop()
+            events = asyncio.Queue()
+
+            def on_event(event):
+                loop.call_soon_threadsafe(events.put_nowait, event)
+
+            def run():
+                event = None
+                try:
+                    result = self.engine.run_turn(
+                        session, prompt, client, model, provider=provider,
+                        stream=stream, on_event=on_event, debug=body.get("debug", False)
+                    )
+                    event = {"type": "done", **result}
+                except Exception as e:
+                    logger.error(f"Turn failed for session {session_id}: {str(e)}")
+                    event = {"type": "error", "message": str(e)}
+                finally:
+                    # Saved even after an error, so the user message is not lost
+                    try:
+                        self.store.put(session)
+                    except SessionConflict as e:
+                        # Another server process ran a turn on this session meanwhile
+                        logger.warning(str(e))
+                        event = {"type": "error", "message": str(e), "status": 409}
+                    except Exception as e:
+                        logger.error(f"Could not save session {session_id}: {str(e)}")
+                        event = {"type": "error", "message": f"Could not save session: {str(e)}"}
+                    on_event(event)
+
+            self.active_turns += 1
+            turn = loop.run_in_executor(self._turns, run)
+            try:
+                if stream:
+                    await self.stream_events(writer, events)
+                else:
+                    await self.respond_with_result(writer, events)
+            finally:
+                # The turn keeps running if the client went away; wait so the lock covers it
+                await turn
+                self.active_turns -= 1
+
+    async def stream_events(self, writer, events):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        connected = True
+        while True:
+            event = await events.get()
+            if connected:
+                try:
+                    writer.write(f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n".encode())
+                    await writer.drain()
+                except ConnectionError:
+                    connected = False
+            if event["type"] in ("done", "error"):
+                return
+
+    async def respond_with_result(self, writer, events):
+        tool_calls = []
+        warnings = []
+        while True:
+            event = await events.get()
+            if event["type"] == "tool_call":
+                tool_calls.append({"name": event["name"], "arguments": event["arguments"]})
+            elif event["type"] == "warning":
+                warnings.append(event["message"])
+            elif event["type"] == "done":
+                return await self.respond(writer, 200, {**event, "tool_calls": tool_calls, "warnings": warnings})
+            elif event["type"] == "error":
+                return await self.respond(writer, event.get("status", 500), {"error": event["message"]})
+
+    async def respond(self, writer, status, payload):
+        body = b"" if payload is None else json.dumps(payload, default=str).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+
+    async def serve(self, host=AGENT_SERVER_HOST, port=AGENT_SERVER_PORT):
+        # Tool I/O runs as coroutines on this loop; turn threads only wait for results
+        self.engine.run_tools_on(asyncio.get_running_loop(), get_async_mongo_client())
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST_BYTES)
+        logger.info(f"Agent server listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the vCon chat agent over HTTP with server-sent events")
+    parser.add_argument("--host", default=AGENT_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=AGENT_SERVER_PORT)
+    parser.add_argument("--session-store", choices=["memory", "mongo"], default=SESSION_STORE)
+    parser.add_argument("--max-turns", type=int, default=AGENT_SERVER_MAX_TURNS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_conn = create_mongo_client()
+    background_services.start(db_conn)
+    server = AgentServer(
+        AgentEngine(db_conn),
+        get_session_store(db_conn, args.session_store),
+        max_turns=args.max_turns
+    )
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(server.serve(args.host, args.port))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
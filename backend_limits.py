@@ -0,0 +1,67 @@
+from contextlib import contextmanager, asynccontextmanager
+from tracing import span
+from config import config
+import threading
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("llm_api")
+
+# Maximum number of concurrent requests allowed against each backend
+BACKEND_LIMITS = {
+    "mongo": int(config.get("mongo_max_concurrency", 8)),
+    "milvus": int(config.get("milvus_max_concurrency", 4)),
+    "embeddings": int(config.get("embeddings_max_concurrency", 4)),
+}
+
+_semaphores = {
+    name: threading.BoundedSemaphore(limit) for name, limit in BACKEND_LIMITS.items()
+}
+
+# asyncio semaphores are bound to a loop, so async callers get their own per loop
+_async_semaphores = {}
+
+@contextmanager
+def backend_slot(backend):
+    """
+    Hold one concurrency slot for the given backend while the block runs.
+
+    The block is traced as a backend span, including the time spent waiting
+    for the slot.
+
+    Args:
+        backend (str): Backend name ("mongo", "milvus" or "embeddings")
+    """
+    with span(backend, "backend") as backend_span:
+        semaphore = _semaphores.get(backend)
+        if semaphore is None:
+            logger.warning(f"No concurrency limit configured for backend: {backend}")
+            yield
+            return
+        waited = time.perf_counter()
+        with semaphore:
+            backend_span.set(slot_wait_ms=round((time.perf_counter() - waited) * 1000, 1))
+            yield
+
+@asynccontextmanager
+async def async_backend_slot(backend):
+    """
+    backend_slot() for coroutines: waits for the slot without blocking the event loop.
+
+    Slots are counted per event loop, separately from the threaded callers.
+    """
+    with span(backend, "backend") as backend_span:
+        limit = BACKEND_LIMITS.get(backend)
+        if limit is None:
+            logger.warning(f"No concurrency limit configured for backend: {backend}")
+            yield
+            return
+        key = (id(asyncio.get_running_loop()), backend)
+        semaphore = _async_semaphores.get(key)
+        if semaphore is None:
+            semaphore = _async_semaphores[key] = asyncio.BoundedSemaphore(limit)
+        waited = time.perf_counter()
+        async with semaphore:
+            backend_span.set(slot_wait_ms=round((time.perf_counter() - waited) * 1000, 1))
+            yield
@@ -0,0 +1,22 @@
+from index_bootstrap import bootstrap_in_background
+from tool_result_cache import tool_result_cache
+from milvus_search_tool import preload_search_collection
+from party_directory import party_directory
+from config import config
+
+def start(db_conn):
+    """
+    Start the once-per-process background work for the app or the agent server.
+
+    This covers index bootstrap, tool cache invalidation, the first party
+    directory load and the Milvus connection and collection load. Each part
+    runs off the caller's thread and is safe to start more than once.
+
+    Args:
+        db_conn: Database connection
+    """
+    collection = db_conn[config["db_name"]][config["collection_name"]]
+    bootstrap_in_background(db_conn)
+    tool_result_cache.watch_collection(collection)
+    party_directory.ensure_fresh(collection, wait=0)
+    preload_search_collection()
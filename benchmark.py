@@ -0,0 +1,380 @@
+from synthetic_vcons import SyntheticVconGenerator, load_vcons, TOPICS
+from get_conversation_by_id_tool import get_conversation_by_id
+from concurrent.futures import ThreadPoolExecutor
+from date_range_tool import find_by_date_range, parse_date_bound
+from local_vector_index import LocalVectorIndex, set_local_index
+from embedding_providers import EmbeddingProvider, set_embedding_provider
+from datetime import datetime, timedelta, timezone
+from index_bootstrap import ensure_indexes
+from party_tool import find_by_party
+from milvus_ingest import vcon_rows
+from milvus_search_tool import search_in_milvus
+import milvus_search_tool
+from pymongo import MongoClient
+from config import config
+import numpy as np
+import platform
+import tempfile
+import argparse
+import logging
+import random
+import json
+import time
+import zlib
+import sys
+
+logger = logging.getLogger("benchmark")
+
+DB_NAME = config["db_name"]
+COLLECTION_NAME = config["collection_name"]
+
+# Dimension of the offline hashing embeddings used by the vector stand-in
+HASH_EMBEDDING_DIMENSION = 256
+# Samples kept from the loaded data to build query workloads
+SAMPLE_SIZE = 10000
+
+def hash_embed(texts, dimension=HASH_EMBEDDING_DIMENSION):
+    """
+    Deterministic bag-of-words embeddings without a model or network call.
+
+    Each word is hashed to a signed coordinate; rows are L2-normalized. The
+    vectors are only good enough to make search cost realistic.
+    """
+    vectors = np.zeros((len(texts), dimension), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            code = zlib.crc32(word.encode("utf-8"))
+            vectors[row, code % dimension] += 1.0 if code & 0x80000000 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+class HashEmbeddingProvider(EmbeddingProvider):
+    """
+    hash_embed() as an embedding provider, so searches need no model or network.
+    """
+
+    name = "hash"
+
+    def __init__(self, dimension=HASH_EMBEDDING_DIMENSION, **kwargs):
+        super().__init__(f"crc32-{dimension}", **kwargs)
+        self._dimension = dimension
+
+    def _embed_batch(self, texts):
+        return hash_embed(texts, self._dimension).tolist()
+
+class Samples:
+    """
+    Reservoir of uuids, parties and dates seen while loading, for building queries.
+    """
+
+    def __init__(self, rng, size=SAMPLE_SIZE):
+        self.rng = rng
+        self.size = size
+        self.seen = 0
+        self.vcons = []
+        self.earliest = None
+        self.latest = None
+
+    def add(self, vcons):
+        for vcon in vcons:
+            self.seen += 1
+            sample = {"uuid": vcon["uuid"], "parties": vcon.get("parties") or []}
+            if len(self.vcons) < self.size:
+                self.vcons.append(sample)
+            else:
+                slot = self.rng.randrange(self.seen)
+                if slot < self.size:
+                    self.vcons[slot] = sample
+            try:
+                created_at = parse_date_bound(vcon["created_at"], end_of_day=False)
+            except (KeyError, TypeError, ValueError, OverflowError):
+                continue
+            self.earliest = min(self.earliest or created_at, created_at)
+            self.latest = max(self.latest or created_at, created_at)
+
+class VectorStandIn:
+    """
+    Local vector index filled with hashing embeddings of the vCon chunks.
+
+    install() makes it the vector backend of search_in_milvus, with
+    HashEmbeddingProvider for the queries, so searches are timed through
+    the real tool: embedding cache, over-fetch, filters and grouping.
+    """
+
+    def __init__(self, max_vcons):
+        self.max_vcons = max_vcons
+        self.vcons = 0
+        self.rows = 0
+        self.index = LocalVectorIndex(tempfile.mkdtemp(prefix="vcon-benchmark-index-"))
+
+    def add(self, vcons):
+        rows = []
+        for vcon in vcons:
+            if self.vcons >= self.max_vcons:
+                break
+            rows.extend(vcon_rows(vcon))
+            self.vcons += 1
+        if rows:
+            self.index.insert([
+                [row[0] for row in rows],
+                [row[1] for row in rows],
+                [row[2] for row in rows],
+                [row[3] for row in rows],
+                hash_embed([row[2] for row in rows])
+            ])
+            self.rows += len(rows)
+
+    def install(self):
+        set_local_index(self.index)
+        set_embedding_provider(HashEmbeddingProvider())
+        milvus_search_tool.VECTOR_BACKEND = "local"
+
+def build_workloads(db_conn, samples, vectors, rng, queries):
+    """
+    Argument lists for each benchmarked tool, drawn from the loaded data.
+
+    Returns:
+        tuple: (workloads, checks). workloads maps each tool name to a list of
+        zero-argument callables; checks maps it to one call that must find
+        something in the loaded data
+    """
+    span = max((samples.latest - samples.earliest).days, 1)
+    everything = (samples.earliest.date().isoformat(), samples.latest.date().isoformat())
+
+    def date_window():
+        days = rng.choice([1, 7, 30])
+        start = samples.earliest + timedelta(days=rng.randrange(max(span - days, 1)))
+        return start.date().isoformat(), (start + timedelta(days=days)).date().isoformat()
+
+    def party(field):
+        for _ in range(100):
+            parties = rng.choice(samples.vcons)["parties"]
+            if parties and parties[0].get(field):
+                return parties[0][field]
+        return "nobody"
+
+    def typo(name):
+        position = rng.randrange(len(name))
+        return name[:position] + name[position + 1:]
+
+    workloads = {
+        "find_by_date_range": [], "find_by_party (exact tel)": [], "find_by_party (prefix)": [],
+        "find_by_party (fuzzy)": [], "get_conversation_by_id": [], "search_in_milvus": [],
+        "search_in_milvus (date filter)": [],
+    }
+    sample = rng.choice([vcon for vcon in samples.vcons if vcon["parties"]] or samples.vcons)
+    known = (sample["parties"] or [{}])[0]
+    topic = " ".join(TOPICS[0][1][:2])
+    checks = {
+        "find_by_date_range": lambda: find_by_date_range(*everything, db_conn, limit=100),
+        "find_by_party (exact tel)": lambda: find_by_party(known.get("tel", "nobody"), db_conn),
+        "find_by_party (prefix)": lambda: find_by_party(known.get("name", "nobody")[:5], db_conn, match="prefix"),
+        "find_by_party (fuzzy)": lambda: find_by_party(known.get("name", "nobody"), db_conn, match="fuzzy"),
+        "get_conversation_by_id": lambda: get_conversation_by_id([sample["uuid"]], db_conn),
+        "search_in_milvus": lambda: search_in_milvus(topic),
+        "search_in_milvus (date filter)": lambda: search_in_milvus(topic, *everything),
+    }
+    for _ in range(queries):
+        start, end = date_window()
+        workloads["find_by_date_range"].append(lambda start=start, end=end: find_by_date_range(start, end, db_conn, limit=100))
+        tel = party("tel")
+        workloads["find_by_party (exact tel)"].append(lambda tel=tel: find_by_party(tel, db_conn))
+        name = party("name")
+        workloads["find_by_party (prefix)"].append(lambda text=name[:5]: find_by_party(text, db_conn, match="prefix"))
+        workloads["find_by_party (fuzzy)"].append(lambda text=typo(name): find_by_party(text, db_conn, match="fuzzy"))
+        uuids = [rng.choice(samples.vcons)["uuid"] for _ in range(rng.randint(1, 10))]
+        workloads["get_conversation_by_id"].append(lambda uuids=uuids: get_conversation_by_id(uuids, db_conn))
+        if vectors is not None:
+            text = " ".join(rng.sample(rng.choice(TOPICS)[1], 2))
+            workloads["search_in_milvus"].append(lambda text=text: search_in_milvus(text))
+            workloads["search_in_milvus (date filter)"].append(
+                lambda text=text, start=start, end=end: search_in_milvus(text, start, end)
+            )
+    workloads = {tool: calls for tool, calls in workloads.items() if calls}
+    return workloads, {tool: checks[tool] for tool in workloads}
+
+def result_count(result):
+    """
+    Number of items a tool returned, or None if the result is an error or not a tool result.
+    """
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict) and isinstance(result.get("uuids"), list):
+        return len(result["uuids"])
+    return None
+
+def check_tools(checks):
+    """
+    Run each tool's check call once, so a broken tool is not timed.
+
+    Returns:
+        list: Names of the tools whose check failed or found nothing
+    """
+    failed = []
+    for tool, check in checks.items():
+        try:
+            result = check()
+        except Exception as e:
+            result = f"Error: {str(e)}"
+        if not result_count(result):
+            logger.error(f"Sanity check for {tool} failed: {str(result)[:200]}")
+            failed.append(tool)
+    return failed
+
+def run_workload(calls, concurrency, warmup):
+    """
+    Time each call, with concurrency calls in flight.
+
+    Returns:
+        dict: Latency percentiles in milliseconds, throughput, errors (exceptions,
+        error strings and unexpected results) and empty results
+    """
+    for call in calls[:warmup]:
+        call()
+
+    def timed(call):
+        started = time.perf_counter()
+        try:
+            count = result_count(call())
+        except Exception as e:
+            logger.error(f"Benchmark call failed: {str(e)}")
+            count = None
+        return time.perf_counter() - started, count
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, calls))
+    wall = time.perf_counter() - started
+
+    latencies = np.array([latency for latency, _ in outcomes]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "calls": len(calls),
+        "errors": sum(count is None for _, count in outcomes),
+        "empty": sum(count == 0 for _, count in outcomes),
+        "mean_ms": round(float(latencies.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(latencies.max()), 3),
+        "throughput_per_s": round(len(calls) / wall, 2)
+    }
+
+def compare(results, baseline):
+    """
+    Ratio of each percentile to the baseline run (above 1.0 is slower).
+    """
+    comparison = {}
+    for tool, stats in results["tools"].items():
+        previous = baseline.get("tools", {}).get(tool)
+        if previous:
+            comparison[tool] = {
+                key: round(stats[key] / previous[key], 3) if previous[key] else None
+                for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_per_s")
+            }
+    return comparison
+
+def _open_database(args):
+    if args.mongo_uri:
+        return MongoClient(args.mongo_uri), "mongodb"
+    try:
+        import mongomock
+    except ImportError as e:
+        raise ImportError("The in-memory benchmark needs mongomock: pip install mongomock, or pass --mongo-uri") from e
+    return mongomock.MongoClient(), "mongomock"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the vCon data-layer tools on synthetic data")
+    parser.add_argument("--docs", type=int, default=10000, help="Synthetic vCons to load")
+    parser.add_argument("--mongo-uri", help="Benchmark a real mongod (default: in-memory mongomock)")
+    parser.add_argument("--no-load", action="store_true", help="With --mongo-uri, benchmark the data already there")
+    parser.add_argument("--vector-docs", type=int, default=20000, help="vCons to put in the vector stand-in (0 to skip search)")
+    parser.add_argument("--queries", type=int, default=200, help="Timed calls per tool")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--date-type", choices=["string", "date"], default="date",
+                        help="Store created_at as a BSON date (the indexed path) or as an ISO string")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    # The tools log every call; only show their warnings so progress stays readable
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+    db_conn, backend = _open_database(args)
+    collection = db_conn[DB_NAME][COLLECTION_NAME]
+    rng = random.Random(args.seed)
+    samples = Samples(rng)
+    vectors = VectorStandIn(args.vector_docs) if args.vector_docs else None
+    if vectors:
+        vectors.install()
+
+    load_seconds = None
+    if args.no_load:
+        # Sample the existing data instead of generating it
+        sampled = list(collection.aggregate([{"$sample": {"size": SAMPLE_SIZE}}]))
+        samples.add(sampled)
+        if vectors:
+            vectors.add(sampled)
+        documents = collection.estimated_document_count()
+    else:
+        if collection.estimated_document_count():
+            logger.error(f"{DB_NAME}.{COLLECTION_NAME} is not empty; use --no-load to benchmark existing data")
+            return 1
+        generator = SyntheticVconGenerator(seed=args.seed, customers=max(100, args.docs // 20))
+
+        def on_batch(batch):
+            samples.add(batch)
+            if vectors:
+                vectors.add(batch)
+
+        started = time.perf_counter()
+        documents = load_vcons(collection, generator, args.docs, date_type=args.date_type, on_batch=on_batch)
+        load_seconds = round(time.perf_counter() - started, 3)
+        logger.info(f"Loaded {documents} vCons in {load_seconds}s")
+
+    try:
+        ensure_indexes(db_conn)
+    except Exception as e:
+        logger.warning(f"Could not create indexes on {backend}: {str(e)}")
+
+    workloads, checks = build_workloads(db_conn, samples, vectors, rng, args.queries)
+    failed = check_tools(checks)
+    if failed:
+        logger.error(f"Not benchmarking broken tools: {', '.join(failed)}")
+        return 1
+    results = {
+        "run": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "backend": backend,
+            "documents": documents,
+            "vector_rows": vectors.rows if vectors else 0,
+            "load_seconds": load_seconds,
+            "queries": args.queries,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "date_type": args.date_type,
+            "python": platform.python_version(),
+            "machine": platform.machine()
+        },
+        "tools": {}
+    }
+    for tool, calls in workloads.items():
+        logger.info(f"Benchmarking {tool}")
+        results["tools"][tool] = run_workload(calls, args.concurrency, args.warmup)
+
+    if args.compare:
+        with open(args.compare) as f:
+            results["comparison"] = compare(results, json.load(f))
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import logging
+
+logger = logging.getLogger("llm_api")
+
+def _finish_tool_call(tool_call, on_tool_call):
+    if tool_call is not None and on_tool_call:
+        on_tool_call(tool_call)
+
+def stream_chat_completion(client, model, messages, tools=None, on_content=None, on_tool_call=None, create=None):
+    """
+    Run a streamed chat completion, rebuilding the assistant message from its deltas.
+
+    Tool calls arrive one after another in the stream, so a call's arguments are
+    complete as soon as the next call starts or the stream ends. on_tool_call is
+    invoked at that point, letting the caller start the tool while the model is
+    still generating the remaining calls.
+
+    Args:
+        client: OpenAI-compatible client
+        model (str): Model name
+        messages (list): Messages in API format
+        tools (list): Tool schemas, or None to call without tools
+        on_content (callable): Called with the accumulated content after each text delta
+        on_tool_call (callable): Called with each completed tool call in API format
+        create (callable): Used instead of client.chat.completions.create, e.g. to
+            go through the rate limit scheduler
+
+    Returns:
+        dict: content, tool_calls (API format), finish_reason and usage
+        (token counts, if the server reported them)
+    """
+    request = {"model": model, "messages": messages, "stream": True}
+    if tools:
+        request["tools"] = tools
+
+    content = ""
+    tool_calls = []
+    current = None
+    current_index = None
+    finish_reason = None
+    usage = None
+
+    stream = (create or client.chat.completions.create)(**request)
+    try:
+        for chunk in stream:
+            # Some servers report token usage on a final chunk without choices
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta
+
+            if delta is not None and delta.content:
+                content += delta.content
+                if on_content:
+                    on_content(content)
+
+            for tool_delta in (delta.tool_calls or []) if delta is not None else []:
+                if tool_delta.index != current_index:
+                    # A new call has started, so the previous one is complete
+                    _finish_tool_call(current, on_tool_call)
+                    current_index = tool_delta.index
+                    current = {
+                        "id": tool_delta.id,
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""}
+                    }
+                    tool_calls.append(current)
+                if tool_delta.id:
+                    current["id"] = tool_delta.id
+                if tool_delta.function is not None:
+                    if tool_delta.function.name:
+                        current["function"]["name"] += tool_delta.function.name
+                    if tool_delta.function.arguments:
+                        current["function"]["arguments"] += tool_delta.function.arguments
+
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    finally:
+        # Ends the HTTP response, and frees a scheduled stream's slot, even if a callback raised
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+    _finish_tool_call(current, on_tool_call)
+    logger.info(f"Streamed completion finished (finish_reason: {finish_reason}, tool calls: {len(tool_calls)})")
+
+    return {
+        "content": content,
+        "tool_calls": tool_calls,
+        "finish_reason": finish_reason,
+        "usage": usage
+    }
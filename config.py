@@ -35,5 +35,4 @@ def ensure_secrets_file():
 ensure_secrets_file()
 
 # Use Streamlit's built-in secrets management
-config = st.secrets 
-print("Config:", config)
\ No newline at end of file
+config = st.secrets
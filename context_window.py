@@ -0,0 +1,225 @@
+from tool_result_serializer import estimate_tokens
+from config import config
+import logging
+import json
+
+logger = logging.getLogger("llm_api")
+
+CONTEXT_TOKEN_BUDGET = int(config.get("context_token_budget", 12000))
+# Share of the budget the rolling summary may use before it is compacted
+SUMMARY_BUDGET_FRACTION = float(config.get("context_summary_budget_fraction", 0.25))
+# Most recent turns that are always kept verbatim
+MIN_RECENT_TURNS = int(config.get("context_min_recent_turns", 1))
+# Tool results in turns that cannot be folded are never cut below this
+MIN_TOOL_RESULT_TOKENS = int(config.get("context_min_tool_result_tokens", 50))
+
+# Fixed per-message overhead for role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def count_message_tokens(message):
+    """
+    Estimate the prompt tokens taken by one API message.
+    """
+    tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content") or "")
+    if message.get("tool_calls"):
+        tokens += estimate_tokens(json.dumps(message["tool_calls"], separators=(",", ":")))
+    return tokens
+
+def _clip(text, limit):
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit] + "..."
+
+def _cut_tool_result(content, tokens):
+    # Keep the start of the result, with a note so the model knows it was cut
+    note = f"... [cut from {len(content)} characters to fit the context window]"
+    keep = max(0, (tokens - MESSAGE_OVERHEAD_TOKENS - estimate_tokens(note)) * 4)
+    return content[:keep] + note
+
+def summarize_turn(messages):
+    """
+    Extractive one-paragraph summary of a folded turn.
+
+    Keeps the question, the tools that were called with a preview of their
+    output, and the start of the answer, so the model knows what was
+    already looked up.
+
+    Args:
+        messages (list): API messages making up one turn
+
+    Returns:
+        str: Summary text
+    """
+    parts = []
+    for message in messages:
+        role = message["role"]
+        if role == "user":
+            parts.append(f"User asked: {_clip(message.get('content'), 300)}")
+        elif role == "assistant":
+            for tool_call in message.get("tool_calls") or []:
+                function = tool_call["function"]
+                parts.append(f"Called {function['name']}({_clip(function['arguments'], 200)})")
+            if message.get("content"):
+                parts.append(f"Assistant answered: {_clip(message['content'], 400)}")
+        elif role == "tool":
+            parts.append(f"Tool result: {_clip(message.get('content'), 300)}")
+    return "; ".join(parts)
+
+class ContextWindow:
+    """
+    Token-budgeted conversation history for the chat completion API.
+
+    Each message's token count is computed once when it is added. When the
+    history exceeds the budget, the oldest whole turns (user message plus
+    the assistant and tool messages that followed) are folded into a
+    rolling summary, which is cached and only extended on later folds.
+    The system prompt always comes first and the summary right after it,
+    so the prompt prefix stays stable between folds and provider-side
+    prompt caching keeps working. If the turns that are never folded are
+    over budget on their own, their tool results are cut down in the
+    prompt, largest first, while the window keeps them whole.
+    """
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, summarizer=summarize_turn):
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        # Each turn is a list of (message, tokens) pairs
+        self.turns = []
+        self.summary = ""
+        self.summary_tokens = 0
+        self.folded_turns = 0
+
+    def add(self, message):
+        """
+        Append an API message; a user message starts a new turn.
+        """
+        if message["role"] == "user" or not self.turns:
+            self.turns.append([])
+        self.turns[-1].append((message, count_message_tokens(message)))
+
+    def history_tokens(self):
+        """
+        Tokens currently held in verbatim history.
+        """
+        return sum(tokens for turn in self.turns for _, tokens in turn)
+
+    def build(self, system_prompt=""):
+        """
+        Build the message list for the next completion, folding old turns if needed.
+
+        Args:
+            system_prompt (str): System prompt placed at the start of the prompt
+
+        Returns:
+            list: Messages in API format
+        """
+        prefix_tokens = count_message_tokens({"content": system_prompt}) if system_prompt.strip() else 0
+        self._fold(self.token_budget - prefix_tokens)
+        cut = self._cut_tool_results(self.token_budget - prefix_tokens)
+
+        messages = []
+        if system_prompt.strip():
+            messages.append({"role": "system", "content": system_prompt})
+        if self.summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of {self.folded_turns} earlier turns: {self.summary}"
+            })
+        for turn in self.turns:
+            messages.extend(
+                {**message, "content": cut[id(message)]} if id(message) in cut else message
+                for message in self._complete_messages(turn)
+            )
+        return messages
+
+    def _cut_tool_results(self, budget):
+        # Shortened content by id() of each tool message that has to be cut:
+        # every result is capped at the largest common size that fits
+        excess = self.summary_tokens + self.history_tokens() - budget
+        results = [(message, tokens) for turn in self.turns for message, tokens in turn if message["role"] == "tool"]
+        if excess <= 0 or not results:
+            return {}
+
+        def saved(cap):
+            return sum(max(0, tokens - cap) for _, tokens in results)
+
+        low, high = MIN_TOOL_RESULT_TOKENS, max(tokens for _, tokens in results)
+        if saved(low) < excess:
+            logger.warning(f"Current turn is over the context budget by {excess - saved(low)} tokens "
+                           f"even with tool results cut to {low} tokens")
+            cap = low
+        else:
+            while low < high:
+                middle = (low + high + 1) // 2
+                if saved(middle) >= excess:
+                    low = middle
+                else:
+                    high = middle - 1
+            cap = low
+        logger.info(f"Cutting tool results in the current turn to {cap} tokens to fit the context budget")
+        return {
+            id(message): _cut_tool_result(message.get("content") or "", cap)
+            for message, tokens in results if tokens > cap
+        }
+
+    def _complete_messages(self, turn):
+        # A turn that failed part-way can leave tool calls without results,
+        # which the API rejects; send those calls' messages without them
+        answered = {message.get("tool_call_id") for message, _ in turn if message["role"] == "tool"}
+        orphaned = set()
+        for message, _ in turn:
+            tool_calls = message.get("tool_calls")
+            if tool_calls and any(tool_call["id"] not in answered for tool_call in tool_calls):
+                orphaned.update(tool_call["id"] for tool_call in tool_calls)
+                message = {key: value for key, value in message.items() if key != "tool_calls"}
+            elif message["role"] == "tool" and message.get("tool_call_id") in orphaned:
+                continue
+            yield message
+
+    def _fold(self, budget):
+        while (
+            len(self.turns) > MIN_RECENT_TURNS
+            and self.summary_tokens + self.history_tokens() > budget
+        ):
+            turn = self.turns.pop(0)
+            folded = self.summarizer([message for message, _ in turn])
+            self.summary = f"{self.summary} | {folded}" if self.summary else folded
+            self.folded_turns += 1
+            self.summary_tokens = count_message_tokens({"content": self.summary})
+            logger.info(f"Folded turn into context summary ({self.folded_turns} turns folded, {self.summary_tokens} summary tokens)")
+
+        # Keep the summary itself bounded by dropping its oldest entries
+        summary_budget = int(self.token_budget * SUMMARY_BUDGET_FRACTION)
+        while self.summary_tokens > summary_budget and " | " in self.summary:
+            self.summary = self.summary.split(" | ", 1)[1]
+            self.summary_tokens = count_message_tokens({"content": self.summary})
+
+    def to_dict(self):
+        """
+        Plain-data form of the window, for session stores.
+        """
+        return {
+            "turns": [[message for message, _ in turn] for turn in self.turns],
+            "summary": self.summary,
+            "folded_turns": self.folded_turns
+        }
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        """
+        Rebuild a window saved with to_dict(); token counts are recomputed.
+        """
+        window = cls(**kwargs)
+        window.turns = [[(message, count_message_tokens(message)) for message in turn] for turn in data.get("turns", [])]
+        window.summary = data.get("summary", "")
+        window.summary_tokens = count_message_tokens({"content": window.summary}) if window.summary else 0
+        window.folded_turns = data.get("folded_turns", 0)
+        return window
+
+    def clear(self):
+        """
+        Forget the whole conversation.
+        """
+        self.turns = []
+        self.summary = ""
+        self.summary_tokens = 0
+        self.folded_turns = 0
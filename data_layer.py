@@ -0,0 +1,161 @@
+from pymongo import MongoClient, AsyncMongoClient, monitoring
+from config import config
+import importlib.util
+import threading
+import asyncio
+import logging
+
+logger = logging.getLogger("llm_api")
+
+# Connection pool per Mongo server, shared by every tool call in the process
+MONGO_MAX_POOL_SIZE = int(config.get("mongo_max_pool_size", 100))
+MONGO_MIN_POOL_SIZE = int(config.get("mongo_min_pool_size", 4))
+MONGO_MAX_IDLE_TIME_MS = int(config.get("mongo_max_idle_time_ms", 300000))
+# How long a request may wait for a free pooled connection
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(config.get("mongo_wait_queue_timeout_ms", 10000))
+# Wire compressors in order of preference; those whose library is missing are skipped
+MONGO_COMPRESSORS = config.get("mongo_compressors", "zstd,snappy,zlib")
+
+# Python package each compressor needs; zlib is in the standard library
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": None}
+
+def available_compressors(preference=MONGO_COMPRESSORS):
+    """
+    The preferred wire compressors that can be used in this environment.
+
+    Returns:
+        list: Compressor names, most preferred first
+    """
+    compressors = []
+    for name in (name.strip() for name in preference.split(",") if name.strip()):
+        if name not in COMPRESSOR_MODULES:
+            logger.warning(f"Unknown Mongo compressor: {name}")
+        elif COMPRESSOR_MODULES[name] and importlib.util.find_spec(COMPRESSOR_MODULES[name]) is None:
+            logger.info(f"Mongo compressor {name} needs the {COMPRESSOR_MODULES[name]} package; skipping it")
+        else:
+            compressors.append(name)
+    return compressors
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool utilization per Mongo server, from pymongo's pool events.
+
+    Shared by the sync and async clients; snapshot() reports open and
+    checked-out connections, utilization against maxPoolSize, and how long
+    checkouts waited for a connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def _pool(self, address):
+        pool = self._pools.get(address)
+        if pool is None:
+            pool = self._pools[address] = {
+                "max_pool_size": MONGO_MAX_POOL_SIZE, "open": 0, "in_use": 0, "peak_in_use": 0,
+                "checkouts": 0, "checkout_failures": 0, "checkout_wait_seconds": 0.0, "cleared": 0
+            }
+        return pool
+
+    def pool_created(self, event):
+        with self._lock:
+            self._pool(event.address)["max_pool_size"] = event.options.get("maxPoolSize", MONGO_MAX_POOL_SIZE)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pool(event.address)["cleared"] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address)["open"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["open"] = max(0, pool["open"] - 1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._pool(event.address)["checkout_failures"] += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["checkouts"] += 1
+            pool["in_use"] += 1
+            pool["peak_in_use"] = max(pool["peak_in_use"], pool["in_use"])
+            pool["checkout_wait_seconds"] += getattr(event, "duration", 0) or 0
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["in_use"] = max(0, pool["in_use"] - 1)
+
+    def snapshot(self):
+        """
+        Pool statistics keyed by "host:port".
+        """
+        with self._lock:
+            pools = {f"{host}:{port}": dict(pool) for (host, port), pool in self._pools.items()}
+        for pool in pools.values():
+            pool["utilization"] = round(pool["in_use"] / pool["max_pool_size"], 3) if pool["max_pool_size"] else 0
+            wait = pool.pop("checkout_wait_seconds")
+            pool["avg_checkout_wait_ms"] = round(wait * 1000 / pool["checkouts"], 2) if pool["checkouts"] else 0
+        return pools
+
+pool_metrics = PoolMetrics()
+
+def mongo_client_options():
+    """
+    Pool, compression and monitoring options shared by the sync and async clients.
+    """
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "event_listeners": [pool_metrics],
+    }
+    compressors = available_compressors()
+    if compressors:
+        options["compressors"] = compressors
+    return options
+
+def create_mongo_client(uri=None):
+    """
+    Synchronous MongoClient with the shared pool settings.
+    """
+    return MongoClient(uri or config["mongo_uri"], **mongo_client_options())
+
+_async_clients = {}
+_async_clients_lock = threading.Lock()
+
+def get_async_mongo_client(uri=None):
+    """
+    Shared AsyncMongoClient with the shared pool settings.
+
+    An async client belongs to the event loop it is first used on, so one
+    client is kept per loop and URI.
+    """
+    key = (id(asyncio.get_running_loop()), uri or config["mongo_uri"])
+    with _async_clients_lock:
+        client = _async_clients.get(key)
+        if client is None:
+            options = mongo_client_options()
+            client = _async_clients[key] = AsyncMongoClient(key[1], **options)
+            logger.info(f"Created async Mongo client (pool {MONGO_MIN_POOL_SIZE}-{MONGO_MAX_POOL_SIZE}, "
+                        f"compressors: {options.get('compressors', [])})")
+        return client
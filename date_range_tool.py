@@ -1,18 +1,25 @@
-from pymongo import MongoClient
-from datetime import datetime
+from datetime import datetime, timezone
+from tool_result_serializer import max_page_size
 from config import config
 import logging
+import base64
+import json
 from dateutil import parser as date_parser
 
 # Update environment variables
 DB_NAME = config["db_name"]
 COLLECTION_NAME = config["collection_name"]
 
+# Also match vCons whose created_at is still stored as an ISO string
+LEGACY_STRING_DATES = config.get("date_range_legacy_string_dates", True)
+
+MAX_ALLOWED_LIMIT = 1000
+
 DATE_RANGE_TOOL = {
     "type": "function",
     "function": {
         "name": "find_by_date_range",
-        "description": "Find conversations within a specific time range. Returns conversation UUIDs that occurred between the specified start and end dates/times.",
+        "description": "Find conversations within a specific time range. Returns the UUIDs of conversations that occurred between the specified start and end dates/times, the total number of matches (first page only) and a next_cursor for fetching the next page.",
         "parameters": {
             "type": "object",
             "properties": {
@@ -26,12 +33,16 @@ DATE_RANGE_TOOL = {
                 },
                 "limit": {
                     "type": "integer",
-                    "description": "Maximum number of results to return (default: 100, max: 1000). Use with offset for pagination.",
+                    "description": "Maximum number of results to return per page (default: 100). Larger limits are reduced to what fits in one page. Use with cursor for pagination.",
                     "default": 100
                 },
+                "cursor": {
+                    "type": "string",
+                    "description": "Opaque next_cursor value from a previous find_by_date_range result. Pass it with the same dates to retrieve the next page."
+                },
                 "offset": {
                     "type": "integer",
-                    "description": "Number of results to skip. Use with limit for pagination to retrieve subsequent pages.",
+                    "description": "Number of results to skip. Prefer cursor, which stays fast on deep pages.",
                     "default": 0
                 },
                 "sort": {
@@ -57,131 +68,236 @@ DATE_RANGE_TOOL = {
                 "start_date": "2023-01-01",
                 "end_date": "2023-01-31",
                 "limit": 100,
-                "offset": 200,
+                "cursor": "eyJzIjoib2xkZXN0IiwidCI6ImRhdGUiLCJ1IjoiLi4uIiwidiI6Ii4uLiJ9",
                 "sort": "oldest"
             }
         ]
     }
 }
 
-def find_by_date_range(start_date, end_date, db_conn, limit=100, offset=None, sort=None):
+def parse_date_bound(value, end_of_day):
+    """
+    Parse a range bound into a timezone-aware UTC datetime.
+    
+    Date-only strings expand to the start or end of that day. Naive values
+    are taken to be UTC.
+    """
+    if isinstance(value, str):
+        parsed = date_parser.parse(value)
+        if value.find(':') == -1:
+            if end_of_day:
+                parsed = parsed.replace(hour=23, minute=59, second=59, microsecond=999999)
+            else:
+                parsed = parsed.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        parsed = value
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def encode_cursor(sort, created_at, uuid):
+    """
+    Encode the sort position after the last returned vCon as an opaque cursor.
+    """
+    if isinstance(created_at, datetime):
+        value_type, value = "date", created_at.replace(tzinfo=created_at.tzinfo or timezone.utc).isoformat()
+    else:
+        value_type, value = "string", created_at
+    payload = json.dumps({"s": sort, "t": value_type, "v": value, "u": uuid}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from encode_cursor().
+    
+    Returns:
+        tuple: (sort, created_at, uuid)
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        value = payload["v"]
+        if payload["t"] == "date":
+            value = datetime.fromisoformat(value)
+        return payload["s"], value, payload["u"]
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def _range_filters(start_dt, end_dt):
+    """
+    created_at conditions per stored type, in ascending BSON sort order.
+    
+    BSON sorts strings before dates, so with legacy data an ascending sort
+    returns all string-dated vCons first and a descending sort returns them
+    last. Strings are compared lexically against UTC ISO bounds, which is
+    only exact for values stored in UTC.
+    """
+    filters = []
+    if LEGACY_STRING_DATES:
+        filters.append(("string", {
+            "$gte": start_dt.strftime("%Y-%m-%dT%H:%M:%S"),
+            # Any suffix (fraction, offset, "Z") of the last second still matches
+            "$lte": end_dt.strftime("%Y-%m-%dT%H:%M:%S") + "\uffff"
+        }))
+    filters.append(("date", {"$gte": start_dt, "$lte": end_dt}))
+    return filters
+
+def keyset_filter(range_filters, sort, last_value, last_uuid):
+    """
+    Match everything after (last_value, last_uuid) in the requested order.
+    
+    The sort is on (created_at, uuid) with uuid in the opposite direction so
+    the created_at/uuid index serves both orders.
+    """
+    newest = sort == "newest"
+    value_type = "date" if isinstance(last_value, datetime) else "string"
+    types = [t for t, _ in range_filters]
+    conditions = dict(range_filters)
+    
+    clauses = [
+        {"created_at": {**conditions[value_type], "$lt" if newest else "$gt": last_value}},
+        {"created_at": last_value, "uuid": {"$gt" if newest else "$lt": last_uuid}}
+    ]
+    # Types that sort after the cursor's type in this direction are still to come
+    position = types.index(value_type) if value_type in types else 0
+    remaining = types[:position] if newest else types[position + 1:]
+    clauses.extend({"created_at": conditions[t]} for t in remaining)
+    return {"$or": clauses}
+
+def find_by_date_range(start_date, end_date, db_conn, limit=100, offset=None, sort=None, cursor=None):
     """
     Find conversations within a datetime range.
     
+    Runs a single aggregation per call. The first page uses $facet to return
+    the total match count together with the page; later pages pass the
+    returned cursor and seek straight to their position on the
+    created_at/uuid index instead of skipping.
+    
     Args:
         start_date (str or datetime): Start of the time range
         end_date (str or datetime): End of the time range
         db_conn: Database connection
         limit (int): Maximum number of results to return
-        offset (int): Number of results to skip
+        offset (int): Number of results to skip (prefer cursor)
         sort (str): Sort order - 'newest' or 'oldest'
+        cursor (str): next_cursor from a previous call
         
     Returns:
-        list: List of conversation UUIDs matching the time range
+        dict: uuids, total (first page only) and next_cursor (None on the last page)
     """
+    query = _date_range_query(start_date, end_date, limit, offset, sort, cursor)
+    if isinstance(query, str):
+        return query
+    pipeline, page = query
+    results = list(db_conn[DB_NAME][COLLECTION_NAME].aggregate(pipeline))
+    return _date_range_page(results, **page)
+
+async def find_by_date_range_async(start_date, end_date, db_conn, limit=100, offset=None, sort=None, cursor=None):
+    """
+    find_by_date_range() for an AsyncMongoClient connection.
+    """
+    query = _date_range_query(start_date, end_date, limit, offset, sort, cursor)
+    if isinstance(query, str):
+        return query
+    pipeline, page = query
+    results = await (await db_conn[DB_NAME][COLLECTION_NAME].aggregate(pipeline)).to_list(None)
+    return _date_range_page(results, **page)
+
+def _date_range_query(start_date, end_date, limit, offset, sort, cursor):
+    # Aggregation pipeline for one page, or an error message for the model
     logger = logging.getLogger("llm_api")
     logger.info(f"Finding conversations between {start_date} and {end_date}")
     
     # Handle date parsing with error handling
     try:
-        # Parse string dates if necessary, preserving time components
-        if isinstance(start_date, str):
-            try:
-                start_dt = date_parser.parse(start_date)
-                # If no time was specified, set to start of day
-                if start_date.find(':') == -1:
-                    start_dt = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-            except ValueError:
-                logger.error(f"Invalid start date format: {start_date}")
-                return []
-        else:
-            start_dt = start_date
-            
-        if isinstance(end_date, str):
-            try:
-                end_dt = date_parser.parse(end_date)
-                # If no time was specified, set to end of day
-                if end_date.find(':') == -1:
-                    end_dt = end_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
-            except ValueError:
-                logger.error(f"Invalid end date format: {end_date}")
-                return []
-        else:
-            end_dt = end_date
-        
-        # Convert to ISO format strings for MongoDB
-        start_iso = start_dt.isoformat()
-        end_iso = end_dt.isoformat()
-        
-        logger.info(f"Parsed time range: {start_iso} to {end_iso}")
-    except Exception as e:
-        logger.error(f"Error parsing date range: {e}")
-        return []
-    
-    # MongoDB query
-    db = db_conn[DB_NAME]
-    collection = db[COLLECTION_NAME]
+        start_dt = parse_date_bound(start_date, end_of_day=False)
+        end_dt = parse_date_bound(end_date, end_of_day=True)
+        logger.info(f"Parsed time range: {start_dt.isoformat()} to {end_dt.isoformat()}")
+    except (ValueError, OverflowError) as e:
+        logger.error(f"Invalid date range {start_date} to {end_date}: {e}")
+        return f"Error: invalid date range {start_date} to {end_date}"
     
     # Apply a reasonable default limit if none provided
     if limit is None:
         limit = 100
     
+    # A page needs at least one row to carry a cursor
+    if limit < 1:
+        logger.warning(f"Requested limit {limit} is below 1. Using 1 instead.")
+        limit = 1
+    
     # Ensure limit is not excessive
-    MAX_ALLOWED_LIMIT = 1000
     if limit > MAX_ALLOWED_LIMIT:
         logger.warning(f"Requested limit {limit} exceeds maximum allowed {MAX_ALLOWED_LIMIT}. Using {MAX_ALLOWED_LIMIT} instead.")
         limit = MAX_ALLOWED_LIMIT
     
-    # Create the base query with time range filter
-    query_filter = {
-        "created_at": {
-            "$gte": start_iso,
-            "$lte": end_iso
-        }
-    }
+    # A page must fit the tool's output budget, or trimming would desync next_cursor
+    page_size = max_page_size("find_by_date_range")
+    if limit > page_size:
+        logger.info(f"Limit {limit} does not fit the tool output budget. Using {page_size} per page.")
+        limit = page_size
     
-    logger.debug(f"MongoDB query filter: {query_filter}")
-    
-    # Count total matching documents
-    total_matching = collection.count_documents(query_filter)
-    logger.info(f"Total matching documents: {total_matching}")
-    
-    # Create the base query
-    query = collection.find(
-        query_filter,
-        {"uuid": 1, "_id": 0}
-    )
-    
-    # Apply sort if provided
-    if sort:
-        if sort == "newest":
-            query = query.sort("created_at", -1)  # Descending order
-        elif sort == "oldest":
-            query = query.sort("created_at", 1)   # Ascending order
-        else:
-            logger.warning(f"Unknown sort value: {sort}. Using 'newest' as default.")
-            query = query.sort("created_at", -1)  # Default to newest first
-    else:
-        # Default sort is newest first
-        query = query.sort("created_at", -1)
+    if sort not in (None, "newest", "oldest"):
+        logger.warning(f"Unknown sort value: {sort}. Using 'newest' as default.")
+        sort = None
+    sort = sort or "newest"
+    
+    range_filters = _range_filters(start_dt, end_dt)
+    range_match = {"$or": [{"created_at": condition} for _, condition in range_filters]}
     
-    # Apply offset (skip) if provided
-    if offset:
-        query = query.skip(offset)
+    if cursor:
+        try:
+            sort, last_value, last_uuid = decode_cursor(cursor)
+        except ValueError as e:
+            logger.error(str(e))
+            return f"Error: {e}. Start again without a cursor."
+        match = {"$and": [range_match, keyset_filter(range_filters, sort, last_value, last_uuid)]}
+    else:
+        match = range_match
     
-    # Apply limit
-    query = query.limit(limit)
+    direction = -1 if sort == "newest" else 1
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": direction, "uuid": -direction}},
+        {"$project": {"_id": 0, "uuid": 1, "created_at": 1}}
+    ]
     
-    # Execute the query and get results
-    results = list(query)
+    # Fetch one extra document to know whether another page exists
+    page = ([{"$skip": offset}] if offset and offset > 0 and not cursor else []) + [{"$limit": limit + 1}]
+    if cursor:
+        pipeline.extend(page)
+    else:
+        pipeline.append({"$facet": {
+            "total": [{"$count": "count"}],
+            "page": page
+        }})
     
-    logger.info(f"Retrieved {len(results)} documents (limit: {limit}, offset: {offset or 0})")
+    logger.debug(f"MongoDB aggregation pipeline: {pipeline}")
+    return pipeline, {"cursor": cursor, "limit": limit, "sort": sort}
+
+def _date_range_page(results, cursor, limit, sort):
+    logger = logging.getLogger("llm_api")
+    if cursor:
+        docs = results
+        total = None
+    else:
+        facet = results[0] if results else {"total": [], "page": []}
+        docs = facet["page"]
+        total = facet["total"][0]["count"] if facet["total"] else 0
+        logger.info(f"Total matching documents: {total}")
     
-    # Extract just the UUIDs from the results
-    uuids = [doc["uuid"] for doc in results]
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_cursor(sort, docs[-1]["created_at"], docs[-1]["uuid"]) if has_more else None
     
-    # If we hit the limit, log a warning
-    if len(results) == limit and limit < total_matching:
-        logger.warning(f"Result set limited to {limit} records. {total_matching - limit} more records match the query.")
+    logger.info(f"Retrieved {len(docs)} documents (limit: {limit}, more: {has_more})")
     
-    return uuids
\ No newline at end of file
+    result = {
+        "uuids": [doc["uuid"] for doc in docs],
+        "next_cursor": next_cursor
+    }
+    if total is not None:
+        result["total"] = total
+    return result
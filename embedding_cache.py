@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from pathlib import Path
+from config import config
+import numpy as np
+import unicodedata
+import threading
+import hashlib
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = config.get("embedding_cache_path", ".cache/embedding_cache.sqlite3")
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(config.get("embedding_cache_memory_entries", 2048))
+EMBEDDING_CACHE_DISK_ENTRIES = int(config.get("embedding_cache_disk_entries", 200000))
+
+def normalize_text(text):
+    """
+    Normalize text so trivially different spellings share a cache entry.
+
+    Applies Unicode NFC normalization and collapses runs of whitespace.
+    Case is preserved because it can change the embedding.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def cache_key(model, text):
+    """
+    Build the cache key for a (model, normalized text) pair.
+    """
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU in front of a SQLite store.
+
+    Vectors are stored on disk as raw float32 blobs. When the disk tier grows
+    past max_disk_entries the least recently used rows are evicted.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_memory_entries=EMBEDDING_CACHE_MEMORY_ENTRIES,
+                 max_disk_entries=EMBEDDING_CACHE_DISK_ENTRIES):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+        self._db = None
+        self._disk_entries = 0
+        if path:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, "
+                    "last_access REAL NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+                )
+                self._db.commit()
+                self._disk_entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            except sqlite3.Error as e:
+                logger.error(f"Embedding cache disk tier disabled: {str(e)}")
+                self._db = None
+
+    def get(self, model, text):
+        """
+        Look up a cached embedding.
+
+        Returns:
+            list: The embedding vector, or None on a miss
+        """
+        key = cache_key(model, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return vector
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key)
+                    )
+                    self._db.commit()
+                    vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self._remember(key, vector)
+                    self.stats["disk_hits"] += 1
+                    return vector
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, model, text, vector):
+        """
+        Store an embedding in both tiers.
+        """
+        key = cache_key(model, text)
+        with self._lock:
+            self._remember(key, list(vector))
+            if self._db is None:
+                return
+            try:
+                exists = self._db.execute(
+                    "SELECT 1 FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector, last_access) VALUES (?, ?, ?, ?)",
+                    (key, model, np.asarray(vector, dtype=np.float32).tobytes(), time.time())
+                )
+                if exists is None:
+                    self._disk_entries += 1
+                self._evict_disk()
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not write embedding to disk cache: {str(e)}")
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        excess = self._disk_entries - self.max_disk_entries
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (excess,)
+            )
+            self._disk_entries -= excess
+            self.stats["evictions"] += excess
+
+    def get_stats(self):
+        """
+        Return hit/miss counters and current tier sizes.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_entries"] = self._disk_entries
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+# Shared cache for the whole process
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,263 @@
+from concurrent.futures import ThreadPoolExecutor
+from backend_limits import backend_slot
+from rate_limiter import get_scheduler
+from tool_result_serializer import estimate_tokens
+from ollama_provider import get_ollama_client
+from config import config
+import contextvars
+import threading
+import logging
+import openai
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_PROVIDER = config.get("embedding_provider", "openai")
+EMBEDDING_BATCH_SIZE = int(config.get("embedding_batch_size", 64))
+EMBEDDING_THREADS = int(config.get("embedding_threads", 4))
+
+# Default model for each provider when embedding_model is not set
+DEFAULT_EMBEDDING_MODELS = {
+    "openai": "text-embedding-ada-002",
+    "ollama": "nomic-embed-text",
+    "local": "sentence-transformers/all-MiniLM-L6-v2",
+}
+
+# Vector length of the configured model; takes precedence over KNOWN_EMBEDDING_DIMENSIONS
+EMBEDDING_DIMENSION = config.get("embedding_dimension")
+
+# Vector length of common models, so knowing it needs no embedding call
+KNOWN_EMBEDDING_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "nomic-embed-text": 768,
+    "mxbai-embed-large": 1024,
+    "all-minilm": 384,
+    "sentence-transformers/all-MiniLM-L6-v2": 384,
+    "sentence-transformers/all-mpnet-base-v2": 768,
+}
+
+class EmbeddingDimensionError(ValueError):
+    """Raised when a provider's vectors do not match the Milvus embedding field."""
+
+class EmbeddingProvider:
+    """
+    Base class for embedding backends.
+
+    Subclasses implement _embed_batch(); embed() splits the input into
+    batches of batch_size and runs them on a shared thread pool.
+    """
+
+    name = "base"
+
+    def __init__(self, model, batch_size=EMBEDDING_BATCH_SIZE, threads=EMBEDDING_THREADS):
+        self.model = model
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"embed-{self.name}")
+        self._dimension = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache_namespace(self):
+        """
+        Key prefix for cached vectors, so providers never share entries.
+        """
+        return f"{self.name}:{self.model}"
+
+    def embed(self, texts):
+        """
+        Embed several texts.
+
+        Args:
+            texts (list): Texts to embed
+
+        Returns:
+            list: One vector per text, in input order
+        """
+        if not texts:
+            return []
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            embeddings = self._embed_batch(batches[0])
+        else:
+            # Each batch runs in its own copy of the caller's context so its spans join the caller's trace
+            contexts = [contextvars.copy_context() for _ in batches]
+            embeddings = []
+            for batch_embeddings in self._executor.map(
+                lambda context, batch: context.run(self._embed_batch, batch), contexts, batches
+            ):
+                embeddings.extend(batch_embeddings)
+        self._observe_dimension(len(embeddings[0]))
+        return embeddings
+
+    @property
+    def dimension(self):
+        """
+        Length of this provider's vectors.
+
+        Taken from embedding_dimension or KNOWN_EMBEDDING_DIMENSIONS, or from
+        vectors already embedded; only an unknown model is probed, once,
+        with a short input.
+        """
+        with self._lock:
+            if self._dimension is None:
+                self._dimension = self._known_dimension()
+        if self._dimension is None:
+            self._observe_dimension(len(self._embed_batch(["dimension check"])[0]))
+        return self._dimension
+
+    def _known_dimension(self):
+        if EMBEDDING_DIMENSION:
+            return int(EMBEDDING_DIMENSION)
+        # Ollama model names may carry a tag, e.g. nomic-embed-text:latest
+        return KNOWN_EMBEDDING_DIMENSIONS.get(self.model, KNOWN_EMBEDDING_DIMENSIONS.get(self.model.split(":")[0]))
+
+    def _observe_dimension(self, dimension):
+        # Real vectors win over configured or tabled lengths
+        with self._lock:
+            if self._dimension is not None and self._dimension != dimension:
+                logger.warning(f"{self.cache_namespace} returned {dimension}-dimensional vectors, "
+                               f"not the expected {self._dimension}")
+            self._dimension = dimension
+
+    def _embed_batch(self, texts):
+        raise NotImplementedError
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """
+    Embeddings from the OpenAI embeddings API.
+    """
+
+    name = "openai"
+
+    def __init__(self, model, api_key=None, **kwargs):
+        # The API accepts up to 2048 inputs per request
+        kwargs.setdefault("batch_size", 2048)
+        super().__init__(model, **kwargs)
+        # Retries are left to the rate limit scheduler
+        self.client = openai.OpenAI(api_key=api_key or config["openai_api_key"], max_retries=0)
+
+    def _embed_batch(self, texts):
+        response = get_scheduler("openai").call(self._create, texts, tokens=sum(estimate_tokens(text) for text in texts))
+        # The API returns one item per input, tagged with its position
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def _create(self, texts):
+        with backend_slot("embeddings"):
+            return self.client.embeddings.with_raw_response.create(input=texts, model=self.model)
+
+class OllamaEmbeddingProvider(EmbeddingProvider):
+    """
+    Embeddings from a local Ollama server's batched /api/embed endpoint.
+    """
+
+    name = "ollama"
+
+    def __init__(self, model, host=None, **kwargs):
+        super().__init__(model, **kwargs)
+        self.client = get_ollama_client(host or config.get("ollama_host", "http://localhost:11434"))
+
+    def _embed_batch(self, texts):
+        return get_scheduler("ollama").call(self._post, texts, tokens=sum(estimate_tokens(text) for text in texts))
+
+    def _post(self, texts):
+        with backend_slot("embeddings"):
+            response = self.client.post("/api/embed", {
+                "model": self.model,
+                "input": texts,
+                "keep_alive": self.client.keep_alive
+            })
+        return response.json()["embeddings"]
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    In-process CPU embeddings with sentence-transformers.
+
+    The model is loaded on first use. sentence-transformers is optional and
+    only needed when this provider is selected.
+    """
+
+    name = "local"
+
+    def __init__(self, model, device="cpu", **kwargs):
+        super().__init__(model, **kwargs)
+        self.device = device
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    def _load(self):
+        with self._model_lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError as e:
+                    raise ImportError(
+                        "embedding_provider 'local' needs sentence-transformers: pip install sentence-transformers"
+                    ) from e
+                logger.info(f"Loading local embedding model {self.model} on {self.device}")
+                self._model = SentenceTransformer(self.model, device=self.device)
+            return self._model
+
+    def _embed_batch(self, texts):
+        model = self._load()
+        return model.encode(texts, batch_size=len(texts), convert_to_numpy=True).tolist()
+
+PROVIDERS = {
+    "openai": OpenAIEmbeddingProvider,
+    "ollama": OllamaEmbeddingProvider,
+    "local": LocalEmbeddingProvider,
+}
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def get_embedding_provider():
+    """
+    The process-wide embedding provider selected by embedding_provider.
+
+    Returns:
+        EmbeddingProvider: Provider for embedding_model (or the provider's default model)
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            if EMBEDDING_PROVIDER not in PROVIDERS:
+                raise ValueError(f"Unknown embedding_provider: {EMBEDDING_PROVIDER}")
+            model = config.get("embedding_model", DEFAULT_EMBEDDING_MODELS[EMBEDDING_PROVIDER])
+            _provider = PROVIDERS[EMBEDDING_PROVIDER](model)
+            logger.info(f"Using {EMBEDDING_PROVIDER} embeddings with model {model}")
+        return _provider
+
+def set_embedding_provider(provider):
+    """
+    Use this provider for the rest of the process instead of the configured one.
+
+    Args:
+        provider (EmbeddingProvider): Provider to return from get_embedding_provider()
+    """
+    global _provider
+    with _provider_lock:
+        _provider = provider
+
+def check_embedding_dimension(provider, collection, anns_field="embedding"):
+    """
+    Make sure the provider's vectors fit the collection's vector field.
+
+    Args:
+        provider (EmbeddingProvider): Provider used for queries
+        collection: Milvus collection
+        anns_field (str): Name of the vector field
+
+    Raises:
+        EmbeddingDimensionError: If the dimensions differ
+    """
+    for field in collection.schema.fields:
+        if field.name == anns_field:
+            expected = int(field.params.get("dim", 0))
+            if expected and provider.dimension != expected:
+                raise EmbeddingDimensionError(
+                    f"{provider.cache_namespace} produces {provider.dimension}-dimensional vectors "
+                    f"but {collection.name}.{anns_field} expects {expected}"
+                )
+            return
+    logger.warning(f"Field {anns_field} not found in collection {collection.name}")
@@ -1,4 +1,9 @@
-from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from bson import CodecOptions, encode, decode
+from bson.raw_bson import RawBSONDocument
+from tool_result_serializer import (
+    VCON_FIELDS, PARTY_FIELDS, DIALOG_FIELDS, ANALYSIS_FIELDS, ATTACHMENT_FIELDS, DEFAULT_VCON_SECTIONS
+)
 from config import config
 import logging
 
@@ -9,6 +14,20 @@ logger = logging.getLogger(__name__)
 DB_NAME = config["db_name"]
 COLLECTION_NAME = config["collection_name"]
 
+# Fetch only the fields the requested sections need; False returns whole documents
+CONVERSATION_PROJECTION = config.get("conversation_projection", True)
+# Fetched documents larger than this keep only the top-level fields that fit
+CONVERSATION_MAX_DOCUMENT_BYTES = int(config.get("conversation_max_document_bytes", 512 * 1024))
+
+# Decoded lazily, so a document's size is known before any of it is decoded
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+# Server error code for an aggregation expression it does not know
+INVALID_PIPELINE_OPERATOR = 168
+
+# Top-level fields in the order they are kept when a document is over the size cap
+FIELD_PRIORITY = list(VCON_FIELDS) + ["parties", "analysis", "dialog", "attachments"]
+
 GET_CONVERSATION_BY_ID = {
     "type": "function",
     "function": {
@@ -24,6 +43,14 @@ GET_CONVERSATION_BY_ID = {
                     },
                     "description": "List of UUIDs of the conversations (max 10)",
                     "maxItems": 10
+                },
+                "sections": {
+                    "type": "array",
+                    "items": {
+                        "type": "string",
+                        "enum": ["parties", "dialog", "summary", "transcript", "analysis", "attachments"]
+                    },
+                    "description": "Sections of each conversation to return in full. Defaults to parties and summary; other bodies are replaced by a size placeholder. Request 'dialog' or 'transcript' only when the wording of the conversation is needed."
                 }
             },
             "required": ["uuids"]
@@ -31,7 +58,158 @@ GET_CONVERSATION_BY_ID = {
     }
 }
 
-def get_conversation_by_id(uuids, db_conn, max_results=10):
+def _not_encoded(item):
+    # Server-side version of tool_result_serializer._is_encoded(), negated
+    return {"$not": {"$in": [{"$toLower": {"$ifNull": [f"$${item}.encoding", ""]}}, ["base64", "base64url"]]}}
+
+def _body(item, keep):
+    # The body when keep holds, otherwise a placeholder with its length
+    placeholder = {
+        "omitted": True,
+        "chars": {"$cond": [{"$eq": [{"$type": f"$${item}.body"}, "string"]}, {"$strLenCP": f"$${item}.body"}, "$$REMOVE"]}
+    }
+    if keep is False:
+        value = placeholder
+    else:
+        value = {"$cond": [keep, f"$${item}.body", placeholder]}
+    # A missing or null body stays absent, as compact_vcon() leaves it
+    return {"$cond": [{"$eq": [{"$ifNull": [f"$${item}.body", None]}, None]}, "$$REMOVE", value]}
+
+def _map(field, item, fields, keep_body=None):
+    # Each array element reduced to fields, and its body if keep_body is given
+    projected = {key: f"$${item}.{key}" for key in fields}
+    if keep_body is not None:
+        projected["body"] = _body(item, keep_body)
+    return {"$map": {"input": f"${field}", "as": item, "in": projected}}
+
+def conversation_projection(sections=None):
+    """
+    $project stage that fetches only what compact_vcon() uses for these sections.
+
+    Bodies that would be replaced by a size placeholder are replaced on the
+    server, so recordings and encoded attachments never leave MongoDB unless
+    their section was requested.
+
+    Args:
+        sections (list): Requested sections (see VCON_SECTIONS)
+
+    Returns:
+        dict: The projection
+    """
+    sections = set(sections or DEFAULT_VCON_SECTIONS)
+    projection = {"_id": 0, **dict.fromkeys(VCON_FIELDS, 1)}
+    if "parties" in sections:
+        projection["parties"] = _map("parties", "party", PARTY_FIELDS)
+
+    keep_dialog = {"$and": [{"$eq": ["$$dialog.type", "text"]}, _not_encoded("dialog")]} if "dialog" in sections else False
+    projection["dialog"] = _map("dialog", "dialog", DIALOG_FIELDS, keep_dialog)
+
+    if "analysis" in sections:
+        keep_analysis = _not_encoded("analysis")
+    else:
+        wanted_types = [section for section in ("summary", "transcript") if section in sections]
+        keep_analysis = {"$and": [
+            {"$regexMatch": {"input": {"$toString": {"$ifNull": ["$$analysis.type", ""]}}, "regex": "|".join(wanted_types)}},
+            _not_encoded("analysis")
+        ]} if wanted_types else False
+    projection["analysis"] = _map("analysis", "analysis", ANALYSIS_FIELDS, keep_analysis)
+
+    keep_attachments = _not_encoded("attachment") if "attachments" in sections else False
+    projection["attachments"] = _map("attachments", "attachment", ATTACHMENT_FIELDS, keep_attachments)
+    return projection
+
+# Cleared once the database turns out not to support them (e.g. mongomock, or an old server)
+_raw_documents_supported = True
+_projection_supported = True
+
+def _collection(db_conn):
+    # The vCon collection, returning RawBSONDocument where the driver supports it
+    global _raw_documents_supported
+    collection = db_conn[DB_NAME][COLLECTION_NAME]
+    if _raw_documents_supported:
+        try:
+            return collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+        except NotImplementedError as e:
+            _raw_documents_supported = False
+            logger.warning(f"Raw BSON documents are not supported ({e}); decoding whole documents")
+    return collection
+
+def _conversation_pipeline(uuids, max_results, sections):
+    pipeline = [{"$match": {"uuid": {"$in": uuids}}}, {"$limit": max_results}]
+    if CONVERSATION_PROJECTION and _projection_supported:
+        pipeline.append({"$project": conversation_projection(sections)})
+    return pipeline
+
+def _projection_unsupported(error):
+    """
+    Whether a failed query should be retried without the projection.
+
+    True, once, when the database rejects the projection's expressions.
+    Whole documents are then fetched and compacted by the client.
+    """
+    global _projection_supported
+    unsupported = isinstance(error, NotImplementedError) or (
+        isinstance(error, OperationFailure)
+        and (error.code == INVALID_PIPELINE_OPERATOR or "Unrecognized expression" in str(error))
+    )
+    if not (unsupported and CONVERSATION_PROJECTION and _projection_supported):
+        return False
+    _projection_supported = False
+    logger.warning(f"The database does not support the conversation projection ({error}); fetching whole documents")
+    return True
+
+def decode_conversation(raw_vcon, max_bytes=CONVERSATION_MAX_DOCUMENT_BYTES):
+    """
+    Decode a RawBSONDocument vCon, within a size cap.
+
+    A document within the cap is decoded as a whole. A larger one keeps its
+    top-level fields in FIELD_PRIORITY order while they fit; each field that
+    does not is replaced by {"omitted": True, "bytes": n} and never decoded.
+    Already decoded documents get the same cap.
+
+    Returns:
+        dict: The vCon
+    """
+    raw = raw_vcon.raw if isinstance(raw_vcon, RawBSONDocument) else encode(raw_vcon)
+    size = len(raw)
+    if size <= max_bytes:
+        return decode(raw) if isinstance(raw_vcon, RawBSONDocument) else raw_vcon
+
+    vcon = {}
+    remaining = max_bytes
+    keys = sorted(raw_vcon.keys(), key=lambda key: FIELD_PRIORITY.index(key) if key in FIELD_PRIORITY else len(FIELD_PRIORITY))
+    for key in keys:
+        # Re-encoding copies the field's raw bytes; nothing below the top level is decoded
+        field = encode({key: raw_vcon[key]})
+        if len(field) <= remaining:
+            vcon.update(decode(field))
+            remaining -= len(field)
+        else:
+            vcon[key] = {"omitted": True, "bytes": len(field)}
+    logger.warning(f"Conversation {vcon.get('uuid')} is {size} bytes; "
+                   f"kept fields within {max_bytes} bytes")
+    return vcon
+
+def get_conversation_by_id(uuids, db_conn, max_results=10, sections=None):
+    """
+    Fetch vCons by UUID.
+
+    The limit is applied on the server, the projection follows the requested
+    sections, and documents arrive as RawBSONDocument so each one's size is
+    checked before it is decoded.
+
+    Args:
+        uuids (list or str): vCon UUIDs (at most 10 are used)
+        db_conn: Database connection
+        max_results (int): Maximum number of vCons to return
+        sections (list): Sections that will be shown in full (see VCON_SECTIONS)
+
+    Returns:
+        list: vCons
+
+    Raises:
+        PyMongoError: If the query fails, so the caller reports an error rather than no matches
+    """
     # Ensure uuids is a list
     if isinstance(uuids, str):
         uuids = [uuids]
@@ -39,17 +217,38 @@ def get_conversation_by_id(uuids, db_conn, max_results=10):
     # Limit to maximum 10 UUIDs
     uuids = uuids[:10]
     
+    logger.debug(f"Querying database {DB_NAME}.{COLLECTION_NAME} for UUIDs: {uuids}")
+    collection = _collection(db_conn)
+    
+    # Perform the search
+    try:
+        raw_vcons = list(collection.aggregate(_conversation_pipeline(uuids, max_results, sections)))
+    except (OperationFailure, NotImplementedError) as e:
+        if not _projection_unsupported(e):
+            raise
+        raw_vcons = list(collection.aggregate(_conversation_pipeline(uuids, max_results, sections)))
+    results = [decode_conversation(raw_vcon) for raw_vcon in raw_vcons]
+    
+    logger.info(f"Found {len(results)} conversations for the requested UUIDs")
+    return results
+
+async def get_conversation_by_id_async(uuids, db_conn, max_results=10, sections=None):
+    """
+    get_conversation_by_id() for an AsyncMongoClient connection.
+    """
+    if isinstance(uuids, str):
+        uuids = [uuids]
+    uuids = uuids[:10]
+    
+    collection = _collection(db_conn)
     try:
-        logger.debug(f"Querying database {DB_NAME}.{COLLECTION_NAME} for UUIDs: {uuids}")
-        db = db_conn[DB_NAME]
-        collection = db[COLLECTION_NAME]
-        
-        # Perform the search
-        query_filter = {"uuid": {"$in": uuids}}
-        results = list(collection.find(query_filter))[:max_results]
-        
-        logger.info(f"Found {len(results)} conversations for the requested UUIDs")
-        return results
-    except Exception as e:
-        logger.error(f"Error querying MongoDB: {str(e)}")
-        return []
+        cursor = await collection.aggregate(_conversation_pipeline(uuids, max_results, sections))
+        raw_vcons = await cursor.to_list(None)
+    except (OperationFailure, NotImplementedError) as e:
+        if not _projection_unsupported(e):
+            raise
+        cursor = await collection.aggregate(_conversation_pipeline(uuids, max_results, sections))
+        raw_vcons = await cursor.to_list(None)
+    results = [decode_conversation(raw_vcon) for raw_vcon in raw_vcons]
+    logger.info(f"Found {len(results)} conversations for the requested UUIDs")
+    return results
@@ -0,0 +1,197 @@
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from date_range_tool import _date_range_query, encode_cursor
+from get_conversation_by_id_tool import _conversation_pipeline
+from party_tool import _party_query, PARTY_SORT
+from datetime import datetime, timezone
+from config import config
+import threading
+import argparse
+import logging
+import sys
+
+logger = logging.getLogger("llm_api")
+
+DB_NAME = config["db_name"]
+COLLECTION_NAME = config["collection_name"]
+
+# Indexes the conversation tools rely on: (name, keys)
+VCON_INDEXES = [
+    # find_by_date_range filters and sorts on created_at and only returns uuid
+    ("created_at_uuid", [("created_at", DESCENDING), ("uuid", ASCENDING)]),
+    # get_conversation_by_id looks vCons up with uuid $in
+    ("uuid", [("uuid", ASCENDING)]),
+    # find_by_party matches normalized party keys, newest first
+    ("party_keys_created_at", [("party_keys", ASCENDING), ("created_at", DESCENDING), ("uuid", ASCENDING)]),
+    # Exact find_by_party also ORs over the raw fields; each branch needs its own
+    # index, in the same order so the branches merge without an in-memory sort
+    ("parties_tel_created_at", [("parties.tel", ASCENDING), ("created_at", DESCENDING), ("uuid", ASCENDING)]),
+    ("parties_mailto_created_at", [("parties.mailto", ASCENDING), ("created_at", DESCENDING), ("uuid", ASCENDING)]),
+    ("parties_name_created_at", [("parties.name", ASCENDING), ("created_at", DESCENDING), ("uuid", ASCENDING)]),
+]
+
+# Representative arguments for each tool query that is checked
+SAMPLE_START, SAMPLE_END = "2024-01-01", "2024-01-31"
+SAMPLE_UUID = "00000000-0000-0000-0000-000000000000"
+SAMPLE_PARTY = "+15555550100"
+
+def query_shapes():
+    """
+    The queries the tools actually send, built by the tools' own helpers.
+
+    Returns:
+        list: (tool, explain command) pairs for the database's explain command
+    """
+    first_page, _ = _date_range_query(SAMPLE_START, SAMPLE_END, 100, None, None, None)
+    cursor = encode_cursor("newest", datetime(2024, 1, 15, tzinfo=timezone.utc), SAMPLE_UUID)
+    next_page, _ = _date_range_query(SAMPLE_START, SAMPLE_END, 100, None, None, cursor)
+    _, party_query = _party_query(SAMPLE_PARTY, "exact", None)
+    return [
+        ("find_by_date_range", {"aggregate": COLLECTION_NAME, "pipeline": first_page, "cursor": {}}),
+        ("find_by_date_range (cursor page)", {"aggregate": COLLECTION_NAME, "pipeline": next_page, "cursor": {}}),
+        ("get_conversation_by_id", {
+            "aggregate": COLLECTION_NAME,
+            "pipeline": _conversation_pipeline([SAMPLE_UUID], 10, None),
+            "cursor": {}
+        }),
+        ("find_by_party", {
+            "find": COLLECTION_NAME,
+            "filter": party_query,
+            "projection": {"uuid": 1, "created_at": 1, "_id": 0},
+            "sort": dict(PARTY_SORT),
+            "limit": 51
+        }),
+    ]
+
+# Plan stages that mean a query will not scale with the collection
+BAD_STAGES = {"COLLSCAN", "SORT"}
+
+class QueryPlanError(Exception):
+    """Raised in strict mode when a tool query would scan the collection or sort in memory."""
+
+def ensure_indexes(db_conn):
+    """
+    Create the indexes the conversation tools need, if they do not exist yet.
+
+    Args:
+        db_conn: Database connection
+
+    Returns:
+        list: Names of the indexes on the collection afterwards
+    """
+    collection = db_conn[DB_NAME][COLLECTION_NAME]
+    # Directions compare equal across int and float; text, hashed and 2dsphere keys are strings
+    existing = {tuple(index["key"].items()) for index in collection.list_indexes()}
+    for name, keys in VCON_INDEXES:
+        if tuple(keys) in existing:
+            continue
+        logger.info(f"Creating index {name} on {DB_NAME}.{COLLECTION_NAME}")
+        collection.create_index(keys, name=name)
+    return [index["name"] for index in collection.list_indexes()]
+
+def _plan_stages(plan):
+    # Walk classic (inputStage/inputStages) and SBE (queryPlan) plan trees
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for key in ("inputStage", "queryPlan", "outerStage", "innerStage"):
+            if key in plan:
+                yield from _plan_stages(plan[key])
+        for child in plan.get("inputStages", []):
+            yield from _plan_stages(child)
+
+def _winning_plans(explain):
+    # Aggregations nest the query planner output under their $cursor stage
+    if isinstance(explain, dict):
+        if "winningPlan" in explain:
+            yield explain["winningPlan"]
+        for value in explain.values():
+            yield from _winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from _winning_plans(value)
+
+def check_query_plans(db_conn):
+    """
+    Explain each tool's real query and report plans that will not scale.
+
+    Args:
+        db_conn: Database connection
+
+    Returns:
+        list: (tool, stages) for every query whose winning plan contains a
+        COLLSCAN or an in-memory SORT
+    """
+    db = db_conn[DB_NAME]
+    problems = []
+    for tool, command in query_shapes():
+        explain = db.command("explain", command, verbosity="queryPlanner")
+        stages = [stage for plan in _winning_plans(explain) for stage in _plan_stages(plan)]
+        bad = sorted(BAD_STAGES.intersection(stages))
+        if bad:
+            logger.warning(f"Query plan for {tool} uses {', '.join(bad)}: {' <- '.join(stages)}")
+            problems.append((tool, stages))
+        else:
+            logger.info(f"Query plan for {tool}: {' <- '.join(stages)}")
+    return problems
+
+def bootstrap(db_conn, create=True, strict=False):
+    """
+    Create missing indexes and verify the tools' query plans.
+
+    Args:
+        db_conn: Database connection
+        create (bool): Create missing indexes before checking
+        strict (bool): Raise QueryPlanError instead of only warning
+
+    Returns:
+        list: Query plan problems found
+    """
+    if create:
+        ensure_indexes(db_conn)
+    problems = check_query_plans(db_conn)
+    if problems and strict:
+        raise QueryPlanError(
+            "Unindexed tool queries: " + ", ".join(tool for tool, _ in problems)
+        )
+    return problems
+
+_startup_lock = threading.Lock()
+_startup_started = False
+
+def bootstrap_in_background(db_conn):
+    """
+    Run bootstrap() once per process on a background thread.
+
+    Failures are logged and never block the app from starting.
+    """
+    global _startup_started
+    with _startup_lock:
+        if _startup_started:
+            return
+        _startup_started = True
+
+    def _run():
+        try:
+            bootstrap(db_conn, create=config.get("create_indexes_on_startup", True))
+        except Exception as e:
+            logger.error(f"Index bootstrap failed: {str(e)}")
+
+    threading.Thread(target=_run, name="index-bootstrap", daemon=True).start()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create and verify MongoDB indexes for the vCon tools")
+    parser.add_argument("--check-only", action="store_true", help="Only explain the tool queries, do not create indexes")
+    parser.add_argument("--strict", action="store_true", help="Exit non-zero if any tool query scans the collection or sorts in memory")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_conn = MongoClient(config["mongo_uri"])
+    try:
+        bootstrap(db_conn, create=not args.check_only, strict=args.strict)
+    except QueryPlanError as e:
+        logger.error(str(e))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from config import config
+import numpy as np
+import threading
+import logging
+import json
+import os
+
+logger = logging.getLogger("llm_api")
+
+LOCAL_VECTOR_INDEX_PATH = config.get("local_vector_index_path", ".cache/local_vector_index")
+LOCAL_VECTOR_BLOCK_SIZE = int(config.get("local_vector_block_size", 65536))
+LOCAL_VECTOR_THREADS = int(config.get("local_vector_threads", 4))
+
+# Fixed widths of the metadata arrays, matching the Milvus VARCHAR fields
+UUID_DTYPE = "U64"
+PARTY_ID_DTYPE = "U256"
+
+# Per-row arrays, each a raw file that inserts append to like vectors.f32: attribute -> (file, dtype)
+ROW_FILES = {
+    "norms": ("norms.f32", np.float32),
+    "uuids": ("vcon_uuid.u64", UUID_DTYPE),
+    "party_ids": ("party_id.u256", PARTY_ID_DTYPE),
+    "created_at": ("created_at.i64", np.int64),
+    "deleted": ("deleted.bool", bool),
+}
+# Layout of the files; version 1 rewrote .npy copies of every array on each insert
+INDEX_FORMAT = 2
+LEGACY_NPY_FILES = {
+    "norms": "norms.npy", "uuids": "vcon_uuid.npy", "party_ids": "party_id.npy",
+    "created_at": "created_at.npy", "deleted": "deleted.npy",
+}
+
+class LocalVectorIndex:
+    """
+    Exact vector search over a memory-mapped float32 matrix on disk.
+
+    The directory holds the vectors (vectors.f32, one row per chunk), their
+    squared norms, fixed-width vcon_uuid and party_id arrays, created_at as
+    Unix seconds, deleted flags, and the chunk texts as UTF-8 in text.bin
+    with an offsets array. Every file is raw and append-only, so an insert
+    costs the size of the batch rather than of the index. meta.json records
+    the row count and is written last, so a partly written append is ignored.
+
+    search() takes the main arguments of Collection.search() and returns the
+    same hit shape, so it can stand in for the Milvus collection.
+    """
+
+    def __init__(self, path=LOCAL_VECTOR_INDEX_PATH, block_size=LOCAL_VECTOR_BLOCK_SIZE, threads=LOCAL_VECTOR_THREADS):
+        self.path = path
+        self.block_size = block_size
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="local-vector-search")
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        meta_path = self._file("meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            meta = {"count": 0, "dimension": None, "format": INDEX_FORMAT}
+        self.dimension = meta["dimension"]
+        count = meta["count"]
+        if count and meta.get("format", 1) < INDEX_FORMAT:
+            self._migrate_npy(count)
+        if count:
+            # Mapping only count rows ignores those of an append that never committed
+            self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r", shape=(count, self.dimension))
+            for attribute, (name, dtype) in ROW_FILES.items():
+                setattr(self, f"_{attribute}", np.memmap(self._file(name), dtype=dtype, mode="r", shape=(count,)))
+            self._text_offsets = np.memmap(self._file("text_offsets.i64"), dtype=np.int64, mode="r", shape=(count + 1,))
+            self._text = np.memmap(self._file("text.bin"), dtype=np.uint8, mode="r", shape=(int(self._text_offsets[-1]),)) \
+                if self._text_offsets[-1] else np.zeros(0, dtype=np.uint8)
+        else:
+            self._vectors = np.zeros((0, self.dimension or 0), dtype=np.float32)
+            self._norms = np.zeros(0, dtype=np.float32)
+            self._uuids = np.zeros(0, dtype=UUID_DTYPE)
+            self._party_ids = np.zeros(0, dtype=PARTY_ID_DTYPE)
+            self._created_at = np.zeros(0, dtype=np.int64)
+            self._text_offsets = np.zeros(1, dtype=np.int64)
+            self._deleted = np.zeros(0, dtype=bool)
+            self._text = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return int(len(self._vectors) - self._deleted.sum())
+
+    def _migrate_npy(self, count):
+        # Convert an index written in format 1 once, then drop its .npy files
+        for attribute, (name, dtype) in ROW_FILES.items():
+            np.asarray(np.load(self._file(LEGACY_NPY_FILES[attribute]))[:count], dtype=dtype).tofile(self._file(name))
+        np.asarray(np.load(self._file("text_offsets.npy"))[:count + 1], dtype=np.int64).tofile(self._file("text_offsets.i64"))
+        self._write_meta(count)
+        for name in [*LEGACY_NPY_FILES.values(), "text_offsets.npy"]:
+            os.remove(self._file(name))
+        logger.info(f"Converted local vector index at {self.path} to format {INDEX_FORMAT}")
+
+    def _append_file(self, name, data, committed_size):
+        # Drop bytes past the last commit before appending
+        with open(self._file(name), "ab") as f:
+            f.truncate(committed_size)
+            f.write(data)
+
+    def insert(self, columns):
+        """
+        Append rows, given as columns like Collection.insert().
+
+        Args:
+            columns (list): [vcon_uuids, party_ids, texts, created_ats, embeddings]
+        """
+        vcon_uuids, party_ids, texts, created_ats, embeddings = columns
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if not len(vectors):
+            return
+        if any(len(column) != len(vectors) for column in (vcon_uuids, party_ids, texts, created_ats)):
+            raise ValueError("Every column needs one value per vector")
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = int(vectors.shape[1])
+            if vectors.shape[1] != self.dimension:
+                raise ValueError(f"Expected {self.dimension}-dimensional vectors, got {vectors.shape[1]}")
+            count = len(self._vectors)
+            encoded = [str(text).encode("utf-8") for text in texts]
+            lengths = np.fromiter((len(text) for text in encoded), dtype=np.int64, count=len(encoded))
+            rows = {
+                "norms": np.einsum("ij,ij->i", vectors, vectors),
+                "uuids": vcon_uuids,
+                "party_ids": party_ids,
+                "created_at": created_ats,
+                "deleted": np.zeros(len(vectors), dtype=bool),
+            }
+            offsets = self._text_offsets[-1] + np.cumsum(lengths)
+            if not count:
+                # The offsets file starts with the 0 that the first text begins at
+                offsets = np.concatenate([[0], offsets])
+
+            self._append_file("vectors.f32", vectors.tobytes(), count * self.dimension * 4)
+            self._append_file("text.bin", b"".join(encoded), int(self._text_offsets[-1]))
+            for attribute, (name, dtype) in ROW_FILES.items():
+                self._append_file(name, np.asarray(rows[attribute], dtype=dtype).tobytes(), count * np.dtype(dtype).itemsize)
+            self._append_file("text_offsets.i64", np.asarray(offsets, dtype=np.int64).tobytes(), (count + 1) * 8 if count else 0)
+            self._commit(count + len(vectors))
+
+    def delete_vcons(self, vcon_uuids):
+        """
+        Mark every row of the given vCons as deleted.
+
+        Returns:
+            int: Number of rows deleted
+        """
+        with self._lock:
+            mask = np.isin(self._uuids, np.asarray(list(vcon_uuids), dtype=UUID_DTYPE)) & ~self._deleted
+            deleted = int(mask.sum())
+            if deleted:
+                # Flags are set in place; searches already running may or may not see them
+                flags = np.memmap(self._file(ROW_FILES["deleted"][0]), dtype=bool, mode="r+", shape=mask.shape)
+                flags[mask] = True
+                flags.flush()
+                del flags
+            return deleted
+
+    def _write_meta(self, count):
+        temp_path = self._file("meta.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"count": count, "dimension": self.dimension, "format": INDEX_FORMAT}, f)
+        os.replace(temp_path, self._file("meta.json"))
+
+    def _commit(self, count):
+        self._write_meta(count)
+        self._load()
+
+    def flush(self):
+        """
+        Inserts are durable once they return; kept for Collection compatibility.
+        """
+
+    def _text_at(self, text, offsets, row):
+        return bytes(text[offsets[row]:offsets[row + 1]]).decode("utf-8")
+
+    def _excluded(self, snapshot, start, stop, filters):
+        # Rows a search must skip: deleted ones and those outside the filters
+        excluded = np.array(snapshot["deleted"][start:stop])
+        if filters.get("start") is not None:
+            excluded |= snapshot["created_at"][start:stop] < filters["start"]
+        if filters.get("end") is not None:
+            excluded |= snapshot["created_at"][start:stop] > filters["end"]
+        if filters.get("party_ids"):
+            excluded |= ~np.isin(snapshot["party_ids"][start:stop], np.asarray(filters["party_ids"], dtype=PARTY_ID_DTYPE))
+        return excluded
+
+    def _search_block(self, queries, query_norms, snapshot, start, stop, k, metric, filters):
+        vectors, norms = snapshot["vectors"], snapshot["norms"]
+        products = queries @ np.asarray(vectors[start:stop]).T
+        if metric == "L2":
+            # Squared distance, expanded so the block needs one matrix product
+            keys = norms[start:stop][None, :] - 2 * products + query_norms[:, None]
+        else:
+            keys = -products
+        keys[:, self._excluded(snapshot, start, stop, filters)] = np.inf
+        k = min(k, stop - start)
+        rows = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        return rows + start, np.take_along_axis(keys, rows, axis=1)
+
+    def search(self, data, anns_field=None, param=None, limit=10, output_fields=None, expr=None, filters=None):
+        """
+        Top-k search for each query vector.
+
+        Milvus expr strings are not parsed; pass the same conditions as filters.
+
+        Args:
+            data (list): Query vectors
+            param (dict): Search parameters; metric_type "L2" (default) or "IP"
+            limit (int): Hits per query
+            expr (str): Milvus filter expression; only accepted alongside
+                filters, which must hold the same conditions
+            filters (dict): Optional start and end (Unix seconds, inclusive)
+                on created_at, and party_ids to match
+
+        Returns:
+            list: One list of hits per query, best first. Each hit has id,
+            score (squared L2 distance, or inner product) and an entity dict
+            with vcon_uuid, party_id, text and, if anns_field is among the
+            output_fields, the vector.
+
+        Raises:
+            ValueError: If expr is given without filters, or the query
+                vectors have the wrong dimension
+        """
+        if expr and filters is None:
+            # Searching without the conditions would silently return unfiltered hits
+            raise ValueError("The local vector index cannot evaluate expr; pass the conditions as filters")
+        metric = ((param or {}).get("metric_type") or "L2").upper()
+        queries = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        with self._lock:
+            snapshot = {
+                "vectors": self._vectors, "norms": self._norms, "deleted": self._deleted,
+                "uuids": self._uuids, "party_ids": self._party_ids, "created_at": self._created_at,
+                "text": self._text, "text_offsets": self._text_offsets
+            }
+        count = len(snapshot["vectors"])
+        if not count or limit <= 0:
+            return [[] for _ in queries]
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-dimensional query vectors, got {queries.shape[1]}")
+
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        blocks = [(start, min(start + self.block_size, count)) for start in range(0, count, self.block_size)]
+        parts = list(self._executor.map(
+            lambda block: self._search_block(queries, query_norms, snapshot, block[0], block[1], limit, metric, filters or {}),
+            blocks
+        ))
+        rows = np.concatenate([part[0] for part in parts], axis=1)
+        keys = np.concatenate([part[1] for part in parts], axis=1)
+
+        # Merge the per-block candidates into the overall top-k
+        k = min(limit, rows.shape[1])
+        best = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        best_keys = np.take_along_axis(keys, best, axis=1)
+        order = np.argsort(best_keys, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        best_keys = np.take_along_axis(best_keys, order, axis=1)
+        best_rows = np.take_along_axis(rows, best, axis=1)
+
+        # Like Milvus, return the vector only when the vector field is requested
+        with_vectors = anns_field is not None and anns_field in (output_fields or [])
+        results = []
+        for query_rows, query_keys in zip(best_rows, best_keys, strict=True):
+            hits = []
+            for row, key in zip(query_rows, query_keys, strict=True):
+                if not np.isfinite(key):
+                    break
+                entity = {
+                    "vcon_uuid": str(snapshot["uuids"][row]),
+                    "party_id": str(snapshot["party_ids"][row]),
+                    "text": self._text_at(snapshot["text"], snapshot["text_offsets"], row)
+                }
+                if with_vectors:
+                    entity[anns_field] = np.asarray(snapshot["vectors"][row]).tolist()
+                hits.append(SimpleNamespace(
+                    id=int(row),
+                    score=float(max(key, 0.0)) if metric == "L2" else float(-key),
+                    entity=entity
+                ))
+            results.append(hits)
+        return results
+
+_local_index = None
+_local_index_lock = threading.Lock()
+
+def get_local_index(path=LOCAL_VECTOR_INDEX_PATH):
+    """
+    The process-wide local vector index, opened on first use.
+    """
+    global _local_index
+    with _local_index_lock:
+        if _local_index is None:
+            _local_index = LocalVectorIndex(path)
+            logger.info(f"Opened local vector index at {path} ({len(_local_index)} rows)")
+        return _local_index
+
+def set_local_index(index):
+    """
+    Use this index for the rest of the process instead of the one at local_vector_index_path.
+    """
+    global _local_index
+    with _local_index_lock:
+        _local_index = index
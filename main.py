@@ -1,22 +1,17 @@
-from party_tool import PARTY_TOOL, find_by_party
-from date_range_tool import DATE_RANGE_TOOL, find_by_date_range
-from get_conversation_by_id_tool import GET_CONVERSATION_BY_ID, get_conversation_by_id
-from milvus_search_tool import MILVUS_SEARCH_TOOL, search_in_milvus
+from agent_engine import Session, DEFAULT_SYSTEM_PROMPT
+from embedding_cache import embedding_cache
+from tool_result_cache import tool_result_cache
+from data_layer import pool_metrics
+from single_flight import tool_flight, embedding_flight, search_flight
+import rate_limiter
+from resources import get_mongo_client, get_llm_client, get_model_list, get_agent_engine, start_background_services
 import streamlit as st
 import requests
-import json
-# Add in postgres connection
-from pymongo import MongoClient
-import os
 from config import config
 import openai
-from openai import OpenAI
 import logging
 import datetime
 import traceback
-import hashlib
-import time
-from milvus_search_tool import MILVUS_SEARCH_TOOL  # Import the new tool
 
 # Configure logging
 logging.basicConfig(
@@ -29,38 +24,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger("llm_api")
 
-# Function to check if a model supports function calling
-def model_supports_function_calling(model_name):
-    # List of models known to support function calling
-    # Update this list as OpenAI releases new models or changes capabilities
-    function_calling_models = [
-        model for model in [
-            "gpt-4", "gpt-4-turbo", "gpt-4-vision-preview", "gpt-4-1106-preview", 
-            "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-4o", 
-            "gpt-3.5-turbo", "gpt-3.5-turbo-1106", "gpt-3.5-turbo-0613",
-            "o1-preview", "o1-mini", "o3-mini"
-        ] if model in model_name
-    ]
-    return len(function_calling_models) > 0
-
 # Initialize session state for message history and settings
-if "messages" not in st.session_state:
-    st.session_state.messages = []
 if "api_provider" not in st.session_state:
     st.session_state.api_provider = "openai"
 if "system_prompt" not in st.session_state:
-    st.session_state.system_prompt = """You are a helpful AI assistant. You can help users search through conversation records using date ranges, party names, or conversation IDs."""
-if "seen_tool_calls" not in st.session_state:
-    st.session_state.seen_tool_calls = set()
-if "conversation_completed" not in st.session_state:
-    st.session_state.conversation_completed = False
+    st.session_state.system_prompt = DEFAULT_SYSTEM_PROMPT
+# Conversation state; the agent engine runs turns against it
+if "agent_session" not in st.session_state:
+    st.session_state.agent_session = Session()
+session = st.session_state.agent_session
 
 # Update database configuration
 MONGO_URI = config["mongo_uri"]
 OPENAI_API_KEY = config["openai_api_key"]
 
-# Connect to database
-conn = MongoClient(MONGO_URI)
+# Connect to database (one client per process, shared across reruns)
+conn = get_mongo_client(MONGO_URI)
+
+# Index bootstrap, tool cache invalidation and Milvus preload (once per process)
+start_background_services(conn)
 
 # Move configuration elements to sidebar
 with st.sidebar:
@@ -75,36 +57,51 @@ with st.sidebar:
     )
     
     if st.button("Reset System Prompt"):
-        st.session_state.system_prompt = """You are a helpful AI assistant. You can help users search through conversation records using date ranges, party names, or conversation IDs."""
+        st.session_state.system_prompt = DEFAULT_SYSTEM_PROMPT
         st.rerun()
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    if not OPENAI_API_KEY:
+    # LLM provider: OpenAI, or a local Ollama server behind the same client interface
+    st.radio("Provider:", ["openai", "ollama"], key="api_provider", horizontal=True)
+    
+    if st.session_state.api_provider == "openai" and not OPENAI_API_KEY:
         st.error("OpenAI API key not found. Please set OPENAI_API_KEY in your .env file.")
         st.stop()
+    client = get_llm_client(st.session_state.api_provider)
     
-    # Fetch available models from OpenAI
-    try:
-        models = client.models.list()
-        available_models = [
-            model.id for model in models 
-            if model.id.startswith(('gpt-3.5', 'gpt-4', 'o1', 'o3')) and 'instruct' not in model.id
-        ]
-        available_models.sort()
-    except openai.OpenAIError as e:
-        st.warning("Could not fetch models from OpenAI, using default options")
-        available_models = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview"]
+    # Model names are cached per process and refreshed in the background
+    models, _ = get_model_list(st.session_state.api_provider).get()
+    if st.session_state.api_provider == "ollama":
+        available_models = list(models or [])
+        if models is None:
+            st.warning(f"Could not fetch models from Ollama at {config['ollama_host']}")
         
-    default_model = config["default_openai_model"]
+        default_model = config["default_model"]
+        if default_model not in available_models:
+            available_models.insert(0, default_model)
+    else:
+        if models is None:
+            st.warning("Could not fetch models from OpenAI, using default options")
+            available_models = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview"]
+        else:
+            available_models = list(models)
+            
+        default_model = config["default_openai_model"]
     default_index = available_models.index(default_model) if default_model in available_models else 0
 
     model = st.selectbox("Select a model:", available_models, index=default_index)
     
+    if st.session_state.api_provider == "ollama":
+        # Load the selected model now so the first turn does not wait for it
+        client.warm([model])
+    
+    # Render assistant tokens as they arrive
+    stream_responses = st.checkbox("Stream responses", value=True)
+    
     # Debug options
     show_debug = st.checkbox("Show debug messages", value=False)
     
     if st.button("Clear Chat"):
-        st.session_state.messages = []
+        session.clear()
         st.rerun()
     
     # Initialize debug log container in session state if not exists
@@ -121,12 +118,29 @@ with st.sidebar:
             with st.expander("View Logs", expanded=True):
                 for log in st.session_state.debug_logs:
                     st.text(log)
+            with st.expander("Embedding Cache", expanded=False):
+                st.json(embedding_cache.get_stats())
+            with st.expander("Tool Result Cache", expanded=False):
+                st.json(tool_result_cache.get_stats())
+            with st.expander("Request Coalescing", expanded=False):
+                st.json({flight.name: flight.get_stats() for flight in (tool_flight, embedding_flight, search_flight)})
+            with st.expander("Rate Limits", expanded=False):
+                st.json(rate_limiter.all_stats())
+            with st.expander("Connection Pools", expanded=False):
+                st.json(pool_metrics.snapshot())
+            with st.expander("Context Window", expanded=False):
+                st.json({
+                    "history_tokens": session.context_window.history_tokens(),
+                    "summary_tokens": session.context_window.summary_tokens,
+                    "folded_turns": session.context_window.folded_turns,
+                    "token_budget": session.context_window.token_budget
+                })
+            with st.expander("Last Turn Trace", expanded=False):
+                # Filled at the end of the run so it shows the turn that just ran
+                trace_placeholder = st.empty()
 
 # Helper function to log messages both to logger and UI if debug is enabled
 def log_message(level, message):
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-    formatted_message = f"[{timestamp}] {level}: {message}"
-    
     # Log to logger
     if level == "INFO":
         logger.info(message)
@@ -137,18 +151,40 @@ def log_message(level, message):
     elif level == "ERROR":
         logger.error(message)
     
-    # Add to UI if debug is enabled
+    add_debug_log(level, message)
+
+# Add a message to the debug log area if debug is enabled
+def add_debug_log(level, message):
     if show_debug:
-        st.session_state.debug_logs.append(formatted_message)
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        st.session_state.debug_logs.append(f"[{timestamp}] {level}: {message}")
         # Keep only the last 100 messages to avoid memory issues
         if len(st.session_state.debug_logs) > 100:
             st.session_state.debug_logs = st.session_state.debug_logs[-100:]
 
+# Draw the spans of a traced turn as a waterfall
+def render_trace(container, trace):
+    rows = trace.waterfall()
+    with container.container():
+        st.vega_lite_chart({
+            "data": {"values": rows},
+            "mark": "bar",
+            "height": max(120, 18 * len(rows)),
+            "encoding": {
+                "y": {"field": "span", "type": "nominal", "sort": None, "title": None},
+                "x": {"field": "start_ms", "type": "quantitative", "title": "ms"},
+                "x2": {"field": "end_ms"},
+                "color": {"field": "kind", "type": "nominal"},
+                "tooltip": [{"field": key} for key in sorted({key for row in rows for key in row})]
+            }
+        }, use_container_width=True)
+        st.json(trace.totals())
+
 # Main chat area
 st.title("Chat Interface")
 
 # Display chat messages
-for message in st.session_state.messages:
+for message in session.messages:
     role = message["role"]
     # Skip function and tool messages in display
     if role in ["function", "tool"]:
@@ -158,221 +194,59 @@ for message in st.session_state.messages:
 
 # Chat input
 if prompt := st.chat_input("What would you like to ask?"):
-    # Reset conversation state for new query
-    st.session_state.conversation_completed = False
-    st.session_state.seen_tool_calls = set()
-    
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    
     # Display user message
     with st.chat_message("user"):
         st.write(prompt)
 
-    try:
-        # Convert session messages to API format with explicit handling
-        api_messages = []
-        # Add system message first if it exists
-        if st.session_state.system_prompt.strip():
-            api_messages.append({
-                "role": "system",
-                "content": st.session_state.system_prompt
-            })
-            
-        # Add all user and assistant messages directly
-        for msg in st.session_state.messages:
-            # Skip function/tool messages as they'll be handled differently
-            if msg["role"] not in ["function", "tool"]:
-                api_messages.append(msg)
+    # Placeholder for the assistant message being streamed in the current iteration
+    stream_state = {"placeholder": None}
 
-        # Check if the selected model supports function calling
-        supports_function_calling = model_supports_function_calling(model)
-        
-        # Max number of iterations to prevent infinite loops
-        max_iterations = 5
-        current_iteration = 0
-        
-        # Process conversation with function calls in a loop
-        while current_iteration < max_iterations:
-            current_iteration += 1
-            log_message("INFO", f"Starting conversation iteration {current_iteration}/{max_iterations}")
-            
-            # Call OpenAI API with current messages and tools
-            log_message("INFO", f"OpenAI call with model {model}")
-            if show_debug:
-                log_message("DEBUG", f"Messages for API call: {json.dumps(api_messages, indent=2)}")
-            
-            # Only include tools if the model supports function calling
-            if supports_function_calling:
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=api_messages,
-                    tools=[PARTY_TOOL, DATE_RANGE_TOOL, GET_CONVERSATION_BY_ID, MILVUS_SEARCH_TOOL]
-                )
-            else:
-                log_message("WARNING", f"Model {model} may not support function calling. Using without tools.")
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=api_messages
-                )
-            
-            log_message("INFO", f"OpenAI response received (finish_reason: {response.choices[0].finish_reason})")
-            
-            # Get assistant response and tool calls
-            assistant_message = response.choices[0].message
-            assistant_response = assistant_message.content
-            tool_calls = assistant_message.tool_calls or [] if supports_function_calling else []
-            
-            # Add the assistant message to the conversation history with tool_calls if present
-            assistant_api_message = {
-                "role": "assistant",
-                "content": assistant_response or ""
-            }
-            
-            # Include tool_calls if present to ensure proper message structure
-            if tool_calls:
-                assistant_api_message["tool_calls"] = [
-                    {
-                        "id": tool_call.id,
-                        "type": "function",
-                        "function": {
-                            "name": tool_call.function.name,
-                            "arguments": tool_call.function.arguments
-                        }
-                    } for tool_call in tool_calls
-                ]
-            
-            # Add the assistant message to the API messages array
-            api_messages.append(assistant_api_message)
-            
-            # Add a simplified version to session state for display
-            if assistant_response:
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": assistant_response
-                })
-                
-                # Display the assistant's response
+    def render_event(event):
+        if event["type"] == "iteration":
+            stream_state["placeholder"] = None
+        elif event["type"] == "content":
+            if stream_state["placeholder"] is None:
                 with st.chat_message("assistant"):
-                    st.write(assistant_response)
-            
-            # If no tool calls, we're done with this conversation
-            if not tool_calls:
-                log_message("INFO", "No tool calls requested, conversation complete")
-                break
-                
-            log_message("INFO", f"OpenAI requested {len(tool_calls)} tool calls")
-            
-            # Process each tool call
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                arguments = json.loads(tool_call.function.arguments)
-                tool_call_id = tool_call.id
-                
-                # Generate a hash of this tool call to detect duplicates
-                call_hash = hashlib.md5(f"{function_name}:{json.dumps(arguments, sort_keys=True)}".encode()).hexdigest()
-                
-                # Skip this tool call if we've seen it before
-                if call_hash in st.session_state.seen_tool_calls:
-                    log_message("WARNING", f"Skipping duplicate tool call: {function_name} with args {arguments}")
-                    continue
-                
-                # Add this call to the seen set
-                st.session_state.seen_tool_calls.add(call_hash)
-                
-                log_message("INFO", f"Executing tool: {function_name}")
-                log_message("DEBUG", f"Tool arguments: {json.dumps(arguments, indent=2)}")
-                
-                # Execute the appropriate tool
-                try:
-                    if function_name == "find_by_party":
-                        party = arguments["party"]
-                        log_message("INFO", f"find_by_party tool call with party: {party}")
-                        results = find_by_party(party, conn)
-                    elif function_name == "find_by_date_range":
-                        start_date = arguments["start_date"]
-                        end_date = arguments["end_date"]
-                        log_message("INFO", f"find_by_date_range tool call with range: {start_date} to {end_date}")
-                        results = find_by_date_range(start_date, end_date, conn)
-                    elif function_name == "get_conversation_by_id":
-                        uuids = arguments["uuids"]
-                        # Limit number of UUIDs to process
-                        if isinstance(uuids, list) and len(uuids) > 20:
-                            log_message("WARNING", f"Too many UUIDs requested: {len(uuids)}. Limiting to 20.")
-                            uuids = uuids[:20]
-                        results = get_conversation_by_id(uuids, conn)
-                    elif function_name == "search_in_milvus":
-                        search_text = arguments["search_text"]
-                        log_message("INFO", f"search_in_milvus tool call with search_text: {search_text}")
-                        results = search_in_milvus(search_text)
-                    else:
-                        error_msg = f"Unknown function: {function_name}"
-                        log_message("ERROR", error_msg)
-                        results = f"Error: {error_msg}"
-                    
-                    # Log results summary
-                    if isinstance(results, list):
-                        log_message("INFO", f"Tool {function_name} returned {len(results)} results")
-                        if show_debug and len(results) > 0:
-                            sample_size = min(3, len(results))
-                            sample = results[:sample_size]
-                            log_message("DEBUG", f"Sample of results: {sample}")
-                    else:
-                        log_message("INFO", f"Tool {function_name} execution completed")
-                        if show_debug and results:
-                            result_preview = str(results)[:200] + "..." if len(str(results)) > 200 else str(results)
-                            log_message("DEBUG", f"Result preview: {result_preview}")
-                    
-                except Exception as e:
-                    error_trace = traceback.format_exc()
-                    log_message("ERROR", f"Error executing tool {function_name}: {str(e)}")
-                    log_message("ERROR", f"Traceback: {error_trace}")
-                    results = f"Error executing tool {function_name}: {str(e)}"
-                
-                # Add tool results to conversation with the correct format for OpenAI
-                tool_message = {
-                    "role": "tool",
-                    "tool_call_id": tool_call_id,
-                    "content": str(results)
-                }
-                
-                # Add to session state
-                st.session_state.messages.append({
-                    "role": "tool",  # Use 'tool' for session state too for consistency
-                    "name": function_name,
-                    "content": str(results)
-                })
-                
-                # Add to API messages for next round
-                api_messages.append(tool_message)
-                
-                if show_debug:
-                    log_message("DEBUG", f"Tool {function_name} results: {str(results)[:500]}...")
-            
-            # If we've reached max iterations, inform the user
-            if current_iteration >= max_iterations and tool_calls:
-                warning_msg = "The assistant reached the maximum number of tool calls allowed. The response may be incomplete."
-                st.warning(warning_msg)
-                log_message("WARNING", warning_msg)
-                break
-        
-        # Mark conversation as completed
-        st.session_state.conversation_completed = True
-        
-        # Add a small delay to ensure UI updates before rerun
-        time.sleep(0.5)
-        
-        # Force Streamlit to rerun the app to refresh the display
-        st.rerun()
+                    stream_state["placeholder"] = st.empty()
+            stream_state["placeholder"].markdown(event["content"])
+        elif event["type"] == "assistant" and not event["streamed"]:
+            with st.chat_message("assistant"):
+                st.write(event["content"])
+        elif event["type"] == "warning":
+            st.warning(event["message"])
+        elif event["type"] == "log":
+            # Already written to the logger by the engine
+            add_debug_log(event["level"], event["message"])
+
+    try:
+        get_agent_engine(conn).run_turn(
+            session,
+            prompt,
+            client,
+            model,
+            provider=st.session_state.api_provider,
+            system_prompt=st.session_state.system_prompt,
+            stream=stream_responses,
+            on_event=render_event,
+            debug=show_debug
+        )
+        st.session_state.last_trace = session.last_trace
                 
     except (requests.exceptions.RequestException, openai.OpenAIError) as e:
         error_trace = traceback.format_exc()
         log_message("ERROR", f"API Error: {str(e)}")
         log_message("ERROR", f"Traceback: {error_trace}")
         st.error(f"API Error: {str(e)}")
-        st.info("Check your OpenAI API key and connection.")
+        if st.session_state.api_provider == "ollama":
+            st.info(f"Check that Ollama is running at {config['ollama_host']}.")
+        else:
+            st.info("Check your OpenAI API key and connection.")
     except Exception as e:
         error_trace = traceback.format_exc()
         log_message("ERROR", f"Unexpected error: {str(e)}")
         log_message("ERROR", f"Traceback: {error_trace}")
         st.error(f"Unexpected error: {str(e)}")
+
+# Show the latest turn's waterfall, now that its spans have all finished
+if show_debug and "last_trace" in st.session_state:
+    render_trace(trace_placeholder, st.session_state.last_trace)
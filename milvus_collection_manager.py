@@ -0,0 +1,114 @@
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CollectionManager:
+    """
+    Long-lived, shared handle to a Milvus collection.
+
+    The connection is opened and the collection loaded once, on first use or
+    via preload(), and stays loaded for every session in the process.
+    pymilvus itself is only imported then, so importing this module is cheap.
+    A background thread checks the load state periodically and reloads only
+    if Milvus reports the collection is no longer loaded. Collections are never released here, since other
+    sessions and processes may be searching them.
+    """
+
+    def __init__(self, collection_name, health_check_interval=30, using="default", host=None, port=None):
+        self.collection_name = collection_name
+        self.health_check_interval = health_check_interval
+        self.using = using
+        self.host = host
+        self.port = port
+        self._collection = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def get_collection(self):
+        """
+        Return the shared collection handle, loading it if necessary.
+
+        Returns:
+            Collection: A loaded Milvus collection
+        """
+        collection = self._collection
+        if collection is not None:
+            return collection
+        with self._lock:
+            if self._collection is None:
+                from pymilvus import Collection
+                self._connect()
+                collection = Collection(self.collection_name, using=self.using)
+                self._ensure_loaded(collection)
+                self._collection = collection
+            self._start_health_check()
+            return self._collection
+
+    def preload(self):
+        """
+        Load the collection in the background so the first search does not pay for it.
+        """
+        def _load():
+            try:
+                self.get_collection()
+            except Exception as e:
+                logger.warning(f"Could not preload Milvus collection {self.collection_name}: {str(e)}")
+
+        threading.Thread(target=_load, name="milvus-preload", daemon=True).start()
+
+    def invalidate(self):
+        """
+        Drop the cached handle so the next call rebuilds and reloads it.
+        """
+        with self._lock:
+            self._collection = None
+
+    def _connect(self):
+        # Open the connection for this alias unless it is already open
+        from pymilvus import connections
+        if self.host is None or connections.has_connection(self.using):
+            return
+        connections.connect(alias=self.using, host=self.host, port=self.port)
+        logger.info(f"Connected to Milvus at {self.host}:{self.port}")
+
+    def close(self):
+        """
+        Stop the health check thread and drop the handle.
+        """
+        self._stop.set()
+        self.invalidate()
+
+    def _ensure_loaded(self, collection):
+        from pymilvus import utility
+        from pymilvus.client.types import LoadState
+        state = utility.load_state(self.collection_name, using=self.using)
+        if state == LoadState.Loaded:
+            return
+        if state == LoadState.Loading:
+            logger.info(f"Collection {self.collection_name} is loading, waiting for it")
+            utility.wait_for_loading_complete(self.collection_name, using=self.using)
+            return
+        logger.info(f"Loading collection {self.collection_name} (state: {state})")
+        collection.load()
+        logger.info(f"Collection {self.collection_name} loaded successfully")
+
+    def _start_health_check(self):
+        if self._health_thread is not None or self.health_check_interval <= 0:
+            return
+        self._health_thread = threading.Thread(
+            target=self._health_loop, name="milvus-health", daemon=True
+        )
+        self._health_thread.start()
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_check_interval):
+            collection = self._collection
+            if collection is None:
+                continue
+            try:
+                self._ensure_loaded(collection)
+            except Exception as e:
+                logger.warning(f"Milvus health check failed for {self.collection_name}: {str(e)}")
+                self.invalidate()
@@ -0,0 +1,556 @@
+from concurrent.futures import ThreadPoolExecutor
+from embedding_providers import get_embedding_provider
+from party_directory import normalize_tel, normalize_mailto
+from date_range_tool import parse_date_bound
+from local_vector_index import LocalVectorIndex, get_local_index
+from rate_limiter import scheduling_priority, BATCH
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from collections import deque
+from config import config
+import threading
+import argparse
+import datetime
+import logging
+import json
+import time
+import sys
+
+logger = logging.getLogger("llm_api")
+
+DB_NAME = config["db_name"]
+COLLECTION_NAME = config["collection_name"]
+MILVUS_COLLECTION_NAME = config["milvus_collection_name"]
+MILVUS_ANNS_FIELD = config.get("milvus_anns_field", "embedding")
+
+INGEST_READ_BATCH_SIZE = int(config.get("ingest_read_batch_size", 500))
+INGEST_EMBED_BATCH_SIZE = int(config.get("ingest_embed_batch_size", 256))
+INGEST_EMBED_CONCURRENCY = int(config.get("ingest_embed_concurrency", 4))
+INGEST_CHUNK_CHARS = int(config.get("ingest_chunk_chars", 1000))
+INGEST_CHUNK_OVERLAP = int(config.get("ingest_chunk_overlap", 100))
+INGEST_CHECKPOINT_COLLECTION = config.get("ingest_checkpoint_collection", "milvus_ingest_checkpoints")
+# Deletes can only be mapped to vcon_uuid when the collection records pre-images (MongoDB 6+)
+INGEST_PRE_IMAGES = config.get("ingest_pre_images", False)
+# Most seconds follow() goes without saving an advanced resume token while no indexed change arrives
+INGEST_CHECKPOINT_INTERVAL = float(config.get("ingest_checkpoint_interval", 60))
+# Store rows in one partition per created_at month so date-filtered searches can skip the rest
+MILVUS_MONTH_PARTITIONS = config.get("milvus_month_partitions", False)
+
+# Milvus VARCHAR limits for the scalar fields
+MAX_UUID_LENGTH = 64
+MAX_PARTY_ID_LENGTH = 256
+MAX_TEXT_LENGTH = 4096
+
+# Only the parts of a vCon that are chunked and embedded
+VCON_PROJECTION = {
+    "uuid": 1,
+    "created_at": 1,
+    "parties": 1,
+    "dialog.type": 1,
+    "dialog.body": 1,
+    "dialog.encoding": 1,
+    "dialog.parties": 1,
+    "analysis": 1,
+}
+# Top-level fields the rows are built from; updates to any other field are skipped
+INDEXED_FIELDS = {field.split(".")[0] for field in VCON_PROJECTION}
+
+def build_schema(dimension):
+    """
+    Schema of the rows search_in_milvus reads.
+    """
+    # pymilvus is imported where it is used: it takes most of a second to import
+    from pymilvus import CollectionSchema, DataType, FieldSchema
+    return CollectionSchema(
+        fields=[
+            FieldSchema("id", DataType.INT64, is_primary=True, auto_id=True),
+            FieldSchema("vcon_uuid", DataType.VARCHAR, max_length=MAX_UUID_LENGTH),
+            FieldSchema("party_id", DataType.VARCHAR, max_length=MAX_PARTY_ID_LENGTH),
+            FieldSchema("text", DataType.VARCHAR, max_length=MAX_TEXT_LENGTH),
+            # vCon created_at as Unix seconds, for date filters
+            FieldSchema("created_at", DataType.INT64),
+            FieldSchema(MILVUS_ANNS_FIELD, DataType.FLOAT_VECTOR, dim=dimension),
+        ],
+        description="vCon transcript and summary chunks"
+    )
+
+def ensure_collection(dimension):
+    """
+    Create the Milvus collection and its indexes if they do not exist yet.
+
+    Returns:
+        Collection: The ingestion target
+
+    Raises:
+        ValueError: If an existing collection lacks fields the rows need
+    """
+    from pymilvus import Collection, utility
+    if utility.has_collection(MILVUS_COLLECTION_NAME):
+        collection = Collection(MILVUS_COLLECTION_NAME)
+        fields = {field.name for field in collection.schema.fields}
+        missing = [
+            field.name for field in build_schema(dimension).fields
+            if not field.is_primary and field.name not in fields
+        ]
+        if missing:
+            # Collections created before date filters have no created_at
+            raise ValueError(
+                f"Milvus collection {MILVUS_COLLECTION_NAME} has no {', '.join(missing)} field; drop it or set "
+                f"milvus_collection_name to a new collection, then run milvus_ingest backfill to rebuild it"
+            )
+        return collection
+    logger.info(f"Creating Milvus collection {MILVUS_COLLECTION_NAME} ({dimension} dimensions)")
+    collection = Collection(MILVUS_COLLECTION_NAME, build_schema(dimension))
+    collection.create_index(MILVUS_ANNS_FIELD, {
+        "index_type": "IVF_FLAT",
+        "metric_type": "L2",
+        "params": {"nlist": 1024}
+    })
+    # Lets re-ingestion delete a vCon's old rows by uuid quickly
+    collection.create_index("vcon_uuid", {"index_type": "INVERTED"})
+    # Scalar indexes for the search filters
+    collection.create_index("party_id", {"index_type": "INVERTED"})
+    collection.create_index("created_at", {"index_type": "STL_SORT"})
+    return collection
+
+def month_partition(timestamp):
+    """
+    Name of the partition holding rows created at the given Unix time.
+    """
+    month = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return f"m{month.year:04d}{month.month:02d}"
+
+def month_partitions_between(start, end):
+    """
+    Names of the month partitions that cover the Unix time range [start, end].
+    """
+    start = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    end = datetime.datetime.fromtimestamp(end, datetime.timezone.utc)
+    year, month = start.year, start.month
+    names = []
+    while (year, month) <= (end.year, end.month):
+        names.append(f"m{year:04d}{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return names
+
+def created_at_seconds(vcon):
+    """
+    A vCon's created_at as Unix seconds, or 0 if it is missing or unreadable.
+    """
+    try:
+        return int(parse_date_bound(vcon["created_at"], end_of_day=False).timestamp())
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return 0
+
+def chunk_text(text, size=INGEST_CHUNK_CHARS, overlap=INGEST_CHUNK_OVERLAP):
+    """
+    Split text into chunks of about size characters on word boundaries.
+
+    Consecutive chunks share roughly overlap characters so that sentences
+    cut at a boundary are still found.
+    """
+    words = text.split()
+    chunks = []
+    current = []
+    length = 0
+    for word in words:
+        if current and length + len(word) + 1 > size:
+            chunks.append(" ".join(current))
+            # Carry the tail of the chunk over as the start of the next one
+            carried = []
+            carried_length = 0
+            for previous in reversed(current):
+                if carried_length + len(previous) + 1 > overlap:
+                    break
+                carried.insert(0, previous)
+                carried_length += len(previous) + 1
+            current = carried
+            length = carried_length
+        current.append(word)
+        length += len(word) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def _party_id(vcon, party_indexes):
+    parties = vcon.get("parties") or []
+    for index in party_indexes:
+        if isinstance(index, int) and 0 <= index < len(parties):
+            party = parties[index]
+            # Identifiers are normalized so search filters match however they were written
+            if party.get("tel") and normalize_tel(party["tel"]):
+                return normalize_tel(party["tel"])
+            if party.get("mailto") and normalize_mailto(party["mailto"]):
+                return normalize_mailto(party["mailto"])[:MAX_PARTY_ID_LENGTH]
+            if party.get("name"):
+                return str(party["name"])[:MAX_PARTY_ID_LENGTH]
+    return "N/A"
+
+def _body_text(body):
+    # Transcripts are stored either as plain text or as structured JSON
+    if isinstance(body, str):
+        return body
+    if isinstance(body, dict):
+        for key in ("transcript", "text", "summary", "paragraphs"):
+            if isinstance(body.get(key), str):
+                return body[key]
+    if isinstance(body, list):
+        return " ".join(_body_text(item) for item in body if item)
+    return json.dumps(body, default=str) if body else ""
+
+def vcon_chunks(vcon):
+    """
+    Chunks of a vCon's transcripts, summaries and text dialogs.
+
+    Returns:
+        list: (party_id, text) pairs
+    """
+    dialogs = vcon.get("dialog") or []
+    chunks = []
+
+    for analysis in vcon.get("analysis") or []:
+        analysis_type = str(analysis.get("type", ""))
+        if not ("transcript" in analysis_type or "summary" in analysis_type):
+            continue
+        if str(analysis.get("encoding", "")).lower() in ("base64", "base64url"):
+            continue
+        dialog_indexes = analysis.get("dialog")
+        dialog_indexes = dialog_indexes if isinstance(dialog_indexes, list) else [dialog_indexes]
+        party_indexes = []
+        for dialog_index in dialog_indexes:
+            if isinstance(dialog_index, int) and 0 <= dialog_index < len(dialogs):
+                party_indexes.extend(dialogs[dialog_index].get("parties") or [])
+        party_id = _party_id(vcon, party_indexes or [0])
+        for chunk in chunk_text(_body_text(analysis.get("body"))):
+            chunks.append((party_id, chunk))
+
+    for dialog in dialogs:
+        if dialog.get("type") != "text" or str(dialog.get("encoding", "")).lower() in ("base64", "base64url"):
+            continue
+        party_indexes = dialog.get("parties")
+        party_indexes = party_indexes if isinstance(party_indexes, list) else [party_indexes]
+        party_id = _party_id(vcon, party_indexes)
+        for chunk in chunk_text(_body_text(dialog.get("body"))):
+            chunks.append((party_id, chunk))
+
+    return chunks
+
+def vcon_rows(vcon):
+    """
+    Rows for a vCon's chunks, without embeddings.
+
+    Returns:
+        list: (vcon_uuid, party_id, text, created_at) tuples
+    """
+    vcon_uuid = str(vcon.get("uuid", ""))[:MAX_UUID_LENGTH]
+    created_at = created_at_seconds(vcon)
+    return [(vcon_uuid, party_id, text, created_at) for party_id, text in vcon_chunks(vcon)]
+
+class IngestMetrics:
+    """
+    Throughput and lag counters for an ingestion run.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.vcons = 0
+        self.chunks = 0
+        self.rows_inserted = 0
+        self.deleted = 0
+        self.errors = 0
+        self.last_event_time = None
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        """
+        Current counters, vCons/sec and change stream lag in seconds.
+        """
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            lag = None
+            if self.last_event_time is not None:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                lag = round((now - self.last_event_time).total_seconds(), 3)
+            return {
+                "vcons": self.vcons,
+                "chunks": self.chunks,
+                "rows_inserted": self.rows_inserted,
+                "deleted": self.deleted,
+                "errors": self.errors,
+                "elapsed_seconds": round(elapsed, 3),
+                "vcons_per_second": round(self.vcons / elapsed, 2),
+                "chunks_per_second": round(self.chunks / elapsed, 2),
+                "lag_seconds": lag
+            }
+
+def indexed_fields_changed(change):
+    """
+    Whether an update event touched any field the Milvus rows are built from.
+    """
+    description = change.get("updateDescription") or {}
+    fields = list(description.get("updatedFields") or {}) + list(description.get("removedFields") or [])
+    return any(field.split(".")[0] in INDEXED_FIELDS for field in fields)
+
+class IngestPipeline:
+    """
+    Streams vCons from MongoDB into the Milvus search collection.
+
+    backfill() reads the collection in _id order with batched cursors,
+    chunks each vCon and embeds the chunks in large batches, with several
+    batches in flight at once, then bulk-inserts the rows. follow() then
+    applies inserts, updates and deletes from a change stream. Both save
+    checkpoints to MongoDB so a restart resumes where the last run stopped;
+    a crash during backfill may insert the batches that were in flight twice.
+    """
+
+    def __init__(self, db_conn, name="default", provider=None, target=None,
+                 embed_batch_size=INGEST_EMBED_BATCH_SIZE, embed_concurrency=INGEST_EMBED_CONCURRENCY):
+        self.name = name
+        self.source = db_conn[DB_NAME][COLLECTION_NAME]
+        self.checkpoints = db_conn[DB_NAME][INGEST_CHECKPOINT_COLLECTION]
+        self.provider = provider or get_embedding_provider()
+        self.embed_batch_size = embed_batch_size
+        self.embed_concurrency = embed_concurrency
+        # The Milvus collection, or a LocalVectorIndex
+        self.collection = target if target is not None else ensure_collection(self.provider.dimension)
+        self.metrics = IngestMetrics()
+        self._partitions = set()
+        self._partition_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=embed_concurrency, thread_name_prefix="ingest-embed")
+
+    def load_checkpoint(self):
+        return self.checkpoints.find_one({"_id": self.name}) or {}
+
+    def save_checkpoint(self, **fields):
+        fields["updated_at"] = datetime.datetime.now(datetime.timezone.utc)
+        self.checkpoints.update_one({"_id": self.name}, {"$set": fields}, upsert=True)
+
+    def _partition(self, name):
+        with self._partition_lock:
+            if name not in self._partitions:
+                if not self.collection.has_partition(name):
+                    self.collection.create_partition(name)
+                self._partitions.add(name)
+        return name
+
+    def _embed_and_insert(self, rows):
+        # Ingestion waits behind interactive searches for the shared embedding limits
+        with scheduling_priority(BATCH):
+            vectors = self.provider.embed([row[2] for row in rows])
+        groups = {}
+        for row, vector in zip(rows, vectors, strict=True):
+            partition = None
+            if MILVUS_MONTH_PARTITIONS and not isinstance(self.collection, LocalVectorIndex):
+                partition = month_partition(row[3])
+            groups.setdefault(partition, []).append((row, vector))
+        for partition, group in groups.items():
+            columns = [
+                [row[0] for row, _ in group],
+                [row[1] for row, _ in group],
+                [row[2][:MAX_TEXT_LENGTH] for row, _ in group],
+                [row[3] for row, _ in group],
+                [vector for _, vector in group]
+            ]
+            if partition is None:
+                self.collection.insert(columns)
+            else:
+                self.collection.insert(columns, partition_name=self._partition(partition))
+        self.metrics.add(rows_inserted=len(rows))
+
+    def _drain(self, in_flight, keep):
+        # Wait for the oldest batches until at most `keep` remain in flight
+        while len(in_flight) > keep:
+            future, checkpoint = in_flight.popleft()
+            future.result()
+            if checkpoint is not None:
+                self.save_checkpoint(backfill_last_id=checkpoint)
+
+    def backfill(self, read_batch_size=INGEST_READ_BATCH_SIZE, log_every=30):
+        """
+        Index every vCon after the saved backfill checkpoint.
+
+        Returns:
+            dict: Metrics snapshot at the end of the run
+        """
+        checkpoint = self.load_checkpoint()
+        if checkpoint.get("backfill_complete"):
+            logger.info("Backfill already complete, nothing to do")
+            return self.metrics.snapshot()
+
+        query = {}
+        if checkpoint.get("backfill_last_id") is not None:
+            query["_id"] = {"$gt": checkpoint["backfill_last_id"]}
+            logger.info(f"Resuming backfill after _id {checkpoint['backfill_last_id']}")
+
+        # Capture the change stream position first so nothing is missed in between
+        if checkpoint.get("resume_token") is None:
+            try:
+                with self.source.watch() as stream:
+                    self.save_checkpoint(resume_token=stream.resume_token)
+            except OperationFailure as e:
+                # A standalone mongod has no change streams; the backfill itself still works
+                logger.warning(f"Could not open a change stream ({str(e)}); changes made during the "
+                               f"backfill will not be picked up by follow")
+
+        cursor = self.source.find(query, VCON_PROJECTION).sort("_id", 1).batch_size(read_batch_size)
+        in_flight = deque()
+        rows = []
+        last_logged = time.monotonic()
+        for vcon in cursor:
+            vcon_chunk_rows = vcon_rows(vcon)
+            rows.extend(vcon_chunk_rows)
+            self.metrics.add(vcons=1, chunks=len(vcon_chunk_rows))
+            if len(rows) >= self.embed_batch_size:
+                # The checkpoint only advances once this batch is stored
+                in_flight.append((self._executor.submit(self._embed_and_insert, rows), vcon["_id"]))
+                rows = []
+                self._drain(in_flight, self.embed_concurrency)
+            if time.monotonic() - last_logged >= log_every:
+                logger.info(f"Backfill progress: {self.metrics.snapshot()}")
+                last_logged = time.monotonic()
+        if rows:
+            in_flight.append((self._executor.submit(self._embed_and_insert, rows), None))
+        self._drain(in_flight, 0)
+        self.collection.flush()
+        self.save_checkpoint(backfill_complete=True)
+        logger.info(f"Backfill complete: {self.metrics.snapshot()}")
+        return self.metrics.snapshot()
+
+    def reindex(self, vcons):
+        """
+        Replace the rows of the given vCons.
+        """
+        uuids = [str(vcon["uuid"]) for vcon in vcons if vcon.get("uuid")]
+        if uuids:
+            self.delete(uuids)
+        rows = []
+        for vcon in vcons:
+            vcon_chunk_rows = vcon_rows(vcon)
+            rows.extend(vcon_chunk_rows)
+            self.metrics.add(vcons=1, chunks=len(vcon_chunk_rows))
+        for start in range(0, len(rows), self.embed_batch_size):
+            self._embed_and_insert(rows[start:start + self.embed_batch_size])
+
+    def delete(self, uuids):
+        if isinstance(self.collection, LocalVectorIndex):
+            self.collection.delete_vcons(uuids)
+        else:
+            self.collection.delete(f"vcon_uuid in {json.dumps(uuids)}")
+        self.metrics.add(deleted=len(uuids))
+
+    def follow(self, max_batch=100, max_wait=1.0, stop_event=None):
+        """
+        Apply changes from the vCon change stream until stop_event is set.
+
+        Changes are grouped into batches of up to max_batch documents or
+        max_wait seconds. Updates that touch none of INDEXED_FIELDS, such as
+        party_keys or metadata writes, are skipped. The resume token is saved
+        after each applied batch, and otherwise at most every
+        INGEST_CHECKPOINT_INTERVAL seconds when it has advanced.
+        """
+        checkpoint = self.load_checkpoint()
+        resume_token = checkpoint.get("resume_token")
+        stop_event = stop_event or threading.Event()
+        last_saved = time.monotonic()
+        logger.info(f"Following {DB_NAME}.{COLLECTION_NAME} change stream")
+        while not stop_event.is_set():
+            try:
+                options = {"full_document": "updateLookup", "max_await_time_ms": int(max_wait * 1000)}
+                if INGEST_PRE_IMAGES:
+                    options["full_document_before_change"] = "whenAvailable"
+                with self.source.watch(resume_after=resume_token, **options) as stream:
+                    pending, deleted = {}, set()
+                    batch_started = time.monotonic()
+                    while not stop_event.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self._collect_change(change, pending, deleted)
+                        full = len(pending) + len(deleted) >= max_batch
+                        waited = time.monotonic() - batch_started >= max_wait
+                        applied = bool(pending or deleted) and (full or waited or change is None)
+                        if applied:
+                            self._apply(pending, deleted)
+                            pending, deleted = {}, set()
+                        if change is None or full or waited:
+                            # An idle poll still advances the token; saving each one would write every max_wait
+                            due = applied or time.monotonic() - last_saved >= INGEST_CHECKPOINT_INTERVAL
+                            if due and stream.resume_token != resume_token:
+                                resume_token = stream.resume_token
+                                self.save_checkpoint(resume_token=resume_token)
+                                last_saved = time.monotonic()
+                            batch_started = time.monotonic()
+            except Exception as e:
+                self.metrics.add(errors=1)
+                logger.error(f"Change stream error, retrying: {str(e)}")
+                time.sleep(5)
+
+    def _collect_change(self, change, pending, deleted):
+        operation = change.get("operationType")
+        if "clusterTime" in change:
+            self.metrics.last_event_time = change["clusterTime"].as_datetime()
+        if operation == "update" and not indexed_fields_changed(change):
+            return
+        if operation in ("insert", "update", "replace"):
+            vcon = change.get("fullDocument")
+            if vcon and vcon.get("uuid"):
+                pending[vcon["uuid"]] = vcon
+        elif operation == "delete":
+            before = change.get("fullDocumentBeforeChange") or {}
+            if before.get("uuid"):
+                deleted.add(before["uuid"])
+            else:
+                logger.warning(f"Cannot remove rows of deleted vCon {change['documentKey']}: enable pre-images on the collection")
+
+    def _apply(self, pending, deleted):
+        try:
+            if deleted:
+                self.delete(sorted(deleted - set(pending)))
+            if pending:
+                self.reindex(list(pending.values()))
+            logger.info(f"Applied {len(pending)} changed and {len(deleted)} deleted vCons: {self.metrics.snapshot()}")
+        except Exception as e:
+            self.metrics.add(errors=1)
+            logger.error(f"Failed to apply change batch: {str(e)}")
+            raise
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index vCons from MongoDB into Milvus")
+    parser.add_argument("mode", choices=["backfill", "follow", "run"], help="run = backfill, then follow the change stream")
+    parser.add_argument("--name", default="default", help="Checkpoint name, one per pipeline")
+    parser.add_argument("--embed-batch-size", type=int, default=INGEST_EMBED_BATCH_SIZE)
+    parser.add_argument("--embed-concurrency", type=int, default=INGEST_EMBED_CONCURRENCY)
+    parser.add_argument("--backend", choices=["milvus", "local"], default=config.get("vector_backend", "milvus"),
+                        help="Write to Milvus or to the local vector index")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    target = None
+    if args.backend == "local":
+        target = get_local_index()
+    else:
+        from pymilvus import connections
+        connections.connect(
+            alias="default",
+            host=config.get("milvus_host", "localhost"),
+            port=config.get("milvus_port", "19530")
+        )
+    pipeline = IngestPipeline(
+        MongoClient(config["mongo_uri"]),
+        name=f"{args.name}-local" if args.backend == "local" else args.name,
+        target=target,
+        embed_batch_size=args.embed_batch_size,
+        embed_concurrency=args.embed_concurrency
+    )
+    if args.mode in ("backfill", "run"):
+        print(json.dumps(pipeline.backfill()))
+    if args.mode in ("follow", "run"):
+        pipeline.follow()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
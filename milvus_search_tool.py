@@ -1,8 +1,22 @@
-from pymilvus import Collection, connections
+from milvus_collection_manager import CollectionManager
 import numpy as np
 from config import config
-import openai
+from backend_limits import backend_slot
+from embedding_cache import embedding_cache, normalize_text
+from embedding_providers import get_embedding_provider, check_embedding_dimension, EmbeddingDimensionError
+from local_vector_index import get_local_index
+from search_postprocess import group_by_conversation, SEARCH_OVERFETCH_FACTOR
+from milvus_ingest import MILVUS_MONTH_PARTITIONS, month_partitions_between
+from party_directory import normalize_tel, normalize_mailto
+from date_range_tool import parse_date_bound
+from single_flight import embedding_flight, search_flight
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import hashlib
+import asyncio
 import logging
+import json
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -10,47 +24,107 @@ logger = logging.getLogger(__name__)
 
 # Get configuration values
 MILVUS_COLLECTION_NAME = config["milvus_collection_name"]
-OPENAI_API_KEY = config["openai_api_key"]
 MILVUS_HOST = config.get("milvus_host", "localhost")
 MILVUS_PORT = config.get("milvus_port", "19530")
-EMBEDDING_MODEL = config.get("embedding_model", "text-embedding-ada-002")
+MILVUS_ANNS_FIELD = config.get("milvus_anns_field", "embedding")
 SEARCH_RESULT_LIMIT = config.get("search_result_limit", 10)
+MILVUS_HEALTH_CHECK_INTERVAL = int(config.get("milvus_health_check_interval", 30))
+MILVUS_PRELOAD = config.get("milvus_preload_collection", True)
+MAX_BATCH_SEARCH_TEXTS = int(config.get("max_batch_search_texts", 10))
+# "milvus", or "local" to serve every search from the local vector index
+VECTOR_BACKEND = config.get("vector_backend", "milvus")
+# Serve searches from the local vector index while Milvus is unreachable
+LOCAL_VECTOR_FALLBACK = config.get("local_vector_fallback", True)
+# Return one diversified entry per conversation instead of raw chunk hits
+SEARCH_GROUP_BY_CONVERSATION = config.get("search_group_by_conversation", True)
 
-# Initialize OpenAI client once
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# Threads for the blocking embedding and pymilvus calls of the async search tools
+MILVUS_EXECUTOR_WORKERS = int(config.get("milvus_executor_workers", 8))
 
-# Establish a connection to Milvus
-try:
-    connections.connect(
-        alias="default",
-        host=MILVUS_HOST,
-        port=MILVUS_PORT
-    )
-    logger.info(f"Connected to Milvus at {MILVUS_HOST}:{MILVUS_PORT}")
-except Exception as e:
-    logger.error(f"Failed to connect to Milvus: {str(e)}")
+# Parameters for every search in the Milvus collection
+SEARCH_PARAMS = {
+    "metric_type": "L2",  # or "IP" depending on your use case
+    "params": {"nprobe": 10}
+}
+
+# Shared, long-lived handle to the search collection; connects on first use
+collection_manager = CollectionManager(
+    MILVUS_COLLECTION_NAME,
+    health_check_interval=MILVUS_HEALTH_CHECK_INTERVAL,
+    host=MILVUS_HOST,
+    port=MILVUS_PORT
+)
+
+# Fixed pool behind the async search tools, so in-flight searches do not each need a thread
+_milvus_executor = ThreadPoolExecutor(max_workers=MILVUS_EXECUTOR_WORKERS, thread_name_prefix="milvus")
+
+# Whether the provider's vectors have been checked against the collection schema
+_dimension_checked = False
+
+# Optional filters accepted by both search tools
+SEARCH_FILTER_PROPERTIES = {
+    "start_date": {
+        "type": "string",
+        "description": "Only search conversations created on or after this date (ISO format)"
+    },
+    "end_date": {
+        "type": "string",
+        "description": "Only search conversations created on or before this date (ISO format)"
+    },
+    "party": {
+        "type": "string",
+        "description": "Only search text from this party (phone number, email or name)"
+    }
+}
 
 MILVUS_SEARCH_TOOL = {
     "type": "function",
     "function": {
         "name": "search_in_milvus",
-        "description": "Search for conversation transcripts and summaries in Milvus",
+        "description": "Search for conversation transcripts and summaries in Milvus. Returns the best matching snippet of each conversation, with the number of matching chunks.",
         "parameters": {
             "type": "object",
             "properties": {
                 "search_text": {
                     "type": "string",
                     "description": "Text to search for in the Milvus database"
-                }
+                },
+                **SEARCH_FILTER_PROPERTIES
             },
             "required": ["search_text"]
         }
     }
 }
 
+MILVUS_BATCH_SEARCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "search_in_milvus_batch",
+        "description": "Search for conversation transcripts and summaries in Milvus using several phrasings at once. Prefer this over repeated search_in_milvus calls when exploring alternative wordings.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "search_texts": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    },
+                    "description": f"Texts to search for in the Milvus database (max {MAX_BATCH_SEARCH_TEXTS})",
+                    "maxItems": MAX_BATCH_SEARCH_TEXTS
+                },
+                **SEARCH_FILTER_PROPERTIES
+            },
+            "required": ["search_texts"]
+        }
+    }
+}
+
 def get_embedding(text):
     """
-    Get embedding for the provided text using OpenAI's embedding API
+    Get embedding for the provided text using the configured embedding provider
+    
+    Results are served from the shared embedding cache when the same
+    normalized text has been embedded with the same provider and model before.
     
     Args:
         text (str): The text to generate embeddings for
@@ -58,16 +132,178 @@ def get_embedding(text):
     Returns:
         list: The embedding vector
     """
+    return get_embeddings([text])[0]
+
+def get_embeddings(texts):
+    """
+    Get embeddings for several texts in as few provider calls as possible
+    
+    Cached texts are not sent; only the misses are embedded, in batches.
+    
+    Args:
+        texts (list): The texts to generate embeddings for
+        
+    Returns:
+        list: One embedding vector per input text, in input order
+    """
+    provider = get_embedding_provider()
+    embeddings = [embedding_cache.get(provider.cache_namespace, text) for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+    
     try:
-        response = openai_client.embeddings.create(
-            input=text,
-            model=EMBEDDING_MODEL
-        )
-        return response.data[0].embedding
+        # Sessions embedding the same texts at the same moment share one provider call
+        key = (provider.cache_namespace, tuple(normalize_text(texts[i]) for i in missing))
+        new_embeddings = embedding_flight.do(key, provider.embed, [texts[i] for i in missing])
+        for i, embedding in zip(missing, new_embeddings, strict=True):
+            embeddings[i] = embedding
+            embedding_cache.put(provider.cache_namespace, texts[i], embedding)
+        return embeddings
     except Exception as e:
         logger.error(f"Error generating embedding: {str(e)}")
         raise
 
+def preload_search_collection():
+    """
+    Connect to Milvus and load the search collection in the background, if configured.
+    """
+    if MILVUS_PRELOAD and VECTOR_BACKEND == "milvus":
+        collection_manager.preload()
+
+def get_search_collection():
+    """
+    Get the shared search collection, checking the embedding dimension on first use
+    
+    Returns:
+        Collection: The loaded Milvus collection
+    """
+    global _dimension_checked
+    collection = collection_manager.get_collection()
+    if not _dimension_checked:
+        check_embedding_dimension(get_embedding_provider(), collection, MILVUS_ANNS_FIELD)
+        _dimension_checked = True
+    return collection
+
+def build_search_filters(start_date=None, end_date=None, party=None):
+    """
+    Turn the optional tool arguments into search filters
+    
+    Args:
+        start_date (str): Earliest creation date, inclusive
+        end_date (str): Latest creation date, inclusive
+        party (str): Party identifier as the user wrote it
+        
+    Returns:
+        dict: start and end as Unix seconds and the party_id values to match
+        
+    Raises:
+        ValueError: If a date cannot be parsed
+    """
+    filters = {}
+    if start_date:
+        filters["start"] = int(parse_date_bound(start_date, end_of_day=False).timestamp())
+    if end_date:
+        filters["end"] = int(parse_date_bound(end_date, end_of_day=True).timestamp())
+    if party:
+        # party_id holds normalized numbers and emails, but older rows may not
+        party = str(party).strip()
+        candidates = [party, normalize_tel(party), normalize_mailto(party) if "@" in party else None]
+        filters["party_ids"] = list(dict.fromkeys(value for value in candidates if value))
+    return filters
+
+def filter_expr(filters):
+    """
+    Build the Milvus boolean expression for search filters
+    
+    Returns:
+        str: The expression, or an empty string when there are no filters
+    """
+    clauses = []
+    if filters.get("start") is not None:
+        clauses.append(f"created_at >= {filters['start']}")
+    if filters.get("end") is not None:
+        clauses.append(f"created_at <= {filters['end']}")
+    if filters.get("party_ids"):
+        clauses.append(f"party_id in {json.dumps(filters['party_ids'])}")
+    return " && ".join(clauses)
+
+def _search_partitions(collection, filters):
+    # Month partitions that can hold rows in the filtered date range
+    start = filters.get("start", 0)
+    end = filters.get("end", int(datetime.now(timezone.utc).timestamp()))
+    existing = {partition.name for partition in collection.partitions}
+    return [name for name in month_partitions_between(start, end) if name in existing]
+
+def _search_key(search_args):
+    # Normalized search: the query vectors by content, plus every other argument
+    digest = hashlib.md5(np.asarray(search_args["data"], dtype=np.float32).tobytes())
+    digest.update(json.dumps({k: v for k, v in search_args.items() if k != "data"}, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def _milvus_search(collection, search_args):
+    with backend_slot("milvus"):
+        return collection.search(**search_args)
+
+def search_vectors(vectors, filters=None, limit=SEARCH_RESULT_LIMIT, with_embeddings=False):
+    """
+    Run a vector search on Milvus, or on the local vector index
+    
+    Filters are pushed down as a Milvus expr, and with milvus_month_partitions
+    only the partitions for the filtered months are searched. The local index
+    serves every search when vector_backend is "local", and stands in for
+    Milvus when a Milvus search fails and local_vector_fallback is enabled.
+    
+    Args:
+        vectors (list): Query vectors
+        filters (dict): Optional filters from build_search_filters()
+        limit (int): Hits per query vector
+        with_embeddings (bool): Also return each hit's embedding
+        
+    Returns:
+        list: One list of hits per query vector
+    """
+    filters = filters or {}
+    search_args = {
+        "data": vectors,
+        "anns_field": MILVUS_ANNS_FIELD,
+        "param": SEARCH_PARAMS,
+        "limit": limit,
+        "output_fields": ["vcon_uuid", "party_id", "text"] + ([MILVUS_ANNS_FIELD] if with_embeddings else [])
+    }
+    if VECTOR_BACKEND == "local":
+        return get_local_index().search(filters=filters, **search_args)
+    
+    try:
+        collection = get_search_collection()
+        expr = filter_expr(filters)
+        if expr:
+            search_args["expr"] = expr
+        if "start" in filters or "end" in filters:
+            if "created_at" not in {field.name for field in collection.schema.fields}:
+                raise ValueError(f"{MILVUS_COLLECTION_NAME} has no created_at field; re-index it with milvus_ingest to filter by date")
+            if MILVUS_MONTH_PARTITIONS:
+                partitions = _search_partitions(collection, filters)
+                if not partitions:
+                    return [[] for _ in vectors]
+                search_args["partition_names"] = partitions
+        # Identical searches already in flight share one Milvus request
+        return search_flight.do(_search_key(search_args), _milvus_search, collection, search_args)
+    except (EmbeddingDimensionError, ValueError):
+        raise
+    except Exception as e:
+        # Rebuild the handle on the next search in case it went stale
+        collection_manager.invalidate()
+        if not LOCAL_VECTOR_FALLBACK:
+            raise
+        local_index = get_local_index()
+        if not len(local_index):
+            raise
+        logger.warning(f"Milvus search failed, serving from the local vector index: {str(e)}")
+        search_args.pop("expr", None)
+        search_args.pop("partition_names", None)
+        return local_index.search(filters=filters, **search_args)
+
 def extract_entity_data(hit):
     """
     Helper function to extract entity data regardless of Milvus SDK version
@@ -103,78 +339,210 @@ def extract_entity_data(hit):
     
     return vcon_uuid, party_id, text_content
 
-def search_in_milvus(search_text):
+def extract_embedding(hit):
+    """
+    Get the embedding returned with a hit, or None if it was not returned
+    
+    Args:
+        hit: A search hit from Milvus
+        
+    Returns:
+        list: The embedding vector, or None
+    """
+    entity = getattr(hit, 'entity', None)
+    if isinstance(entity, dict):
+        return entity.get(MILVUS_ANNS_FIELD)
+    if hasattr(entity, 'fields'):
+        return entity.fields.get(MILVUS_ANNS_FIELD)
+    if hasattr(entity, 'get'):
+        return entity.get(MILVUS_ANNS_FIELD)
+    return None
+
+def postprocess_hits(hits):
+    """
+    Format the hits for one query, grouped per conversation if enabled
+    
+    Args:
+        hits: Search hits for one query vector, best first
+        
+    Returns:
+        list: Formatted results, at most SEARCH_RESULT_LIMIT of them
+    """
+    formatted = [format_hit(hit) for hit in hits]
+    if not SEARCH_GROUP_BY_CONVERSATION:
+        return formatted[:SEARCH_RESULT_LIMIT]
+    return group_by_conversation(
+        formatted,
+        [extract_embedding(hit) for hit in hits],
+        SEARCH_RESULT_LIMIT,
+        metric=SEARCH_PARAMS["metric_type"]
+    )
+
+def _search_limit():
+    # Fetch extra chunks when they will be grouped into conversations
+    if SEARCH_GROUP_BY_CONVERSATION:
+        return SEARCH_RESULT_LIMIT * SEARCH_OVERFETCH_FACTOR
+    return SEARCH_RESULT_LIMIT
+
+def format_hit(hit):
+    """
+    Format a Milvus search hit in a way that's useful for the LLM
+    
+    Args:
+        hit: A search hit from Milvus
+        
+    Returns:
+        dict: Hit id, score, vCon metadata and (possibly truncated) text
+    """
+    vcon_uuid, party_id, text_content = extract_entity_data(hit)
+    return {
+        "id": hit.id if hasattr(hit, 'id') else 'Unknown ID',
+        "score": round(hit.score, 4) if hasattr(hit, 'score') else 0,
+        "vcon_uuid": vcon_uuid,
+        "party_id": party_id,
+        "text": text_content[:1000] + "..." if len(text_content) > 1000 else text_content,
+        "truncated": len(text_content) > 1000
+    }
+
+def search_in_milvus(search_text, start_date=None, end_date=None, party=None):
     """
     Search for similar content in Milvus using vector similarity
     
     Args:
         search_text (str): The text to search for
+        start_date (str): Only search conversations created on or after this date
+        end_date (str): Only search conversations created on or before this date
+        party (str): Only search text from this party
         
     Returns:
         list: Formatted search results or error message
     """
     try:
+        filters = build_search_filters(start_date, end_date, party)
+        
         # Convert the search text to an embedding vector
         search_vector = get_embedding(search_text)
         
         # Make sure the vector is the correct format
         search_vector = np.array(search_vector, dtype=np.float32).tolist()
         
-        # Get collection
-        collection = Collection(MILVUS_COLLECTION_NAME)
-        
-        # Load collection - this is safe to call even if already loaded
-        try:
-            collection.load()
-            logger.info(f"Collection {MILVUS_COLLECTION_NAME} loaded successfully")
-        except Exception as load_error:
-            logger.warning(f"Note when loading collection: {str(load_error)}")
-        
-        # Perform a search in the Milvus collection
-        search_params = {
-            "metric_type": "L2",  # or "IP" depending on your use case
-            "params": {"nprobe": 10}
-        }
-        
         # Perform the search with the vector embedding
-        results = collection.search(
-            data=[search_vector],
-            anns_field="embedding",
-            param=search_params,
-            limit=SEARCH_RESULT_LIMIT,
-            output_fields=["vcon_uuid", "party_id", "text"]
+        results = search_vectors(
+            [search_vector], filters, limit=_search_limit(), with_embeddings=SEARCH_GROUP_BY_CONVERSATION
         )
         
         # Process the search results
         formatted_results = []
         for hits in results:
-            for hit in hits:
-                # Extract entity data
-                vcon_uuid, party_id, text_content = extract_entity_data(hit)
-                
-                # Format results in a way that's useful for the LLM
-                formatted_results.append({
-                    "id": hit.id if hasattr(hit, 'id') else 'Unknown ID',
-                    "score": round(hit.score, 4) if hasattr(hit, 'score') else 0,
-                    "vcon_uuid": vcon_uuid,
-                    "party_id": party_id,
-                    "text": text_content[:1000] + "..." if len(text_content) > 1000 else text_content,
-                    "truncated": len(text_content) > 1000
-                })
-        
-        # Release collection resources
-        collection.release()
+            formatted_results.extend(postprocess_hits(hits))
         
         return formatted_results
     except Exception as e:
         logger.error(f"Error searching in Milvus: {str(e)}")
         return f"Error searching in Milvus: {str(e)}"
 
+def search_in_milvus_batch(search_texts, start_date=None, end_date=None, party=None):
+    """
+    Search Milvus for several texts with one embedding call and one multi-vector search
+    
+    Repeated search texts are searched once. A hit (or, when grouping by
+    conversation, a conversation) already returned for an earlier query is
+    listed again without its text, pointing back to the query that carries it.
+    
+    Args:
+        search_texts (list): The texts to search for
+        start_date (str): Only search conversations created on or after this date
+        end_date (str): Only search conversations created on or before this date
+        party (str): Only search text from this party
+        
+    Returns:
+        list: One entry per distinct search text with its formatted results, or error message
+    """
+    try:
+        filters = build_search_filters(start_date, end_date, party)
+        if isinstance(search_texts, str):
+            search_texts = [search_texts]
+        
+        # Drop empty and repeated queries, keeping the first occurrence
+        unique_texts = []
+        seen_texts = set()
+        for text in search_texts:
+            key = normalize_text(text)
+            if key and key not in seen_texts:
+                seen_texts.add(key)
+                unique_texts.append(text)
+        
+        if len(unique_texts) > MAX_BATCH_SEARCH_TEXTS:
+            logger.warning(f"Too many search texts requested: {len(unique_texts)}. Limiting to {MAX_BATCH_SEARCH_TEXTS}.")
+            unique_texts = unique_texts[:MAX_BATCH_SEARCH_TEXTS]
+        if not unique_texts:
+            return []
+        
+        query_vectors = np.array(get_embeddings(unique_texts), dtype=np.float32).tolist()
+        
+        results = search_vectors(
+            query_vectors, filters, limit=_search_limit(), with_embeddings=SEARCH_GROUP_BY_CONVERSATION
+        )
+        
+        # Grouped results are one per conversation, so repeats are found by vcon_uuid
+        duplicate_key = "vcon_uuid" if SEARCH_GROUP_BY_CONVERSATION else "id"
+        
+        # Milvus returns one hit list per query vector, in query order
+        first_seen = {}
+        batch_results = []
+        for query_index, (search_text, hits) in enumerate(zip(unique_texts, results, strict=True)):
+            query_results = []
+            seen_keys = set()
+            for formatted in postprocess_hits(hits):
+                key = formatted[duplicate_key]
+                if key in seen_keys:
+                    continue
+                seen_keys.add(key)
+                if key in first_seen:
+                    formatted = {
+                        "id": formatted["id"],
+                        "score": formatted["score"],
+                        "vcon_uuid": formatted["vcon_uuid"],
+                        "duplicate_of_query": first_seen[key]
+                    }
+                else:
+                    first_seen[key] = query_index
+                query_results.append(formatted)
+            batch_results.append({
+                "query": query_index,
+                "search_text": search_text,
+                "results": query_results
+            })
+        
+        return batch_results
+    except Exception as e:
+        logger.error(f"Error searching in Milvus: {str(e)}")
+        return f"Error searching in Milvus: {str(e)}"
+
+async def _run_blocking(function, *args):
+    # Run on the Milvus pool in a copy of the caller's context, so spans stay in its trace
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_milvus_executor, context.run, function, *args)
+
+async def search_in_milvus_async(search_text, start_date=None, end_date=None, party=None):
+    """
+    search_in_milvus() for coroutines, run on the fixed Milvus thread pool.
+    """
+    return await _run_blocking(search_in_milvus, search_text, start_date, end_date, party)
+
+async def search_in_milvus_batch_async(search_texts, start_date=None, end_date=None, party=None):
+    """
+    search_in_milvus_batch() for coroutines, run on the fixed Milvus thread pool.
+    """
+    return await _run_blocking(search_in_milvus_batch, search_texts, start_date, end_date, party)
+
 def cleanup_connections():
     """
     Disconnect from Milvus - call this when shutting down your application
     """
+    collection_manager.close()
     try:
+        from pymilvus import connections
         connections.disconnect("default")
         logger.info("Disconnected from Milvus")
     except Exception as e:
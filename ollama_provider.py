@@ -0,0 +1,266 @@
+from requests.adapters import HTTPAdapter
+from types import SimpleNamespace
+from config import config
+import threading
+import requests
+import logging
+import json
+import uuid
+
+logger = logging.getLogger("llm_api")
+
+OLLAMA_HOST = config.get("ollama_host", "http://localhost:11434")
+# How long Ollama keeps a model in memory after a request (Ollama duration string or seconds)
+OLLAMA_KEEP_ALIVE = config.get("ollama_keep_alive", "30m")
+OLLAMA_TIMEOUT = float(config.get("ollama_timeout", 300))
+OLLAMA_POOL_SIZE = int(config.get("ollama_pool_size", 16))
+
+class OllamaError(requests.HTTPError):
+    """
+    An error reported by the Ollama server, with its message.
+
+    Carries the HTTP response, so the rate limiter can see the status code.
+    """
+
+def _raise_for_status(response):
+    # Ollama explains failures in an {"error": ...} body, which raise_for_status() would drop
+    if response.status_code < 400:
+        return
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    message = body.get("error") if isinstance(body, dict) else None
+    if not message:
+        response.raise_for_status()
+    raise OllamaError(f"{response.status_code} from Ollama: {message}", response=response)
+
+def _to_ollama_messages(messages):
+    """
+    Translate OpenAI chat messages to Ollama's format.
+
+    Ollama takes tool call arguments as objects rather than JSON strings and
+    identifies tool results by tool name instead of tool_call_id.
+    """
+    tool_names = {}
+    translated = []
+    for message in messages:
+        converted = {"role": message["role"], "content": message.get("content") or ""}
+        if message.get("tool_calls"):
+            converted["tool_calls"] = []
+            for tool_call in message["tool_calls"]:
+                function = tool_call["function"]
+                arguments = function.get("arguments") or "{}"
+                tool_names[tool_call.get("id")] = function["name"]
+                converted["tool_calls"].append({
+                    "function": {
+                        "name": function["name"],
+                        "arguments": json.loads(arguments) if isinstance(arguments, str) else arguments
+                    }
+                })
+        if message["role"] == "tool":
+            name = message.get("name") or tool_names.get(message.get("tool_call_id"))
+            if name:
+                converted["tool_name"] = name
+        translated.append(converted)
+    return translated
+
+def _to_openai_tool_calls(tool_calls):
+    """
+    Translate Ollama tool calls to OpenAI-style objects with generated ids.
+    """
+    return [
+        SimpleNamespace(
+            id=f"call_{uuid.uuid4().hex[:24]}",
+            type="function",
+            function=SimpleNamespace(
+                name=tool_call["function"]["name"],
+                arguments=json.dumps(tool_call["function"].get("arguments") or {})
+            )
+        )
+        for tool_call in tool_calls
+    ]
+
+def _finish_reason(data, tool_calls):
+    if tool_calls:
+        return "tool_calls"
+    return "length" if data.get("done_reason") == "length" else "stop"
+
+def _usage(data):
+    # Ollama reports token counts on the final response
+    return SimpleNamespace(
+        prompt_tokens=data.get("prompt_eval_count", 0),
+        completion_tokens=data.get("eval_count", 0)
+    )
+
+class _ChatCompletions:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, model, messages, tools=None, stream=False):
+        """
+        OpenAI-compatible chat completion backed by Ollama's /api/chat.
+
+        Returns a response object shaped like OpenAI's, or an iterator of
+        chunk objects when stream is True.
+        """
+        payload = {
+            "model": model,
+            "messages": _to_ollama_messages(messages),
+            "stream": stream,
+            "keep_alive": self._client.keep_alive
+        }
+        if tools:
+            payload["tools"] = tools
+        response = self._client.post("/api/chat", payload, stream=stream)
+        if stream:
+            return self._stream_chunks(response)
+
+        data = response.json()
+        message = data.get("message", {})
+        tool_calls = _to_openai_tool_calls(message.get("tool_calls") or [])
+        return SimpleNamespace(
+            model=data.get("model", model),
+            choices=[SimpleNamespace(
+                index=0,
+                finish_reason=_finish_reason(data, tool_calls),
+                message=SimpleNamespace(
+                    role="assistant",
+                    content=message.get("content") or "",
+                    tool_calls=tool_calls or None
+                )
+            )],
+            usage=_usage(data)
+        )
+
+    def _stream_chunks(self, response):
+        # Ollama streams one JSON object per line; tool calls arrive whole
+        tool_index = 0
+        saw_tool_calls = False
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    # Failures after the response started arrive as a line of their own
+                    raise OllamaError(data["error"], response=response)
+                message = data.get("message", {})
+                tool_deltas = []
+                for tool_call in _to_openai_tool_calls(message.get("tool_calls") or []):
+                    tool_deltas.append(SimpleNamespace(
+                        index=tool_index,
+                        id=tool_call.id,
+                        type="function",
+                        function=tool_call.function
+                    ))
+                    tool_index += 1
+                saw_tool_calls = saw_tool_calls or bool(tool_deltas)
+                done = data.get("done", False)
+                yield SimpleNamespace(choices=[SimpleNamespace(
+                    index=0,
+                    delta=SimpleNamespace(
+                        content=message.get("content") or None,
+                        tool_calls=tool_deltas or None
+                    ),
+                    finish_reason=_finish_reason(data, saw_tool_calls) if done else None
+                )], usage=_usage(data) if done else None)
+
+class _Models:
+    def __init__(self, client):
+        self._client = client
+
+    def list(self):
+        """
+        Models available on the Ollama server, as objects with an id.
+        """
+        data = self._client.get("/api/tags").json()
+        return [SimpleNamespace(id=model["name"]) for model in data.get("models", [])]
+
+class OllamaClient:
+    """
+    Minimal OpenAI-compatible client for a local Ollama server.
+
+    Exposes client.chat.completions.create() and client.models.list() so the
+    agent loop can use it in place of the OpenAI client. Requests share one
+    pooled HTTP session, and every request carries keep_alive so models stay
+    resident between turns.
+    """
+
+    def __init__(self, host=OLLAMA_HOST, keep_alive=OLLAMA_KEEP_ALIVE, timeout=OLLAMA_TIMEOUT,
+                 pool_size=OLLAMA_POOL_SIZE):
+        self.host = host.rstrip("/")
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.chat = SimpleNamespace(completions=_ChatCompletions(self))
+        self.models = _Models(self)
+        self._capabilities = {}
+        self._warmed = set()
+        self._lock = threading.Lock()
+
+    def post(self, path, payload, stream=False):
+        response = self.session.post(
+            f"{self.host}{path}", json=payload, stream=stream, timeout=self.timeout
+        )
+        _raise_for_status(response)
+        return response
+
+    def get(self, path):
+        response = self.session.get(f"{self.host}{path}", timeout=self.timeout)
+        _raise_for_status(response)
+        return response
+
+    def supports_tools(self, model):
+        """
+        Whether the model accepts tools, from the capabilities in /api/show.
+
+        Servers too old to report capabilities are assumed to support tools.
+        """
+        if model not in self._capabilities:
+            try:
+                data = self.post("/api/show", {"model": model}).json()
+                self._capabilities[model] = data.get("capabilities")
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Could not read capabilities of Ollama model {model}: {str(e)}")
+                return True
+        capabilities = self._capabilities[model]
+        return capabilities is None or "tools" in capabilities
+
+    def warm(self, models):
+        """
+        Load models into memory in the background so the first turn does not wait for them.
+
+        Each model is only warmed once per client.
+        """
+        with self._lock:
+            pending = [model for model in models if model and model not in self._warmed]
+            self._warmed.update(pending)
+
+        def _load(model):
+            try:
+                # An empty generate request only loads the model
+                self.post("/api/generate", {"model": model, "keep_alive": self.keep_alive})
+                logger.info(f"Ollama model {model} loaded")
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Could not warm Ollama model {model}: {str(e)}")
+                with self._lock:
+                    self._warmed.discard(model)
+
+        for model in pending:
+            threading.Thread(target=_load, args=(model,), name="ollama-warm", daemon=True).start()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_ollama_client(host=OLLAMA_HOST):
+    """
+    Shared OllamaClient for a host, so the connection pool survives reruns.
+    """
+    with _clients_lock:
+        if host not in _clients:
+            _clients[host] = OllamaClient(host)
+        return _clients[host]
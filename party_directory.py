@@ -0,0 +1,415 @@
+from pymongo import MongoClient, UpdateOne
+from config import config
+import unicodedata
+import threading
+import argparse
+import asyncio
+import logging
+import itertools
+import bisect
+import heapq
+import time
+import sys
+import re
+
+logger = logging.getLogger("llm_api")
+
+DB_NAME = config["db_name"]
+COLLECTION_NAME = config["collection_name"]
+
+# Country code assumed for phone numbers written without one
+DEFAULT_COUNTRY_CODE = str(config.get("default_country_code", "1"))
+# Seconds between incremental refreshes of the in-memory directory
+PARTY_DIRECTORY_REFRESH_INTERVAL = int(config.get("party_directory_refresh_interval", 60))
+# Seconds between full rebuilds, which pick up parties that were edited or deleted
+PARTY_DIRECTORY_REBUILD_INTERVAL = int(config.get("party_directory_rebuild_interval", 3600))
+FUZZY_MIN_SIMILARITY = float(config.get("party_fuzzy_min_similarity", 0.3))
+# Seconds a lookup waits for the first load before giving up; later refreshes never block
+PARTY_DIRECTORY_LOAD_WAIT = float(config.get("party_directory_load_wait", 5))
+
+def normalize_tel(value):
+    """
+    Normalize a phone number to E.164 (+<country><number>).
+
+    Numbers without a leading + that look national (10 digits) get
+    DEFAULT_COUNTRY_CODE. Returns None if there are too few digits.
+    """
+    value = str(value).strip()
+    if value.lower().startswith("tel:"):
+        value = value[4:]
+    digits = re.sub(r"\D", "", value)
+    if len(digits) < 7:
+        return None
+    if value.startswith("+"):
+        return "+" + digits
+    if value.startswith("00"):
+        return "+" + digits[2:]
+    if len(digits) == 10:
+        return "+" + DEFAULT_COUNTRY_CODE + digits
+    return "+" + digits
+
+def normalize_mailto(value):
+    """
+    Normalize an email address to lowercase without a mailto: prefix.
+    """
+    value = str(value).strip()
+    if value.lower().startswith("mailto:"):
+        value = value[7:]
+    return value.lower() or None
+
+def normalize_name(value):
+    """
+    Fold a name: strip accents and punctuation, casefold, collapse whitespace.
+    """
+    decomposed = unicodedata.normalize("NFKD", str(value))
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    folded = re.sub(r"[^\w\s]", " ", stripped.casefold())
+    return " ".join(folded.split()) or None
+
+def party_keys(party):
+    """
+    Build the normalized keys for one vCon party.
+
+    Args:
+        party (dict): Party from a vCon's parties array
+
+    Returns:
+        list: Keys such as "tel:+15555550100", "mailto:a@b.com", "name:jane doe"
+    """
+    keys = []
+    for field, normalize in (("tel", normalize_tel), ("mailto", normalize_mailto), ("name", normalize_name)):
+        if party.get(field):
+            normalized = normalize(party[field])
+            if normalized:
+                keys.append(f"{field}:{normalized}")
+    return keys
+
+def vcon_party_keys(vcon):
+    """
+    All distinct party keys of a vCon document.
+    """
+    keys = []
+    for party in vcon.get("parties") or []:
+        for key in party_keys(party):
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+def query_keys(text):
+    """
+    Guess which kind of party identifier a search string is and normalize it.
+
+    Returns:
+        list: Candidate party keys for an exact lookup
+    """
+    text = str(text).strip()
+    if "@" in text:
+        return [f"mailto:{normalize_mailto(text)}"]
+    keys = []
+    if re.fullmatch(r"(tel:)?[+\d\s().-]+", text, re.IGNORECASE):
+        tel = normalize_tel(text)
+        if tel:
+            keys.append(f"tel:{tel}")
+    name = normalize_name(text)
+    if name and not keys:
+        keys.append(f"name:{name}")
+    return keys
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PartyDirectory:
+    """
+    In-memory directory of every party key in the vCon collection.
+
+    Supports prefix lookups (binary search over the sorted keys) and fuzzy
+    lookups (trigram similarity). Refreshes are incremental, reading only
+    vCons with an _id above the highest one already seen, except every
+    rebuild_interval, when the directory is rebuilt from the whole
+    collection so edited and deleted parties drop out. Keys are always
+    computed from parties, never taken from a possibly stale party_keys.
+    The directory never writes to the collection; party_keys is kept by
+    the command-line backfill and follower below.
+
+    Refreshes run in the background, one at a time. Until the first load
+    has finished, every lookup waits for it (up to a timeout) instead of
+    scanning the collection itself or seeing an empty directory.
+    """
+
+    def __init__(self, refresh_interval=PARTY_DIRECTORY_REFRESH_INTERVAL,
+                 rebuild_interval=PARTY_DIRECTORY_REBUILD_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self._counts = {}
+        self._sorted_keys = []
+        self._trigrams = {}
+        self._last_id = None
+        self._last_refresh = 0
+        self._last_rebuild = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._tasks = set()
+
+    @property
+    def loaded(self):
+        return self._loaded.is_set()
+
+    def ensure_fresh(self, collection, wait=PARTY_DIRECTORY_LOAD_WAIT):
+        """
+        Start a background refresh if the last one is older than the interval.
+
+        Args:
+            collection: vCon collection
+            wait (float): Seconds to wait if the directory has never been loaded
+
+        Returns:
+            bool: Whether the directory is loaded
+        """
+        if time.monotonic() - self._last_refresh >= self.refresh_interval and self._refresh_lock.acquire(blocking=False):
+            threading.Thread(
+                target=self._refresh_locked, args=(collection,), name="party-directory-refresh", daemon=True
+            ).start()
+        return self._loaded.wait(wait)
+
+    async def ensure_fresh_async(self, collection, wait=PARTY_DIRECTORY_LOAD_WAIT):
+        """
+        ensure_fresh() for an AsyncMongoClient collection; the refresh runs as a task on the loop.
+        """
+        if time.monotonic() - self._last_refresh >= self.refresh_interval and self._refresh_lock.acquire(blocking=False):
+            task = asyncio.get_running_loop().create_task(self._refresh_async_locked(collection))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if self._loaded.is_set():
+            return True
+        # Whoever is loading, this loop's task or another thread, sets the event
+        return await asyncio.to_thread(self._loaded.wait, wait)
+
+    def refresh(self, collection, batch_size=5000):
+        """
+        Add the party keys of vCons inserted since the last refresh, or rebuild
+        the directory when a rebuild is due; waits for a refresh already running.
+        """
+        self._refresh_lock.acquire()
+        self._refresh_locked(collection, batch_size, raise_errors=True)
+
+    def _refresh_locked(self, collection, batch_size=5000, raise_errors=False):
+        # Runs with _refresh_lock held and releases it
+        try:
+            rebuild = self._rebuild_due()
+            counts = {}
+            last_id = None if rebuild else self._last_id
+            for vcon in self._changes(collection, batch_size, last_id):
+                last_id = self._count(vcon, counts)
+            self._apply(counts, last_id, rebuild)
+        except Exception as e:
+            logger.error(f"Party directory refresh failed: {str(e)}")
+            if raise_errors:
+                raise
+        finally:
+            self._refresh_lock.release()
+
+    async def _refresh_async_locked(self, collection, batch_size=5000):
+        try:
+            rebuild = self._rebuild_due()
+            counts = {}
+            last_id = None if rebuild else self._last_id
+            async for vcon in self._changes(collection, batch_size, last_id):
+                last_id = self._count(vcon, counts)
+            self._apply(counts, last_id, rebuild)
+        except Exception as e:
+            logger.error(f"Party directory refresh failed: {str(e)}")
+        finally:
+            self._refresh_lock.release()
+
+    def _rebuild_due(self):
+        return self._last_rebuild is None or time.monotonic() - self._last_rebuild >= self.rebuild_interval
+
+    def _changes(self, collection, batch_size, after_id):
+        # vCons above after_id (all of them for None), in _id order
+        query = {"_id": {"$gt": after_id}} if after_id is not None else {}
+        return collection.find(
+            query,
+            {"parties.tel": 1, "parties.mailto": 1, "parties.name": 1}
+        ).sort("_id", 1).batch_size(batch_size)
+
+    def _count(self, vcon, counts):
+        for key in vcon_party_keys(vcon):
+            counts[key] = counts.get(key, 0) + 1
+        return vcon["_id"]
+
+    def _apply(self, counts, last_id, rebuild=False):
+        if rebuild:
+            # Built aside and swapped in, so lookups keep the old directory meanwhile
+            trigrams = {}
+            for key in counts:
+                for trigram in _trigrams(key.split(":", 1)[1]):
+                    trigrams.setdefault(trigram, set()).add(key)
+            with self._lock:
+                self._counts = counts
+                self._sorted_keys = sorted(counts)
+                self._trigrams = trigrams
+                self._last_id = last_id
+            self._last_rebuild = time.monotonic()
+            logger.info(f"Party directory rebuilt: {len(counts)} keys")
+        else:
+            # Apply the batch under the lock so lookups never see partial updates
+            with self._lock:
+                new_keys = sorted(key for key in counts if key not in self._counts)
+                for key, count in counts.items():
+                    self._counts[key] = self._counts.get(key, 0) + count
+                for key in new_keys:
+                    for trigram in _trigrams(key.split(":", 1)[1]):
+                        self._trigrams.setdefault(trigram, set()).add(key)
+                self._sorted_keys = list(heapq.merge(self._sorted_keys, new_keys))
+                self._last_id = last_id
+            if new_keys:
+                logger.info(f"Party directory refreshed: {len(new_keys)} new keys, {len(self._counts)} total")
+        self._last_refresh = time.monotonic()
+        self._loaded.set()
+
+    def prefix(self, text, limit=10):
+        """
+        Keys whose normalized value starts with the given text.
+        """
+        candidates = []
+        with self._lock:
+            for key_prefix in self._candidate_prefixes(text):
+                start = bisect.bisect_left(self._sorted_keys, key_prefix)
+                for key in itertools.islice(self._sorted_keys, start, None):
+                    if not key.startswith(key_prefix) or len(candidates) >= limit * 4:
+                        break
+                    candidates.append(key)
+            # Prefer the parties that appear in the most conversations
+            return sorted(candidates, key=lambda key: -self._counts[key])[:limit]
+
+    def fuzzy(self, text, limit=10):
+        """
+        Keys whose normalized value is most similar to the given text.
+        """
+        value = normalize_name(text) or str(text).strip().lower()
+        wanted = _trigrams(value)
+        shared = {}
+        scored = []
+        with self._lock:
+            for trigram in wanted:
+                for key in self._trigrams.get(trigram, ()):
+                    shared[key] = shared.get(key, 0) + 1
+            for key, count in shared.items():
+                similarity = count / len(wanted | _trigrams(key.split(":", 1)[1]))
+                if similarity >= FUZZY_MIN_SIMILARITY:
+                    scored.append((similarity, self._counts[key], key))
+        scored.sort(reverse=True)
+        return [key for _, _, key in scored[:limit]]
+
+    def _candidate_prefixes(self, text):
+        text = str(text).strip()
+        if "@" in text:
+            return [f"mailto:{normalize_mailto(text)}"]
+        prefixes = []
+        digits = re.sub(r"\D", "", text)
+        if digits and re.fullmatch(r"[+\d\s().-]+", text):
+            prefixes.append(f"tel:+{digits}" if text.startswith("+") else f"tel:+{DEFAULT_COUNTRY_CODE}{digits}")
+        name = normalize_name(text)
+        if name:
+            prefixes.append(f"name:{name}")
+            prefixes.append(f"mailto:{name}")
+        return prefixes
+
+# Shared directory for the whole process
+party_directory = PartyDirectory()
+
+def backfill_party_keys(db_conn, batch_size=1000, recompute=False):
+    """
+    Write the normalized party_keys field on vCons that do not have it yet,
+    or with recompute, on every vCon whose party_keys no longer matches its parties.
+
+    This is the one-time migration run from the command line; the app and
+    the agent server only read party_keys. find_by_party also matches the
+    raw party fields, so vCons without it are found in the meantime.
+
+    Args:
+        db_conn: Database connection
+        batch_size (int): Number of updates per bulk write
+        recompute (bool): Also check vCons that already have party_keys
+
+    Returns:
+        int: Number of vCons updated
+    """
+    collection = db_conn[DB_NAME][COLLECTION_NAME]
+    cursor = collection.find(
+        {} if recompute else {"party_keys": {"$exists": False}},
+        {"party_keys": 1, "parties.tel": 1, "parties.mailto": 1, "parties.name": 1}
+    ).batch_size(batch_size)
+    updated = 0
+    operations = []
+    for vcon in cursor:
+        keys = vcon_party_keys(vcon)
+        if vcon.get("party_keys") == keys:
+            continue
+        operations.append(UpdateOne({"_id": vcon["_id"]}, {"$set": {"party_keys": keys}}))
+        if len(operations) >= batch_size:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+            logger.info(f"Backfilled party_keys on {updated} vCons")
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    logger.info(f"Party key backfill complete: {updated} vCons updated")
+    return updated
+
+def parties_changed(change):
+    """
+    Whether a change stream event may have changed a vCon's parties.
+    """
+    operation = change.get("operationType")
+    if operation in ("insert", "replace"):
+        return True
+    if operation != "update":
+        return False
+    description = change.get("updateDescription") or {}
+    fields = list(description.get("updatedFields") or {}) + list(description.get("removedFields") or [])
+    return any(field == "parties" or field.startswith("parties.") for field in fields)
+
+def follow_party_keys(db_conn, stop_event=None, max_wait=1.0):
+    """
+    Keep party_keys in step with parties, from the vCon change stream, until stop_event is set.
+
+    Inserts and replacements, and updates that touch parties, get their
+    party_keys recomputed; the follower's own party_keys writes are skipped.
+    Needs a replica set.
+    """
+    collection = db_conn[DB_NAME][COLLECTION_NAME]
+    stop_event = stop_event or threading.Event()
+    logger.info(f"Following {DB_NAME}.{COLLECTION_NAME} for party changes")
+    with collection.watch(full_document="updateLookup", max_await_time_ms=int(max_wait * 1000)) as stream:
+        while not stop_event.is_set():
+            change = stream.try_next()
+            if change is None or not parties_changed(change):
+                continue
+            vcon = change.get("fullDocument")
+            if not vcon:
+                continue
+            keys = vcon_party_keys(vcon)
+            if vcon.get("party_keys") != keys:
+                collection.update_one({"_id": vcon["_id"]}, {"$set": {"party_keys": keys}})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the normalized party_keys field on vCons")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Updates per bulk write")
+    parser.add_argument("--recompute", action="store_true", help="Also fix vCons whose party_keys is out of date")
+    parser.add_argument("--follow", action="store_true", help="Then keep party_keys up to date from the change stream")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_conn = MongoClient(config["mongo_uri"])
+    backfill_party_keys(db_conn, batch_size=args.batch_size, recompute=args.recompute)
+    if args.follow:
+        try:
+            follow_party_keys(db_conn)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
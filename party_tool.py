@@ -1,22 +1,49 @@
-from pymongo import MongoClient
 from config import config
-from pymilvus import Collection  # Import the Milvus client
+from party_directory import party_directory, query_keys
+from date_range_tool import encode_cursor, decode_cursor, keyset_filter
+from tool_result_serializer import max_page_size
+import logging
+
+logger = logging.getLogger("llm_api")
 
 # Update environment variables
 DB_NAME = config["db_name"]
 COLLECTION_NAME = config["collection_name"]
 
+MAX_PARTY_RESULTS = int(config.get("max_party_results", 500))
+# Also match the raw tel/mailto/name fields, for vCons written without party_keys
+LEGACY_FALLBACK = config.get("party_lookup_legacy_fallback", True)
+
+# created_at may be a BSON date or a legacy ISO string; BSON sorts strings before dates
+CREATED_AT_TYPES = [("string", {"$type": "string"}), ("date", {"$type": "date"})]
+PARTY_SORT = [("created_at", -1), ("uuid", 1)]
+
 PARTY_TOOL = {
     "type": "function",
     "function": {
         "name": "find_by_party",
-        "description": "Find conversations by party name",
+        "description": "Find conversations by party phone number, email address or name. Returns the UUIDs of the most recent matching conversations, the party identifiers that matched and a next_cursor for fetching more.",
         "parameters": {
             "type": "object",
             "properties": {
                 "party": {
                     "type": "string",
-                    "description": "Name of the party to search for"
+                    "description": "Phone number, email address or name of the party to search for"
+                },
+                "match": {
+                    "type": "string",
+                    "description": "'exact' (default) matches the normalized identifier, 'prefix' matches identifiers starting with the text, 'fuzzy' tolerates misspellings. Use prefix or fuzzy when an exact search finds nothing.",
+                    "enum": ["exact", "prefix", "fuzzy"],
+                    "default": "exact"
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum number of conversation UUIDs to return per page (default: 50). Larger limits are reduced to what fits in one page.",
+                    "default": 50
+                },
+                "cursor": {
+                    "type": "string",
+                    "description": "Opaque next_cursor value from a previous find_by_party result, to retrieve the next page"
                 }
             },
             "required": ["party"]
@@ -24,40 +51,110 @@ PARTY_TOOL = {
     }
 }
 
-def find_by_party(party, db_conn):
-    # MongoDB query to match party across tel, mailto, or name fields in parties array
+def _legacy_query(party, keys):
+    # The raw party fields, as typed or in their normalized forms
+    values = {party}
+    for key in keys:
+        field, value = key.split(":", 1)
+        values.update((value, key) if field in ("tel", "mailto") else (value,))
+    values = sorted(values)
+    return [
+        {"parties.tel": {"$in": values}},
+        {"parties.mailto": {"$in": values}},
+        {"parties.name": {"$in": values}}
+    ]
+
+def find_by_party(party, db_conn, match="exact", limit=50, cursor=None):
+    """
+    Find conversations involving a party, newest first.
+    
+    Matches on the normalized party_keys field (E.164 phone numbers,
+    lowercase email, folded names) through a single multikey index. Exact
+    lookups also match the raw party fields, so vCons written without
+    party_keys are still found. Prefix and fuzzy matches first resolve the
+    text to known party keys using the in-memory party directory.
+    
+    Args:
+        party (str): Phone number, email address or name
+        db_conn: Database connection
+        match (str): 'exact', 'prefix' or 'fuzzy'
+        limit (int): Maximum number of UUIDs to return
+        cursor (str): next_cursor from a previous call
+        
+    Returns:
+        dict: uuids, matched_parties and next_cursor (None on the last page)
+    """
     collection = db_conn[DB_NAME][COLLECTION_NAME]
-    query = {
-        "$or": [
-            {"parties.tel": party},
-            {"parties.mailto": party},
-            {"parties.name": party}
-        ]
-    }
-    results = list(collection.find(query, {"uuid": 1, "_id": 0}))
-    # Extract and return just the UUIDs
-    print(results)
-    return [doc["uuid"] for doc in results]
-
-# Add a new function to search in Milvus
-def search_in_milvus(search_text, milvus_conn):
-    # Assuming 'conversations' is the name of the Milvus collection
-    collection = Collection("conversations")
-    
-    # Perform a search in the Milvus collection
-    search_params = {
-        "metric_type": "L2",  # or "IP" depending on your use case
-        "params": {"nprobe": 10}
-    }
+    limit = _page_limit(limit)
+    
+    if match in ("prefix", "fuzzy") and not party_directory.ensure_fresh(collection):
+        return _DIRECTORY_LOADING
+    keys, query = _party_query(party, match, cursor)
+    if query is None:
+        return keys
     
-    # Perform the search
-    results = collection.search(
-        data=[search_text],  # The text to search for
-        anns_field="embedding",  # The field containing the vector embeddings
-        param=search_params,
-        limit=10,  # Limit the number of results
-        expr=None  # You can add additional filtering criteria if needed
+    # Newest first on the party_keys/created_at index; one extra document tells us if there is more
+    results = list(
+        collection.find(query, {"uuid": 1, "created_at": 1, "_id": 0}).sort(PARTY_SORT).limit(limit + 1)
     )
+    return _party_page(results, keys or ([party] if results else []), limit)
+
+async def find_by_party_async(party, db_conn, match="exact", limit=50, cursor=None):
+    """
+    find_by_party() for an AsyncMongoClient connection.
+    """
+    collection = db_conn[DB_NAME][COLLECTION_NAME]
+    limit = _page_limit(limit)
+    
+    if match in ("prefix", "fuzzy") and not await party_directory.ensure_fresh_async(collection):
+        return _DIRECTORY_LOADING
+    keys, query = _party_query(party, match, cursor)
+    if query is None:
+        return keys
+    
+    results = await collection.find(
+        query, {"uuid": 1, "created_at": 1, "_id": 0}
+    ).sort(PARTY_SORT).limit(limit + 1).to_list(None)
+    return _party_page(results, keys or ([party] if results else []), limit)
+
+_DIRECTORY_LOADING = "Error: the party directory is still loading. Retry shortly, or use match='exact'."
+
+def _page_limit(limit):
+    # At least one result, and no more than fit in the tool's output budget
+    return max(1, min(limit or 50, MAX_PARTY_RESULTS, max_page_size("find_by_party")))
+
+def _party_query(party, match, cursor):
+    # (keys, filter) for the party_keys query, or (finished result, None) when there is nothing to run
+    if match in ("prefix", "fuzzy"):
+        keys = party_directory.prefix(party) if match == "prefix" else party_directory.fuzzy(party)
+    else:
+        keys = query_keys(party)
     
-    # Extract and return the UUIDs of the conversations
-    return [result.id for result in results[0]]  # Assuming results[0] contains the first search result
+    if not keys and not (match == "exact" and LEGACY_FALLBACK):
+        logger.info(f"No party keys found for {party!r} (match: {match})")
+        return {"uuids": [], "matched_parties": [], "next_cursor": None}, None
+    
+    query = {"party_keys": {"$in": keys}}
+    if match == "exact" and LEGACY_FALLBACK:
+        query = {"$or": [query] + _legacy_query(party, keys)}
+    if cursor:
+        try:
+            _, last_value, last_uuid = decode_cursor(cursor)
+        except ValueError:
+            return f"Error: Invalid cursor: {cursor}. Start again without a cursor.", None
+        query = {"$and": [query, keyset_filter(CREATED_AT_TYPES, "newest", last_value, last_uuid)]}
+    return keys, query
+
+def _party_page(results, keys, limit):
+    has_more = len(results) > limit
+    results = results[:limit]
+    next_cursor = (
+        encode_cursor("newest", results[-1].get("created_at"), results[-1]["uuid"]) if has_more else None
+    )
+    logger.info(f"find_by_party matched {len(results)} conversations for keys {keys} (more: {has_more})")
+    
+    return {
+        "uuids": [doc["uuid"] for doc in results],
+        "matched_parties": keys,
+        "next_cursor": next_cursor
+    }
@@ -0,0 +1,417 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from tracing import span
+from config import config
+import threading
+import itertools
+import requests
+import logging
+import random
+import openai
+import heapq
+import time
+import re
+
+logger = logging.getLogger("llm_api")
+
+# Priorities, lowest first: interactive chat is served before batch work
+INTERACTIVE = 0
+BATCH = 10
+
+# Per provider: requests and tokens per minute (0 for no limit) and concurrent calls.
+# OpenAI limits are learned from x-ratelimit-* response headers; these are the starting values.
+DEFAULT_RATE_LIMITS = {
+    "openai": {"rpm": 500, "tpm": 200000, "max_concurrency": 16},
+    "ollama": {"rpm": 0, "tpm": 0, "max_concurrency": 4},
+}
+RATE_LIMITS = {
+    provider: {**limits, **dict(config.get("rate_limits", {}).get(provider, {}))}
+    for provider, limits in DEFAULT_RATE_LIMITS.items()
+}
+RATE_LIMIT_MAX_RETRIES = int(config.get("rate_limit_max_retries", 4))
+RATE_LIMIT_BASE_DELAY = float(config.get("rate_limit_base_delay", 0.5))
+RATE_LIMIT_MAX_DELAY = float(config.get("rate_limit_max_delay", 20))
+# Completion tokens reserved for a chat call before its usage is known
+COMPLETION_TOKEN_ESTIMATE = int(config.get("rate_limit_completion_tokens", 500))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+_priority = ContextVar("scheduling_priority", default=INTERACTIVE)
+
+@contextmanager
+def scheduling_priority(priority):
+    """
+    Schedule the provider calls made in this block (and in executor work
+    started from it with a copied context) at the given priority.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def parse_reset(value):
+    """
+    Seconds in an x-ratelimit-reset-* value such as "1s", "6m0s" or "20ms".
+    """
+    if not value:
+        return None
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+class TokenBucket:
+    """
+    Refills continuously at limit per minute up to limit; a limit of 0 never throttles.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until amount can be taken.
+        """
+        if not self.capacity:
+            return 0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0 if self.tokens >= amount else (amount - self.tokens) * 60 / self.capacity
+
+    def take(self, amount, now):
+        if self.capacity:
+            self._refill(now)
+            self.tokens -= min(amount, self.capacity)
+
+    def sync(self, limit, remaining, now):
+        """
+        Adopt the provider's view of this limit from response headers.
+        """
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.tokens = remaining
+            self.updated = now
+
+def _int_header(headers, name):
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _retry_after(error):
+    # Server-requested delay from a failed response, in seconds
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("retry-after"):
+        return parse_reset(headers["retry-after"])
+    # Otherwise wait for whichever exhausted limit resets
+    resets = [parse_reset(headers.get(f"x-ratelimit-reset-{kind}")) for kind in ("requests", "tokens")
+              if _int_header(headers, f"x-ratelimit-remaining-{kind}") == 0]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def _status(error):
+    response = getattr(error, "response", None)
+    return getattr(error, "status_code", None) or getattr(response, "status_code", None)
+
+def is_retryable(error):
+    """
+    Whether a provider error is worth retrying: rate limits, overload, timeouts and dropped connections.
+    """
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError,
+                          requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError)):
+        return True
+    return _status(error) in RETRYABLE_STATUS
+
+class RateLimitScheduler:
+    """
+    Shared admission control for one provider's API calls.
+
+    Calls wait in a priority queue until the requests-per-minute and
+    tokens-per-minute buckets and the concurrency limit allow them, so
+    interactive chat goes ahead of batch embeddings. The buckets follow the
+    provider's x-ratelimit-* headers. Retryable failures are retried with
+    jittered exponential backoff, or after Retry-After; a 429 pauses every
+    caller, not just the one that hit it. Streamed calls go through stream(),
+    which holds their concurrency slot until the stream ends.
+    """
+
+    def __init__(self, name, rpm=0, tpm=0, max_concurrency=8, max_retries=RATE_LIMIT_MAX_RETRIES,
+                 base_delay=RATE_LIMIT_BASE_DELAY, max_delay=RATE_LIMIT_MAX_DELAY):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._paused_until = 0
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "failures": 0,
+                      "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def call(self, function, *args, tokens=1, priority=None, **kwargs):
+        """
+        Run a provider call once the limits allow it, retrying transient failures.
+
+        If the function returns a raw OpenAI response (from with_raw_response),
+        its rate limit headers are read and the parsed result is returned.
+
+        Args:
+            function (callable): The API call
+            tokens (int): Estimated tokens the call consumes
+            priority (int): INTERACTIVE or BATCH; defaults to the scheduling_priority in effect
+
+        Returns:
+            The call's result
+
+        Raises:
+            The last error once retries are exhausted, or any non-retryable error
+        """
+        priority = _priority.get() if priority is None else priority
+        attempt = 0
+        while True:
+            self._acquire(priority, tokens)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                self._release()
+                if not self._wait_to_retry(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            self._release()
+            return self._parse(result)
+
+    def stream(self, function, *args, tokens=1, priority=None, **kwargs):
+        """
+        call() for a streamed response.
+
+        The concurrency slot is held until the stream is exhausted, fails or
+        is closed, not only while it is opened. A retryable error before the
+        first chunk reopens the stream, within the same retry budget; once a
+        chunk has reached the caller the error is raised, since a retry would
+        repeat it.
+
+        Returns:
+            generator: The stream's chunks
+
+        Raises:
+            The last error once retries are exhausted, or any non-retryable error
+        """
+        priority = _priority.get() if priority is None else priority
+        attempts = [0]
+
+        def open_stream():
+            while True:
+                self._acquire(priority, tokens)
+                try:
+                    # Left holding the slot, which the stream's generator releases
+                    return self._parse(function(*args, **kwargs))
+                except Exception as e:
+                    self._release()
+                    if not self._wait_to_retry(e, attempts[0]):
+                        raise
+                    attempts[0] += 1
+
+        # Opened here, so errors on the request itself are raised to the caller straight away
+        stream = self._iterate_stream(open_stream(), open_stream, attempts)
+        # Started up to its try block, so even a stream that is never read releases the slot when closed
+        next(stream)
+        return stream
+
+    def _iterate_stream(self, chunks, open_stream, attempts):
+        emitted = False
+        try:
+            yield
+            while True:
+                try:
+                    for chunk in chunks:
+                        emitted = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    _close(chunks)
+                    chunks = None
+                    self._release()
+                    if emitted:
+                        with self._cond:
+                            self.stats["failures"] += 1
+                        raise
+                    if not self._wait_to_retry(e, attempts[0]):
+                        raise
+                    attempts[0] += 1
+                    chunks = open_stream()
+        finally:
+            if chunks is not None:
+                _close(chunks)
+                self._release()
+
+    def _parse(self, result):
+        # A raw OpenAI response: read its rate limit headers and return the parsed result
+        if hasattr(result, "headers") and hasattr(result, "parse"):
+            self.update_from_headers(result.headers)
+            return result.parse()
+        return result
+
+    def _wait_to_retry(self, error, attempt):
+        # Sleep before the next attempt, or return False if the error is final
+        if attempt >= self.max_retries or not is_retryable(error):
+            with self._cond:
+                self.stats["failures"] += 1
+            return False
+        delay = self._backoff(error, attempt)
+        logger.warning(f"{self.name} call failed ({type(error).__name__}: {str(error)[:200]}); "
+                       f"retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+        time.sleep(delay)
+        return True
+
+    def update_from_headers(self, headers):
+        """
+        Sync the buckets with the x-ratelimit-limit-* and x-ratelimit-remaining-* headers.
+        """
+        now = time.monotonic()
+        with self._cond:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = _int_header(headers, f"x-ratelimit-limit-{kind}")
+                remaining = _int_header(headers, f"x-ratelimit-remaining-{kind}")
+                if limit is not None or remaining is not None:
+                    bucket.sync(limit, remaining, now)
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            calls = self.stats["calls"]
+            return {
+                **{key: value for key, value in self.stats.items() if key != "wait_seconds"},
+                "queue_depth": len(self._queue),
+                "queued_interactive": sum(1 for priority, _ in self._queue if priority <= INTERACTIVE),
+                "in_flight": self._in_flight,
+                "avg_wait_ms": round(self.stats["wait_seconds"] * 1000 / calls, 1) if calls else 0,
+                "requests_available": round(self.requests.tokens) if self.requests.capacity else None,
+                "tokens_available": round(self.tokens.tokens) if self.tokens.capacity else None,
+            }
+
+    def _ready_in(self, tokens, now):
+        return max(self._paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def _acquire(self, priority, tokens):
+        with span(self.name, "queue", priority=priority) as queue_span:
+            started = time.monotonic()
+            with self._cond:
+                entry = (priority, next(self._sequence))
+                heapq.heappush(self._queue, entry)
+                try:
+                    while True:
+                        now = time.monotonic()
+                        if self._queue[0] == entry and self._in_flight < self.max_concurrency:
+                            wait = self._ready_in(tokens, now)
+                            if wait <= 0:
+                                break
+                            self._cond.wait(wait)
+                        else:
+                            self._cond.wait()
+                finally:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._cond.notify_all()
+                now = time.monotonic()
+                self.requests.take(1, now)
+                self.tokens.take(tokens, now)
+                self._in_flight += 1
+                waited = now - started
+                self.stats["calls"] += 1
+                self.stats["wait_seconds"] += waited
+                self.stats["max_wait_seconds"] = round(max(self.stats["max_wait_seconds"], waited), 3)
+            queue_span.set(queue_wait_ms=round(waited * 1000, 1))
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _backoff(self, error, attempt):
+        delay = _retry_after(error)
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers:
+            self.update_from_headers(headers)
+        with self._cond:
+            self.stats["retries"] += 1
+            if _status(error) == 429:
+                self.stats["throttled"] += 1
+                # Everyone is over the limit, not just this caller
+                self._paused_until = max(self._paused_until, time.monotonic() + (delay or self.base_delay))
+        if delay is None:
+            # Full jitter keeps retries from arriving together
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, self.max_delay)
+
+def _close(chunks):
+    # Stream objects and generators both release their connection on close()
+    close = getattr(chunks, "close", None)
+    if close:
+        close()
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(provider):
+    """
+    The shared scheduler for a provider ("openai" or "ollama").
+    """
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            limits = RATE_LIMITS.get(provider, {})
+            _schedulers[provider] = RateLimitScheduler(
+                provider,
+                rpm=int(limits.get("rpm", 0)),
+                tpm=int(limits.get("tpm", 0)),
+                max_concurrency=int(limits.get("max_concurrency", 8))
+            )
+        return _schedulers[provider]
+
+def all_stats():
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {scheduler.name: scheduler.get_stats() for scheduler in schedulers}
+
+def create_chat_completion(client, provider, prompt_tokens, **request):
+    """
+    client.chat.completions.create() through the provider's scheduler.
+
+    Args:
+        client: OpenAI-compatible client
+        provider (str): "openai" or "ollama"
+        prompt_tokens (int): Estimated prompt tokens, for the token bucket
+        **request: Arguments for create()
+
+    Returns:
+        The completion, or the chunk stream when stream=True; a stream holds
+        its concurrency slot until it is exhausted or closed
+    """
+    completions = client.chat.completions
+    # The raw response carries the rate limit headers; Ollama's client has none
+    create = completions.with_raw_response.create if hasattr(completions, "with_raw_response") else completions.create
+    scheduler = get_scheduler(provider)
+    run = scheduler.stream if request.get("stream") else scheduler.call
+    return run(create, tokens=prompt_tokens + COMPLETION_TOKEN_ESTIMATE, **request)
@@ -0,0 +1,127 @@
+from ollama_provider import get_ollama_client
+from agent_engine import AgentEngine
+from data_layer import create_mongo_client
+import background_services
+from openai import OpenAI
+from config import config
+import streamlit as st
+import threading
+import logging
+import time
+
+logger = logging.getLogger("llm_api")
+
+# Seconds before a model list is refreshed in the background
+MODEL_LIST_TTL = int(config.get("model_list_ttl", 300))
+# Seconds before retrying a model list whose last fetch failed
+MODEL_LIST_RETRY = 30
+
+OPENAI_MODEL_PREFIXES = ('gpt-3.5', 'gpt-4', 'o1', 'o3')
+
+class ModelList:
+    """
+    A provider's model names, fetched once and then refreshed in the background.
+
+    Only the first get() waits on the network. After that, get() returns the
+    cached names at once and, when they are older than the TTL, starts a
+    single refresh thread whose result the next rerun picks up.
+    """
+
+    def __init__(self, fetch, ttl=MODEL_LIST_TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.models = None
+        self.error = None
+        self.fetched_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns:
+            tuple: (models, error); models is None until a fetch succeeds
+        """
+        if self.fetched_at is None:
+            self.refresh()
+        elif time.monotonic() - self.fetched_at > (MODEL_LIST_RETRY if self.error else self.ttl):
+            self._refresh_in_background()
+        return self.models, self.error
+
+    def refresh(self):
+        """
+        Fetch the model names now. A failed fetch keeps the previous names.
+        """
+        try:
+            models = self.fetch()
+            error = None
+        except Exception as e:
+            logger.warning(f"Could not fetch model list: {str(e)}")
+            models, error = self.models, str(e)
+        with self._lock:
+            self.models = models
+            self.error = error
+            self.fetched_at = time.monotonic()
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="model-list-refresh", daemon=True).start()
+
+@st.cache_resource(show_spinner=False)
+def get_mongo_client(uri):
+    """
+    MongoClient shared by every session; it pools connections and is thread-safe.
+    """
+    return create_mongo_client(uri)
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key):
+    """
+    OpenAI client shared by every session, so its HTTP connection pool survives reruns.
+
+    Retries are left to the rate limit scheduler.
+    """
+    return OpenAI(api_key=api_key, max_retries=0)
+
+def get_llm_client(provider):
+    """
+    Shared chat client for a provider: "openai" or "ollama".
+    """
+    if provider == "ollama":
+        return get_ollama_client(config["ollama_host"])
+    return get_openai_client(config["openai_api_key"])
+
+@st.cache_resource(show_spinner=False)
+def get_model_list(provider):
+    """
+    Shared ModelList for a provider.
+    """
+    client = get_llm_client(provider)
+    if provider == "ollama":
+        return ModelList(lambda: sorted(model.id for model in client.models.list()))
+    return ModelList(lambda: sorted(
+        model.id for model in client.models.list()
+        if model.id.startswith(OPENAI_MODEL_PREFIXES) and 'instruct' not in model.id
+    ))
+
+@st.cache_resource(show_spinner=False)
+def get_agent_engine(_db_conn):
+    """
+    Agent engine shared by every session; conversation state lives on each Session.
+    """
+    return AgentEngine(_db_conn)
+
+@st.cache_resource(show_spinner=False)
+def start_background_services(_db_conn):
+    """
+    Start the once-per-process background work.
+
+    This covers index bootstrap, tool cache invalidation, the first party
+    directory load and the Milvus connection and collection load. None of it
+    blocks the first render.
+    """
+    background_services.start(_db_conn)
+    return True
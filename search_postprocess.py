@@ -0,0 +1,102 @@
+from config import config
+import numpy as np
+
+# Candidates fetched per returned result, so grouping still leaves enough conversations
+SEARCH_OVERFETCH_FACTOR = int(config.get("search_overfetch_factor", 4))
+# Trade-off between relevance (1.0) and diversity (0.0) when picking conversations
+SEARCH_MMR_LAMBDA = float(config.get("search_mmr_lambda", 0.7))
+# Weight of each further matching chunk in a conversation's aggregate score
+SEARCH_GROUP_DECAY = float(config.get("search_group_decay", 0.5))
+
+def relevance(scores, metric="L2"):
+    """
+    Map raw search scores to relevance in [0, 1], higher is better.
+
+    L2 scores are distances and IP scores similarities; both are min-max
+    scaled over the candidate set.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    similarities = -scores if metric.upper() == "L2" else scores
+    spread = similarities.max() - similarities.min()
+    if spread <= 0:
+        return np.ones_like(similarities)
+    return (similarities - similarities.min()) / spread
+
+def mmr_order(vectors, relevances, limit, mmr_lambda=SEARCH_MMR_LAMBDA):
+    """
+    Pick up to limit items by maximal marginal relevance.
+
+    Each step takes the item with the best trade-off between its relevance
+    and its cosine similarity to the items already picked.
+
+    Args:
+        vectors (np.ndarray): One vector per item
+        relevances (np.ndarray): Relevance of each item in [0, 1]
+        limit (int): Number of items to pick
+
+    Returns:
+        list: Indexes of the picked items, in pick order
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms > 0, norms, 1)
+    similarity = unit @ unit.T
+
+    picked = []
+    available = np.ones(len(vectors), dtype=bool)
+    closest = np.zeros(len(vectors), dtype=np.float32)
+    for _ in range(min(limit, len(vectors))):
+        scores = np.where(available, mmr_lambda * relevances - (1 - mmr_lambda) * closest, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        closest = np.maximum(closest, similarity[best])
+    return picked
+
+def group_by_conversation(hits, embeddings, limit, metric="L2", mmr_lambda=SEARCH_MMR_LAMBDA,
+                          decay=SEARCH_GROUP_DECAY):
+    """
+    Collapse chunk hits into one entry per conversation and diversify them.
+
+    Each conversation is represented by its best chunk. Its aggregate score
+    adds the relevance of its other matching chunks with geometrically
+    decaying weights. Conversations are then picked by MMR over the best
+    chunks' embeddings, or by aggregate score when embeddings are missing.
+
+    Args:
+        hits (list): Formatted hits (dicts with id, score, vcon_uuid, ...), best first
+        embeddings (list): Embedding of each hit, or None where unavailable
+        limit (int): Number of conversations to return
+
+    Returns:
+        list: One dict per conversation: the best chunk's fields plus
+        aggregate_score and matches (number of chunks that matched)
+    """
+    if not hits:
+        return []
+    relevances = relevance([hit["score"] for hit in hits], metric)
+
+    groups = {}
+    for index, hit in enumerate(hits):
+        groups.setdefault(hit["vcon_uuid"], []).append(index)
+
+    entries = []
+    representatives = []
+    aggregates = []
+    for indexes in groups.values():
+        indexes = sorted(indexes, key=lambda index: -relevances[index])
+        weights = decay ** np.arange(len(indexes))
+        aggregate = float(np.dot(relevances[indexes], weights))
+        best = indexes[0]
+        entries.append(dict(hits[best], aggregate_score=round(aggregate, 4), matches=len(indexes)))
+        representatives.append(best)
+        aggregates.append(aggregate)
+
+    aggregates = np.asarray(aggregates, dtype=np.float32)
+    if aggregates.max() > 0:
+        aggregates = aggregates / aggregates.max()
+    if all(embeddings[index] is not None for index in representatives):
+        order = mmr_order([embeddings[index] for index in representatives], aggregates, limit, mmr_lambda)
+    else:
+        order = list(np.argsort(-aggregates, kind="stable")[:limit])
+    return [entries[index] for index in order]
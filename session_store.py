@@ -0,0 +1,126 @@
+from agent_engine import Session
+from pymongo.errors import DuplicateKeyError
+from config import config
+import threading
+import datetime
+import logging
+
+logger = logging.getLogger("llm_api")
+
+# "memory" keeps sessions in this process; "mongo" shares them between server processes
+SESSION_STORE = config.get("session_store", "memory")
+SESSION_COLLECTION = config.get("session_collection", "agent_sessions")
+# Sessions untouched for this long are dropped
+SESSION_TTL_SECONDS = int(config.get("session_ttl_seconds", 7 * 24 * 3600))
+
+class SessionConflict(Exception):
+    """
+    Raised by put() when the stored session changed after this copy was loaded.
+    """
+
+class MemorySessionStore:
+    """
+    Sessions held in this process, for a single server or the Streamlit app.
+    """
+
+    def __init__(self, ttl_seconds=SESSION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._sessions = {}
+        self._touched = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """
+        The session, or None if it does not exist or has expired.
+        """
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._touched[session_id] = datetime.datetime.now(datetime.timezone.utc)
+            return session
+
+    def put(self, session):
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._touched[session.session_id] = datetime.datetime.now(datetime.timezone.utc)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._touched.pop(session_id, None)
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _expire(self):
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.ttl_seconds)
+        for session_id in [session_id for session_id, touched in self._touched.items() if touched < cutoff]:
+            del self._touched[session_id]
+            del self._sessions[session_id]
+
+class MongoSessionStore:
+    """
+    Sessions saved as documents, so any server process behind a load
+    balancer can continue any conversation.
+
+    A TTL index on updated_at lets MongoDB drop idle sessions. Each save
+    increments a version and only succeeds against the version the session
+    was loaded at, so two processes running turns on one session cannot
+    silently overwrite each other; the later save raises SessionConflict.
+    """
+
+    def __init__(self, db_conn, collection_name=SESSION_COLLECTION, ttl_seconds=SESSION_TTL_SECONDS):
+        self.collection = db_conn[config["db_name"]][collection_name]
+        self.collection.create_index("updated_at", expireAfterSeconds=ttl_seconds)
+
+    def get(self, session_id):
+        doc = self.collection.find_one({"_id": session_id})
+        if doc is None:
+            return None
+        session = Session.from_dict(doc["session"])
+        session.version = doc.get("version", 0)
+        return session
+
+    def put(self, session):
+        """
+        Save the session if nobody else saved it since it was loaded.
+
+        Raises:
+            SessionConflict: If the stored session is newer than this copy
+        """
+        doc = {
+            "session": session.to_dict(),
+            "updated_at": datetime.datetime.now(datetime.timezone.utc),
+            "version": session.version + 1
+        }
+        if session.version == 0:
+            # A new session, or one saved before versions were kept; if another
+            # process saved it meanwhile the upsert's insert hits the duplicate _id
+            try:
+                self.collection.replace_one({"_id": session.session_id, "version": {"$exists": False}}, doc, upsert=True)
+            except DuplicateKeyError as e:
+                raise SessionConflict(f"Session {session.session_id} already exists") from e
+        elif self.collection.replace_one({"_id": session.session_id, "version": session.version}, doc).matched_count == 0:
+            raise SessionConflict(f"Session {session.session_id} was changed or deleted by another turn")
+        session.version += 1
+
+    def delete(self, session_id):
+        return self.collection.delete_one({"_id": session_id}).deleted_count > 0
+
+    def __len__(self):
+        return self.collection.estimated_document_count()
+
+def get_session_store(db_conn, kind=SESSION_STORE):
+    """
+    The configured session store.
+
+    Args:
+        db_conn: Database connection, used by the mongo store
+        kind (str): "memory" or "mongo"
+    """
+    if kind == "mongo":
+        return MongoSessionStore(db_conn)
+    if kind != "memory":
+        raise ValueError(f"Unknown session store: {kind}")
+    return MemorySessionStore()
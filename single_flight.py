@@ -0,0 +1,158 @@
+from config import config
+import threading
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("llm_api")
+
+# Seconds a caller waits for an identical in-flight call before giving up, per group
+DEFAULT_SINGLE_FLIGHT_TIMEOUTS = {
+    "tool": 60,
+    "embeddings": 30,
+    "milvus_search": 30,
+}
+SINGLE_FLIGHT_TIMEOUTS = {**DEFAULT_SINGLE_FLIGHT_TIMEOUTS, **dict(config.get("single_flight_timeouts", {}))}
+
+class SingleFlightTimeout(TimeoutError):
+    """
+    Raised to a caller that waited too long for an identical in-flight call.
+    """
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.started = time.monotonic()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls into one execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    runs wait for it and get the same result, or the same exception. Nothing
+    is kept once the call finishes, so this only removes duplicate work that
+    overlaps in time; the caches handle repeats after that.
+
+    A waiting caller gives up with SingleFlightTimeout after the group's
+    timeout. A call running longer than that is no longer joined, so one
+    stuck request cannot hold every later caller. Shared results must be
+    treated as read-only.
+    """
+
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout if timeout is not None else SINGLE_FLIGHT_TIMEOUTS.get(name, 30)
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"executions": 0, "shared": 0, "timeouts": 0, "errors": 0}
+
+    def _joinable(self, call):
+        return call is not None and time.monotonic() - call.started < self.timeout
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) unless an identical call is already running.
+
+        Args:
+            key: Hashable key of the normalized call
+            function (callable): The backend call
+
+        Returns:
+            The result of the one execution shared by every caller with this key
+
+        Raises:
+            The execution's exception, or SingleFlightTimeout to a waiting caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = not self._joinable(call)
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["executions"] += 1
+            else:
+                call.waiters += 1
+                self.stats["shared"] += 1
+
+        if leader:
+            try:
+                call.result = function(*args, **kwargs)
+                return call.result
+            except BaseException as e:
+                call.error = e
+                with self._lock:
+                    self.stats["errors"] += 1
+                raise
+            finally:
+                with self._lock:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+                call.done.set()
+                if call.waiters:
+                    logger.debug(f"{self.name} single-flight shared one execution with {call.waiters} callers")
+
+        if not call.done.wait(self.timeout - (time.monotonic() - call.started)):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise SingleFlightTimeout(f"Timed out waiting for an in-flight {self.name} call")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def do_async(self, key, function, *args, **kwargs):
+        """
+        do() for coroutine functions: waiting callers await the running call.
+
+        Calls are coalesced per event loop.
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        with self._lock:
+            entry = self._async_calls.get(loop_key)
+            leader = entry is None or time.monotonic() - entry[1] >= self.timeout
+            if leader:
+                entry = self._async_calls[loop_key] = (loop.create_future(), time.monotonic())
+                self.stats["executions"] += 1
+            else:
+                self.stats["shared"] += 1
+        future, started = entry
+
+        if leader:
+            try:
+                result = await function(*args, **kwargs)
+                future.set_result(result)
+                return result
+            except BaseException as e:
+                with self._lock:
+                    self.stats["errors"] += 1
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Mark it retrieved so an unshared failure is not reported twice
+                    future.exception()
+                raise
+            finally:
+                with self._lock:
+                    if self._async_calls.get(loop_key) is entry:
+                        del self._async_calls[loop_key]
+
+        try:
+            # Shielded so a waiter timing out does not cancel the leader's call
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout - (time.monotonic() - started))
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise SingleFlightTimeout(f"Timed out waiting for an in-flight {self.name} call") from None
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, "in_flight": len(self._calls) + len(self._async_calls)}
+
+# One group per backend request type
+tool_flight = SingleFlight("tool")
+embedding_flight = SingleFlight("embeddings")
+search_flight = SingleFlight("milvus_search")
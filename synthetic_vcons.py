@@ -0,0 +1,241 @@
+from party_directory import vcon_party_keys
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient
+from config import config
+import argparse
+import logging
+import random
+import uuid
+import time
+import sys
+
+logger = logging.getLogger("llm_api")
+
+FIRST_NAMES = ["James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+               "William", "Barbara", "Richard", "Susan", "José", "Jessica", "Thomas", "Sarah", "Chen", "Karen",
+               "Ahmed", "Nancy", "Daniel", "Lisa", "Matthew", "Betty", "Anthony", "Margaret", "Mark", "Zoë"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+              "Hernández", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+              "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Ramirez", "O'Brien", "Nguyen"]
+EMAIL_DOMAINS = ["example.com", "mail.example.org", "corp.example.net"]
+
+# Call topics: (summary template, phrases that appear in the transcript)
+TOPICS = [
+    ("Customer called about an unexpected charge on their bill.",
+     ["I see a charge I don't recognize", "my bill is higher than last month", "can you explain this fee",
+      "I'll issue a credit to your account", "the charge was for the premium plan"]),
+    ("Customer requested a refund for a cancelled order.",
+     ["I cancelled the order last week", "I'd like my money back", "the refund takes five to seven business days",
+      "I've processed the refund", "you'll get a confirmation email"]),
+    ("Customer reported that the service was down.",
+     ["nothing is loading", "the service has been down since this morning", "we're aware of an outage",
+      "please restart your router", "it should be working again now"]),
+    ("Customer wanted to upgrade their plan.",
+     ["I'd like more data", "what plans do you have", "the unlimited plan is fifty dollars",
+      "I'll switch you over today", "the change takes effect next cycle"]),
+    ("Customer complained about a late delivery.",
+     ["my package hasn't arrived", "it was supposed to come on Monday", "the tracking number shows a delay",
+      "I'm sorry about the wait", "we'll send it by express shipping"]),
+    ("Customer asked to update their address.",
+     ["I moved recently", "please update my address", "can you confirm the new zip code",
+      "your address has been updated", "future bills will go to the new address"]),
+]
+FILLER = ["okay", "thank you", "let me check", "one moment please", "is there anything else", "I understand",
+          "that makes sense", "sure", "great", "have a nice day"]
+
+# Relative call volume by hour of day (UTC) and by weekday (Monday first)
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 4, 8, 14, 18, 20, 20, 18, 20, 20, 18, 16, 12, 8, 6, 4, 3, 2, 1]
+WEEKDAY_WEIGHTS = [10, 10, 10, 10, 9, 4, 3]
+
+def _tel(rng, number):
+    # Real data writes the same number in many formats
+    digits = f"{number:010d}"
+    formats = [
+        f"+1{digits}",
+        f"+1 {digits[:3]}-{digits[3:6]}-{digits[6:]}",
+        f"({digits[:3]}) {digits[3:6]}-{digits[6:]}",
+        digits,
+        f"tel:+1{digits}",
+    ]
+    return rng.choice(formats)
+
+class SyntheticVconGenerator:
+    """
+    Deterministic generator of realistic vCons.
+
+    Customers follow a skewed popularity distribution (a few call very
+    often), are written with varying phone formats, and created_at follows
+    business hours and weekdays. Output only depends on the seed, so two
+    runs with the same arguments produce the same documents.
+    """
+
+    def __init__(self, seed=0, customers=1000, agents=50, start=None, end=None, party_keys=True):
+        self.rng = random.Random(seed)
+        self.customers = customers
+        self.agents = agents
+        self.end = end or datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.start = start or self.end - timedelta(days=365)
+        self.party_keys = party_keys
+        self._days = max(1, (self.end - self.start).days)
+
+    def customer(self, index):
+        """
+        Customer party for an index into the customer pool.
+        """
+        # Identity depends only on the index so repeat callers match
+        rng = random.Random(index)
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        party = {"tel": _tel(self.rng, 2_000_000_000 + index * 7919 % 8_000_000_000), "name": f"{first} {last}"}
+        if rng.random() < 0.4:
+            party["mailto"] = f"{first}.{last}{index}@{rng.choice(EMAIL_DOMAINS)}".lower().replace("'", "")
+        return party
+
+    def agent(self, index):
+        return {"name": f"Agent {index:03d}", "mailto": f"agent{index:03d}@support.example.com", "role": "agent"}
+
+    def pick_customer(self):
+        # Cubing a uniform draw skews toward low indexes: heavy repeat callers
+        return int(self.customers * self.rng.random() ** 3)
+
+    def created_at(self):
+        while True:
+            day = self.start + timedelta(days=self.rng.randrange(self._days))
+            if self.rng.random() * 10 < WEEKDAY_WEIGHTS[day.weekday()]:
+                break
+        hour = self.rng.choices(range(24), weights=HOUR_WEIGHTS)[0]
+        return day.replace(hour=hour, minute=self.rng.randrange(60), second=self.rng.randrange(60), microsecond=0)
+
+    def transcript(self, phrases, duration):
+        words = max(20, min(duration // 2, 1500))
+        sentences = []
+        length = 0
+        while length < words:
+            sentence = self.rng.choice(phrases) if self.rng.random() < 0.5 else self.rng.choice(FILLER)
+            speaker = "Agent" if len(sentences) % 2 == 0 else "Customer"
+            sentences.append(f"{speaker}: {sentence}.")
+            length += len(sentence.split()) + 1
+        return " ".join(sentences)
+
+    def vcon(self, date_type="string"):
+        """
+        One vCon document.
+
+        Args:
+            date_type (str): Store created_at as an ISO "string" or a BSON "date"
+        """
+        customer_index = self.pick_customer()
+        parties = [self.customer(customer_index), self.agent(self.rng.randrange(self.agents))]
+        created_at = self.created_at()
+        summary, phrases = self.rng.choice(TOPICS)
+
+        dialog = []
+        analysis = []
+        start = created_at
+        for _ in range(self.rng.choice([1, 1, 1, 2, 3])):
+            if self.rng.random() < 0.8:
+                duration = int(self.rng.lognormvariate(5.5, 0.8))
+                dialog.append({
+                    "type": "recording",
+                    "start": start.isoformat(),
+                    "duration": duration,
+                    "parties": [0, 1],
+                    "mimetype": "audio/x-wav",
+                    "url": f"https://recordings.example.com/{uuid.UUID(int=self.rng.getrandbits(128))}.wav"
+                })
+                analysis.append({
+                    "type": "transcript",
+                    "dialog": len(dialog) - 1,
+                    "vendor": "synthetic",
+                    "encoding": "none",
+                    "body": self.transcript(phrases, duration)
+                })
+            else:
+                duration = self.rng.randrange(30, 600)
+                dialog.append({
+                    "type": "text",
+                    "start": start.isoformat(),
+                    "parties": [0],
+                    "mimetype": "text/plain",
+                    "body": self.rng.choice(phrases)
+                })
+            start += timedelta(seconds=duration + self.rng.randrange(600))
+        analysis.append({"type": "summary", "dialog": 0, "vendor": "synthetic", "encoding": "none", "body": summary})
+
+        vcon = {
+            "vcon": "0.0.1",
+            "uuid": str(uuid.UUID(int=self.rng.getrandbits(128), version=4)),
+            "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00") if date_type == "string" else created_at,
+            "parties": parties,
+            "dialog": dialog,
+            "analysis": analysis,
+            "attachments": []
+        }
+        if self.party_keys:
+            vcon["party_keys"] = vcon_party_keys(vcon)
+        return vcon
+
+    def generate(self, count, date_type="string"):
+        """
+        Yield count vCons, one at a time, so any size fits in memory.
+        """
+        for _ in range(count):
+            yield self.vcon(date_type)
+
+def load_vcons(collection, generator, count, batch_size=1000, date_type="string", on_batch=None):
+    """
+    Insert generated vCons into a collection in unordered bulk batches.
+
+    Args:
+        collection: Target MongoDB (or mongomock) collection
+        generator (SyntheticVconGenerator): Source of vCons
+        count (int): Number of vCons to insert
+        on_batch (callable): Called with each inserted batch
+
+    Returns:
+        int: Number of vCons inserted
+    """
+    inserted = 0
+    batch = []
+    started = time.monotonic()
+    for vcon in generator.generate(count, date_type):
+        batch.append(vcon)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            inserted += len(batch)
+            if on_batch:
+                on_batch(batch)
+            batch = []
+            if inserted % (batch_size * 100) == 0:
+                logger.info(f"Inserted {inserted} vCons ({inserted / (time.monotonic() - started):.0f}/sec)")
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        inserted += len(batch)
+        if on_batch:
+            on_batch(batch)
+    return inserted
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load synthetic vCons into MongoDB")
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--customers", type=int, help="Size of the customer pool (default count / 20)")
+    parser.add_argument("--mongo-uri", default=config["mongo_uri"])
+    parser.add_argument("--db", default="vcon_benchmark", help="Target database (not the app's database by default)")
+    parser.add_argument("--collection", default=config["collection_name"])
+    parser.add_argument("--date-type", choices=["string", "date"], default="string")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--append", action="store_true", help="Allow loading into a non-empty collection")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    collection = MongoClient(args.mongo_uri)[args.db][args.collection]
+    if not args.append and collection.estimated_document_count():
+        logger.error(f"{args.db}.{args.collection} is not empty; pass --append to add to it")
+        return 1
+    generator = SyntheticVconGenerator(seed=args.seed, customers=args.customers or max(100, args.count // 20))
+    inserted = load_vcons(collection, generator, args.count, args.batch_size, args.date_type)
+    logger.info(f"Inserted {inserted} synthetic vCons into {args.db}.{args.collection}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
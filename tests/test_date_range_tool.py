@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+from date_range_tool import (
+    find_by_date_range, encode_cursor, decode_cursor, keyset_filter, _range_filters,
+    DB_NAME, COLLECTION_NAME
+)
+import unittest
+import mongomock
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip_keeps_the_value_type(self):
+        for value in ("2024-01-02T10:00:00Z", utc(2024, 1, 3, 4, 5, 6)):
+            self.assertEqual(decode_cursor(encode_cursor("oldest", value, "u1")), ("oldest", value, "u1"))
+
+    def test_naive_datetimes_are_encoded_as_utc(self):
+        _, value, _ = decode_cursor(encode_cursor("newest", datetime(2024, 1, 3), "u1"))
+        self.assertEqual(value, utc(2024, 1, 3))
+
+    def test_malformed_cursor_raises_value_error(self):
+        for cursor in ("not base64!", "e30=", encode_cursor("newest", "x", "u")[:-6]):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_keyset_filter_includes_the_types_still_to_come(self):
+        range_filters = _range_filters(utc(2024, 1, 1), utc(2024, 1, 31, 23, 59, 59))
+        # Newest first: dates sort after strings, so strings remain after a date cursor
+        newest = keyset_filter(range_filters, "newest", utc(2024, 1, 3), "u1")
+        self.assertEqual(len(newest["$or"]), 3)
+        self.assertEqual(newest["$or"][2], {"created_at": dict(range_filters)["string"]})
+        # Oldest first: nothing sorts after a date
+        self.assertEqual(len(keyset_filter(range_filters, "oldest", utc(2024, 1, 3), "u1")["$or"]), 2)
+        # Oldest first from a string: every date is still to come
+        oldest = keyset_filter(range_filters, "oldest", "2024-01-02T10:00:00", "u1")
+        self.assertEqual(oldest["$or"][2], {"created_at": dict(range_filters)["date"]})
+
+class FindByDateRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.db_conn = mongomock.MongoClient()
+        self.db_conn[DB_NAME][COLLECTION_NAME].insert_many([
+            {"uuid": "a", "created_at": "2024-01-01T10:00:00Z"},
+            {"uuid": "b", "created_at": "2024-01-02T10:00:00"},
+            {"uuid": "c", "created_at": "2024-01-02T10:00:00"},
+            {"uuid": "d", "created_at": utc(2024, 1, 1, 12)},
+            {"uuid": "e", "created_at": utc(2024, 1, 3)},
+            {"uuid": "f", "created_at": utc(2024, 1, 3)},
+            {"uuid": "g", "created_at": utc(2024, 2, 1)},
+            {"uuid": "h", "created_at": "2023-12-01T00:00:00"}
+        ])
+
+    def pages(self, sort):
+        page = find_by_date_range("2024-01-01", "2024-01-31", self.db_conn, limit=2, sort=sort)
+        pages = [page]
+        while page["next_cursor"]:
+            page = find_by_date_range("2024-01-01", "2024-01-31", self.db_conn, limit=2, cursor=page["next_cursor"])
+            pages.append(page)
+        return pages
+
+    def test_newest_pages_dates_then_strings(self):
+        pages = self.pages("newest")
+        self.assertEqual(pages[0]["total"], 6)
+        self.assertTrue(all("total" not in page for page in pages[1:]))
+        # Ties on created_at are broken by uuid, opposite to the created_at direction
+        self.assertEqual([page["uuids"] for page in pages], [["e", "f"], ["d", "b"], ["c", "a"]])
+
+    def test_oldest_pages_strings_then_dates(self):
+        pages = self.pages("oldest")
+        self.assertEqual([page["uuids"] for page in pages], [["a", "c"], ["b", "d"], ["f", "e"]])
+        self.assertIsNone(pages[-1]["next_cursor"])
+
+    def test_invalid_cursor_is_reported_to_the_model(self):
+        result = find_by_date_range("2024-01-01", "2024-01-31", self.db_conn, cursor="bogus")
+        self.assertTrue(result.startswith("Error: Invalid cursor"))
+
+if __name__ == "__main__":
+    unittest.main()
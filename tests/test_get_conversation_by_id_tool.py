@@ -0,0 +1,166 @@
+from unittest import mock
+from bson import encode
+from bson.raw_bson import RawBSONDocument
+import get_conversation_by_id_tool as tool
+import re
+import unittest
+import mongomock
+
+MISSING = object()
+
+def evaluate(expression, document, variables):
+    """
+    Evaluate the aggregation expressions conversation_projection() uses, as MongoDB does.
+    """
+    if isinstance(expression, str) and expression.startswith("$"):
+        if expression == "$$REMOVE":
+            return MISSING
+        path = expression[2:].split(".") if expression.startswith("$$") else [None] + expression[1:].split(".")
+        value = variables[path[0]] if path[0] is not None else document
+        for key in path[1:]:
+            value = value.get(key, MISSING) if isinstance(value, dict) else MISSING
+        return value
+    if isinstance(expression, list):
+        return [evaluate(item, document, variables) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) != 1 or not next(iter(expression)).startswith("$"):
+        # An object expression; fields that evaluate to nothing are left out
+        values = {key: evaluate(value, document, variables) for key, value in expression.items()}
+        return {key: value for key, value in values.items() if value is not MISSING}
+
+    (operator, argument), = expression.items()
+    if operator == "$map":
+        items = evaluate(argument["input"], document, variables)
+        if items is MISSING or items is None:
+            return None
+        return [evaluate(argument["in"], document, {**variables, argument["as"]: item}) for item in items]
+    if operator == "$cond":
+        condition, then, otherwise = argument
+        return evaluate(then if evaluate(condition, document, variables) else otherwise, document, variables)
+    if operator == "$regexMatch":
+        text = evaluate(argument["input"], document, variables)
+        return re.search(argument["regex"], text) is not None
+    values = evaluate(argument, document, variables)
+    if operator == "$and":
+        return all(values)
+    if operator == "$not":
+        return not values
+    if operator == "$eq":
+        return (None if values[0] is MISSING else values[0]) == values[1]
+    if operator == "$in":
+        return values[0] in values[1]
+    if operator == "$ifNull":
+        return values[1] if values[0] is MISSING or values[0] is None else values[0]
+    if operator == "$type":
+        return "missing" if values is MISSING else {str: "string", dict: "object", list: "array"}.get(type(values), "other")
+    if operator == "$strLenCP":
+        return len(values)
+    if operator in ("$toLower", "$toString"):
+        return str(values).lower() if operator == "$toLower" else str(values)
+    raise NotImplementedError(operator)
+
+class StubCollection:
+    """
+    Runs the tool's $match/$limit/$project pipeline in Python; returns raw documents when asked.
+    """
+
+    def __init__(self, documents, raw=False):
+        self.documents = documents
+        self.raw = raw
+
+    def with_options(self, codec_options):
+        return StubCollection(self.documents, raw=codec_options.document_class is RawBSONDocument)
+
+    def aggregate(self, pipeline):
+        documents = self.documents
+        for stage in pipeline:
+            (name, argument), = stage.items()
+            if name == "$match":
+                documents = [document for document in documents if document["uuid"] in argument["uuid"]["$in"]]
+            elif name == "$limit":
+                documents = documents[:argument]
+            elif name == "$project":
+                documents = [self._project(document, argument) for document in documents]
+        return [RawBSONDocument(encode(document)) if self.raw else document for document in documents]
+
+    def _project(self, document, projection):
+        projected = {}
+        for key, value in projection.items():
+            if value == 1:
+                if key in document:
+                    projected[key] = document[key]
+            elif value != 0:
+                projected[key] = evaluate(value, document, {})
+        return projected
+
+VCON = {
+    "uuid": "v1",
+    "created_at": "2024-01-01T00:00:00",
+    "subject": "Billing",
+    "mailbox": "not a vCon field",
+    "parties": [{"tel": "+15555550100", "name": "Jane Doe", "meta": {"crm_id": 7}}],
+    "dialog": [
+        {"type": "text", "body": "Hello there", "parties": [0]},
+        {"type": "recording", "body": "QUJDRA==", "encoding": "base64", "mimetype": "audio/wav"}
+    ],
+    "analysis": [
+        {"type": "summary", "body": "Asked about a bill", "vendor": "v"},
+        {"type": "transcript", "body": "Hello there, I have a question"}
+    ],
+    "attachments": [{"type": "invoice", "body": "PDF bytes", "encoding": "base64url"}]
+}
+
+class ConversationProjectionTest(unittest.TestCase):
+    def setUp(self):
+        for name, value in (("_raw_documents_supported", True), ("_projection_supported", True)):
+            patcher = mock.patch.object(tool, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.db_conn = {tool.DB_NAME: {tool.COLLECTION_NAME: StubCollection([VCON])}}
+
+    def test_default_sections_keep_parties_and_summary(self):
+        vcon, = tool.get_conversation_by_id("v1", self.db_conn)
+        self.assertEqual(set(vcon), {"uuid", "created_at", "subject", "parties", "dialog", "analysis", "attachments"})
+        self.assertEqual(vcon["parties"], [{"tel": "+15555550100", "name": "Jane Doe"}])
+        self.assertEqual(vcon["dialog"], [
+            {"type": "text", "parties": [0], "body": {"omitted": True, "chars": 11}},
+            {"type": "recording", "mimetype": "audio/wav", "body": {"omitted": True, "chars": 8}}
+        ])
+        self.assertEqual([item["body"] for item in vcon["analysis"]], ["Asked about a bill", {"omitted": True, "chars": 30}])
+        self.assertEqual(vcon["attachments"], [{"type": "invoice", "encoding": "base64url", "body": {"omitted": True, "chars": 9}}])
+
+    def test_requested_sections_are_returned_in_full_except_encoded_bodies(self):
+        vcon, = tool.get_conversation_by_id(["v1"], self.db_conn, sections=["dialog", "transcript", "attachments"])
+        self.assertNotIn("parties", vcon)
+        self.assertEqual(vcon["dialog"][0]["body"], "Hello there")
+        self.assertEqual(vcon["dialog"][1]["body"], {"omitted": True, "chars": 8})
+        self.assertEqual([item["body"] for item in vcon["analysis"]],
+                         [{"omitted": True, "chars": 18}, "Hello there, I have a question"])
+        self.assertEqual(vcon["attachments"][0]["body"], {"omitted": True, "chars": 9})
+
+    def test_unsupported_projection_falls_back_to_whole_documents(self):
+        db_conn = mongomock.MongoClient()
+        db_conn[tool.DB_NAME][tool.COLLECTION_NAME].insert_one(dict(VCON))
+        vcon, = tool.get_conversation_by_id(["v1"], db_conn)
+        self.assertEqual(vcon["dialog"][0]["body"], "Hello there")
+        self.assertFalse(tool._projection_supported)
+        self.assertFalse(tool._raw_documents_supported)
+
+class SizeCapTest(unittest.TestCase):
+    def test_small_documents_are_decoded_whole(self):
+        raw = RawBSONDocument(encode(VCON))
+        self.assertEqual(tool.decode_conversation(raw), VCON)
+
+    def test_large_documents_keep_the_fields_that_fit_in_priority_order(self):
+        vcon = {**VCON, "dialog": [{"type": "text", "body": "x" * 5000}]}
+        max_bytes = len(encode({key: vcon[key] for key in ("uuid", "created_at", "subject", "parties", "analysis")})) + 100
+        for document in (RawBSONDocument(encode(vcon)), vcon):
+            capped = tool.decode_conversation(document, max_bytes=max_bytes)
+            for key in ("uuid", "created_at", "subject", "parties", "analysis"):
+                self.assertEqual(capped[key], vcon[key])
+            self.assertEqual(capped["dialog"], {"omitted": True, "bytes": len(encode({"dialog": vcon["dialog"]}))})
+            self.assertLessEqual(len(encode({key: value for key, value in capped.items() if key != "dialog"})), max_bytes)
+
+if __name__ == "__main__":
+    unittest.main()
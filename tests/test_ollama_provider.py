@@ -0,0 +1,116 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ollama_provider import OllamaClient, OllamaError
+from rate_limiter import is_retryable
+import threading
+import unittest
+import json
+
+class StubOllama(BaseHTTPRequestHandler):
+    """
+    Answers each request with the next queued (status, body lines) and records the request.
+    """
+
+    responses = []
+    requests = []
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.requests.append((self.path, json.loads(self.rfile.read(length))))
+        status, lines = self.responses.pop(0)
+        body = b"".join(json.dumps(line).encode() + b"\n" for line in lines)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class OllamaProviderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllama)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.client = OllamaClient(f"http://127.0.0.1:{cls.server.server_address[1]}", keep_alive="5m", timeout=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubOllama.responses.clear()
+        StubOllama.requests.clear()
+
+    def test_request_translates_tool_messages(self):
+        StubOllama.responses.append((200, [{"model": "m", "message": {"content": "ok"}, "done": True}]))
+        self.client.chat.completions.create("m", [
+            {"role": "assistant", "content": None, "tool_calls": [
+                {"id": "call_1", "type": "function", "function": {"name": "find_by_party", "arguments": '{"party": "Ann"}'}}
+            ]},
+            {"role": "tool", "tool_call_id": "call_1", "content": "[]"}
+        ])
+        path, payload = StubOllama.requests[0]
+        self.assertEqual(path, "/api/chat")
+        self.assertEqual(payload["keep_alive"], "5m")
+        self.assertEqual(payload["messages"][0]["tool_calls"][0]["function"]["arguments"], {"party": "Ann"})
+        self.assertEqual(payload["messages"][1]["tool_name"], "find_by_party")
+
+    def test_tool_calls_are_mapped_to_openai_objects(self):
+        StubOllama.responses.append((200, [{
+            "model": "m",
+            "message": {"content": "", "tool_calls": [{"function": {"name": "find_by_party", "arguments": {"party": "Ann"}}}]},
+            "done": True, "prompt_eval_count": 12, "eval_count": 3
+        }]))
+        response = self.client.chat.completions.create("m", [{"role": "user", "content": "hi"}], tools=[{"type": "function"}])
+        choice = response.choices[0]
+        self.assertEqual(choice.finish_reason, "tool_calls")
+        tool_call = choice.message.tool_calls[0]
+        self.assertTrue(tool_call.id.startswith("call_"))
+        self.assertEqual(tool_call.function.name, "find_by_party")
+        self.assertEqual(json.loads(tool_call.function.arguments), {"party": "Ann"})
+        self.assertEqual((response.usage.prompt_tokens, response.usage.completion_tokens), (12, 3))
+
+    def test_streaming_yields_content_and_indexed_tool_calls(self):
+        StubOllama.responses.append((200, [
+            {"message": {"content": "Hel"}, "done": False},
+            {"message": {"content": "lo"}, "done": False},
+            {"message": {"content": "", "tool_calls": [
+                {"function": {"name": "a", "arguments": {}}},
+                {"function": {"name": "b", "arguments": {"x": 1}}}
+            ]}, "done": False},
+            {"message": {"content": ""}, "done": True, "eval_count": 5}
+        ]))
+        chunks = list(self.client.chat.completions.create("m", [{"role": "user", "content": "hi"}], stream=True))
+        self.assertEqual("".join(chunk.choices[0].delta.content or "" for chunk in chunks), "Hello")
+        tool_deltas = [delta for chunk in chunks for delta in chunk.choices[0].delta.tool_calls or []]
+        self.assertEqual([(delta.index, delta.function.name) for delta in tool_deltas], [(0, "a"), (1, "b")])
+        self.assertEqual(chunks[-1].choices[0].finish_reason, "tool_calls")
+        self.assertEqual(chunks[-1].usage.completion_tokens, 5)
+
+    def test_http_errors_keep_ollama_message_and_status(self):
+        StubOllama.responses.append((404, [{"error": "model 'm' not found"}]))
+        with self.assertRaises(OllamaError) as raised:
+            self.client.chat.completions.create("m", [{"role": "user", "content": "hi"}])
+        self.assertIn("model 'm' not found", str(raised.exception))
+        self.assertEqual(raised.exception.response.status_code, 404)
+        self.assertFalse(is_retryable(raised.exception))
+
+        StubOllama.responses.append((503, [{"error": "server busy"}]))
+        with self.assertRaises(OllamaError) as raised:
+            self.client.chat.completions.create("m", [{"role": "user", "content": "hi"}], stream=True)
+        self.assertTrue(is_retryable(raised.exception))
+
+    def test_error_line_in_stream_raises(self):
+        StubOllama.responses.append((200, [
+            {"message": {"content": "Hi"}, "done": False},
+            {"error": "out of memory"}
+        ]))
+        chunks = self.client.chat.completions.create("m", [{"role": "user", "content": "hi"}], stream=True)
+        self.assertEqual(next(chunks).choices[0].delta.content, "Hi")
+        with self.assertRaisesRegex(OllamaError, "out of memory"):
+            next(chunks)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+from datetime import datetime, timezone
+from unittest import mock
+from party_directory import PartyDirectory, vcon_party_keys
+import party_tool
+import unittest
+import mongomock
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+# mongomock has no $type; these ranges select the same BSON types
+CREATED_AT_TYPES = [("string", {"$gte": ""}), ("date", {"$gte": datetime.min})]
+
+VCONS = [
+    ("v1", "2024-01-01T00:00:00", [{"tel": "(555) 555-0100", "name": "Jane Doe"}]),
+    ("v2", utc(2024, 1, 2), [{"tel": "+1 555 555 0100"}, {"mailto": "Bob@Example.com", "name": "Bob Smith"}]),
+    ("v3", utc(2024, 1, 3), [{"name": "Jane Doe"}]),
+    ("v4", utc(2024, 1, 3), [{"tel": "555-555-0199", "name": "Janet Dow"}]),
+    ("v5", "2023-06-01T00:00:00", [{"name": "Jane Doe"}])
+]
+
+class FindByPartyTest(unittest.TestCase):
+    def setUp(self):
+        self.db_conn = mongomock.MongoClient()
+        self.collection = self.db_conn[party_tool.DB_NAME][party_tool.COLLECTION_NAME]
+        for uuid, created_at, parties in VCONS:
+            vcon = {"uuid": uuid, "created_at": created_at, "parties": parties}
+            vcon["party_keys"] = vcon_party_keys(vcon)
+            self.collection.insert_one(vcon)
+        # Written before party_keys existed; only the legacy fallback finds it
+        self.collection.insert_one({"uuid": "v6", "created_at": utc(2024, 1, 4), "parties": [{"tel": "+15555550123"}]})
+
+        self.directory = PartyDirectory()
+        self.directory.refresh(self.collection)
+        for patcher in (mock.patch.object(party_tool, "party_directory", self.directory),
+                        mock.patch.object(party_tool, "CREATED_AT_TYPES", CREATED_AT_TYPES)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_exact_match_normalizes_the_identifier(self):
+        result = party_tool.find_by_party("555.555.0100", self.db_conn)
+        self.assertEqual(result, {"uuids": ["v2", "v1"], "matched_parties": ["tel:+15555550100"], "next_cursor": None})
+        self.assertEqual(party_tool.find_by_party("bob@EXAMPLE.com", self.db_conn)["uuids"], ["v2"])
+
+    def test_exact_match_falls_back_to_the_raw_party_fields(self):
+        self.assertEqual(party_tool.find_by_party("+1 555 555 0123", self.db_conn)["uuids"], ["v6"])
+
+    def test_next_cursor_pages_newest_first_across_types(self):
+        uuids = []
+        result = party_tool.find_by_party("Jane Doe", self.db_conn, limit=1)
+        while True:
+            uuids.extend(result["uuids"])
+            if not result["next_cursor"]:
+                break
+            result = party_tool.find_by_party("Jane Doe", self.db_conn, limit=1, cursor=result["next_cursor"])
+        # Dates sort after strings, so newest first returns them before the string dates
+        self.assertEqual(uuids, ["v3", "v1", "v5"])
+
+    def test_invalid_cursor_is_reported_to_the_model(self):
+        result = party_tool.find_by_party("Jane Doe", self.db_conn, cursor="bogus")
+        self.assertTrue(result.startswith("Error: Invalid cursor"))
+
+    def test_prefix_match(self):
+        result = party_tool.find_by_party("555 555 01", self.db_conn, match="prefix")
+        # The most frequent party first; the directory reads parties, so v6's number is known
+        self.assertEqual(result["matched_parties"], ["tel:+15555550100", "tel:+15555550123", "tel:+15555550199"])
+        # Prefix lookups only query party_keys, which v6 lacks
+        self.assertEqual(result["uuids"], ["v4", "v2", "v1"])
+        result = party_tool.find_by_party("jan", self.db_conn, match="prefix")
+        self.assertEqual(result["matched_parties"], ["name:jane doe", "name:janet dow"])
+
+    def test_fuzzy_match_tolerates_misspellings(self):
+        result = party_tool.find_by_party("Jane Deo", self.db_conn, match="fuzzy")
+        self.assertEqual(result["matched_parties"], ["name:jane doe"])
+        self.assertEqual(result["uuids"], ["v3", "v1", "v5"])
+        self.assertEqual(party_tool.find_by_party("Zzyzx", self.db_conn, match="fuzzy")["uuids"], [])
+
+    def test_refresh_picks_up_new_vcons_and_rebuild_drops_edited_parties(self):
+        self.collection.insert_one({"uuid": "v7", "created_at": utc(2024, 1, 5), "parties": [{"name": "Janine Roe"}]})
+        self.directory.refresh(self.collection)
+        self.assertIn("name:janine roe", self.directory.prefix("jan"))
+
+        self.collection.update_one({"uuid": "v4"}, {"$set": {"parties": [{"name": "Carl Dow"}]}})
+        self.directory.rebuild_interval = 0
+        self.directory.refresh(self.collection)
+        self.assertNotIn("name:janet dow", self.directory.prefix("jan"))
+        self.assertEqual(self.directory.prefix("carl"), ["name:carl dow"])
+
+if __name__ == "__main__":
+    unittest.main()
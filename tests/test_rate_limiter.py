@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+from unittest import mock
+from rate_limiter import RateLimitScheduler, parse_reset
+import threading
+import unittest
+import time
+
+class ProviderError(Exception):
+    """
+    An HTTP error shaped like the OpenAI client's: status_code and a response with headers.
+    """
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+
+def failing(*errors, result="ok"):
+    # A provider call that raises the given errors in turn, then returns result
+    errors = list(errors)
+    calls = []
+
+    def function():
+        calls.append(time.monotonic())
+        if errors:
+            raise errors.pop(0)
+        return result
+    return function, calls
+
+class RateLimitSchedulerTest(unittest.TestCase):
+    def test_retry_after_sets_the_delay(self):
+        scheduler = RateLimitScheduler("test", max_retries=2)
+        function, calls = failing(ProviderError(503, {"retry-after-ms": "100"}))
+        self.assertEqual(scheduler.call(function), "ok")
+        self.assertGreaterEqual(calls[1] - calls[0], 0.1)
+        self.assertEqual(scheduler.get_stats()["retries"], 1)
+        self.assertEqual(scheduler.get_stats()["throttled"], 0)
+
+    def test_backoff_without_retry_after_is_jittered_and_capped(self):
+        scheduler = RateLimitScheduler("test", max_retries=4, base_delay=1, max_delay=3)
+        function, _ = failing(*[ProviderError(502) for _ in range(4)])
+        with mock.patch("rate_limiter.time.sleep") as sleep:
+            self.assertEqual(scheduler.call(function), "ok")
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 4)
+        for attempt, delay in enumerate(delays):
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(3, 2 ** attempt))
+
+    def test_gives_up_after_max_retries_and_on_final_errors(self):
+        scheduler = RateLimitScheduler("test", max_retries=2)
+        function, calls = failing(*[ProviderError(503, {"retry-after-ms": "1"}) for _ in range(3)])
+        with self.assertRaises(ProviderError):
+            scheduler.call(function)
+        self.assertEqual(len(calls), 3)
+
+        function, calls = failing(ProviderError(400))
+        with self.assertRaises(ProviderError):
+            scheduler.call(function)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(scheduler.get_stats()["failures"], 2)
+
+    def test_429_pauses_every_caller(self):
+        scheduler = RateLimitScheduler("test", max_retries=1)
+        started = []
+
+        def rate_limited():
+            raise ProviderError(429, {"retry-after": "0.3"})
+
+        def other_call():
+            # Call once the pause is in place, which the throttled count is updated with
+            while not scheduler.get_stats()["throttled"]:
+                time.sleep(0.001)
+            scheduler.call(lambda: started.append(time.monotonic()))
+
+        other = threading.Thread(target=other_call)
+        other.start()
+        before = time.monotonic()
+        with self.assertRaises(ProviderError):
+            scheduler.call(rate_limited)
+        other.join(5)
+        # The second caller never hit the limit itself but still waited out the pause
+        self.assertGreaterEqual(started[0] - before, 0.3)
+        self.assertEqual(scheduler.get_stats()["throttled"], 1)
+
+    def test_exhausted_limit_headers_wait_for_the_reset(self):
+        self.assertEqual(parse_reset("6m0s"), 360)
+        self.assertEqual(parse_reset("20ms"), 0.02)
+        scheduler = RateLimitScheduler("test", max_retries=1)
+        function, calls = failing(ProviderError(429, {
+            "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "200ms",
+            "x-ratelimit-remaining-tokens": "10", "x-ratelimit-reset-tokens": "5s"
+        }))
+        self.assertEqual(scheduler.call(function), "ok")
+        self.assertGreaterEqual(calls[1] - calls[0], 0.2)
+        self.assertLess(calls[1] - calls[0], 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+from concurrent.futures import ThreadPoolExecutor
+from party_tool import find_by_party, find_by_party_async
+from date_range_tool import find_by_date_range, find_by_date_range_async
+from get_conversation_by_id_tool import get_conversation_by_id, get_conversation_by_id_async
+from milvus_search_tool import (
+    search_in_milvus, search_in_milvus_batch, search_in_milvus_async, search_in_milvus_batch_async
+)
+from backend_limits import backend_slot, async_backend_slot
+from tool_result_cache import tool_result_cache
+from single_flight import tool_flight
+from tracing import span
+from config import config
+import contextvars
+import asyncio
+import traceback
+import hashlib
+import logging
+import json
+
+logger = logging.getLogger("llm_api")
+
+# Backend that each Mongo tool talks to; Milvus search takes its own
+# embedding and Milvus slots inside search_in_milvus
+TOOL_BACKENDS = {
+    "find_by_party": "mongo",
+    "find_by_date_range": "mongo",
+    "get_conversation_by_id": "mongo",
+}
+
+TOOL_FUNCTIONS = {
+    "find_by_party": find_by_party,
+    "find_by_date_range": find_by_date_range,
+    "get_conversation_by_id": get_conversation_by_id,
+    "search_in_milvus": search_in_milvus,
+    "search_in_milvus_batch": search_in_milvus_batch,
+}
+
+# Coroutine versions, for an AsyncMongoClient connection
+ASYNC_TOOL_FUNCTIONS = {
+    "find_by_party": find_by_party_async,
+    "find_by_date_range": find_by_date_range_async,
+    "get_conversation_by_id": get_conversation_by_id_async,
+    "search_in_milvus": search_in_milvus_async,
+    "search_in_milvus_batch": search_in_milvus_batch_async,
+}
+
+TOOL_MAX_WORKERS = int(config.get("tool_max_workers", 8))
+
+# Shared pool for every session in this process
+_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+def tool_call_hash(function_name, arguments):
+    """
+    Hash a tool call so identical calls can be recognised.
+
+    Args:
+        function_name (str): Name of the tool
+        arguments (dict): Parsed tool arguments
+
+    Returns:
+        str: md5 hex digest of the normalized call
+    """
+    return hashlib.md5(f"{function_name}:{json.dumps(arguments, sort_keys=True)}".encode()).hexdigest()
+
+def _tool_arguments(function_name, arguments):
+    # Keyword arguments for the tool function, without the database connection
+    if function_name == "find_by_party":
+        party = arguments["party"]
+        logger.info(f"find_by_party tool call with party: {party}")
+        return {
+            "party": party,
+            "match": arguments.get("match", "exact"),
+            "limit": arguments.get("limit", 50),
+            "cursor": arguments.get("cursor")
+        }
+    elif function_name == "find_by_date_range":
+        start_date = arguments["start_date"]
+        end_date = arguments["end_date"]
+        logger.info(f"find_by_date_range tool call with range: {start_date} to {end_date}")
+        return {
+            "start_date": start_date,
+            "end_date": end_date,
+            "limit": arguments.get("limit", 100),
+            "offset": arguments.get("offset"),
+            "sort": arguments.get("sort"),
+            "cursor": arguments.get("cursor")
+        }
+    elif function_name == "get_conversation_by_id":
+        uuids = arguments["uuids"]
+        # Limit number of UUIDs to process
+        if isinstance(uuids, list) and len(uuids) > 20:
+            logger.warning(f"Too many UUIDs requested: {len(uuids)}. Limiting to 20.")
+            uuids = uuids[:20]
+        return {"uuids": uuids, "sections": arguments.get("sections")}
+    elif function_name == "search_in_milvus":
+        search_text = arguments["search_text"]
+        logger.info(f"search_in_milvus tool call with search_text: {search_text}")
+        return {
+            "search_text": search_text,
+            "start_date": arguments.get("start_date"),
+            "end_date": arguments.get("end_date"),
+            "party": arguments.get("party")
+        }
+    elif function_name == "search_in_milvus_batch":
+        search_texts = arguments["search_texts"]
+        logger.info(f"search_in_milvus_batch tool call with {len(search_texts)} search texts")
+        return {
+            "search_texts": search_texts,
+            "start_date": arguments.get("start_date"),
+            "end_date": arguments.get("end_date"),
+            "party": arguments.get("party")
+        }
+    return None
+
+def _dispatch_tool(function_name, arguments, db_conn):
+    kwargs = _tool_arguments(function_name, arguments)
+    if kwargs is None:
+        error_msg = f"Unknown function: {function_name}"
+        logger.error(error_msg)
+        return f"Error: {error_msg}"
+    if function_name in TOOL_BACKENDS:
+        kwargs["db_conn"] = db_conn
+    return TOOL_FUNCTIONS[function_name](**kwargs)
+
+async def _dispatch_tool_async(function_name, arguments, db_conn):
+    kwargs = _tool_arguments(function_name, arguments)
+    if kwargs is None:
+        error_msg = f"Unknown function: {function_name}"
+        logger.error(error_msg)
+        return f"Error: {error_msg}"
+    if function_name in TOOL_BACKENDS:
+        kwargs["db_conn"] = db_conn
+    return await ASYNC_TOOL_FUNCTIONS[function_name](**kwargs)
+
+def _execute_tool(call_hash, function_name, arguments, db_conn):
+    # One backend execution, holding a slot on the backend it uses; errors are not cached
+    backend = TOOL_BACKENDS.get(function_name)
+    if backend:
+        with backend_slot(backend):
+            results = _dispatch_tool(function_name, arguments, db_conn)
+    else:
+        results = _dispatch_tool(function_name, arguments, db_conn)
+    if not (isinstance(results, str) and results.startswith("Error")):
+        tool_result_cache.put(call_hash, function_name, results)
+    return results
+
+async def _execute_tool_async(call_hash, function_name, arguments, db_conn):
+    backend = TOOL_BACKENDS.get(function_name)
+    if backend:
+        async with async_backend_slot(backend):
+            results = await _dispatch_tool_async(function_name, arguments, db_conn)
+    else:
+        results = await _dispatch_tool_async(function_name, arguments, db_conn)
+    if not (isinstance(results, str) and results.startswith("Error")):
+        tool_result_cache.put(call_hash, function_name, results)
+    return results
+
+def run_tool(function_name, arguments, db_conn):
+    """
+    Execute a single tool call, holding a slot on the backend it uses.
+
+    Results are served from the shared tool result cache when an identical
+    call was answered recently, and shared with an identical call that is
+    still running. Errors are returned as a message for the model rather
+    than raised, and are never cached.
+
+    Args:
+        function_name (str): Name of the tool to run
+        arguments (dict): Parsed tool arguments
+        db_conn: Database connection
+
+    Returns:
+        The tool results, or an error string
+    """
+    with span(function_name, "tool", request_bytes=len(json.dumps(arguments))) as tool_span:
+        call_hash = tool_call_hash(function_name, arguments)
+        hit, results = tool_result_cache.get(call_hash)
+        tool_span.set(cache_hit=hit)
+        if hit:
+            logger.info(f"Serving {function_name} from the tool result cache")
+            tool_span.set(result_bytes=len(str(results)))
+            return results
+        
+        try:
+            # Identical calls already running in other sessions share this one's result
+            results = tool_flight.do(call_hash, _execute_tool, call_hash, function_name, arguments, db_conn)
+            tool_span.set(result_bytes=len(str(results)))
+            if isinstance(results, str) and results.startswith("Error"):
+                tool_span.status = "error"
+            return results
+        except Exception as e:
+            logger.error(f"Error executing tool {function_name}: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            tool_span.status = "error"
+            return f"Error executing tool {function_name}: {str(e)}"
+
+async def run_tool_async(function_name, arguments, db_conn):
+    """
+    run_tool() as a coroutine, for an AsyncMongoClient connection.
+
+    Mongo tools wait on the event loop instead of holding a thread; Milvus
+    tools run on the fixed Milvus thread pool.
+    """
+    with span(function_name, "tool", request_bytes=len(json.dumps(arguments))) as tool_span:
+        call_hash = tool_call_hash(function_name, arguments)
+        hit, results = tool_result_cache.get(call_hash)
+        tool_span.set(cache_hit=hit)
+        if hit:
+            logger.info(f"Serving {function_name} from the tool result cache")
+            tool_span.set(result_bytes=len(str(results)))
+            return results
+        
+        try:
+            results = await tool_flight.do_async(call_hash, _execute_tool_async, call_hash, function_name, arguments, db_conn)
+            tool_span.set(result_bytes=len(str(results)))
+            if isinstance(results, str) and results.startswith("Error"):
+                tool_span.status = "error"
+            return results
+        except Exception as e:
+            logger.error(f"Error executing tool {function_name}: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            tool_span.status = "error"
+            return f"Error executing tool {function_name}: {str(e)}"
+
+def submit_tool_call(function_name, arguments, db_conn):
+    """
+    Start a tool call on the shared executor.
+
+    The call runs in a copy of the caller's context, so its spans belong to
+    the caller's trace.
+
+    Args:
+        function_name (str): Name of the tool to run
+        arguments (dict): Parsed tool arguments
+        db_conn: Database connection
+
+    Returns:
+        concurrent.futures.Future: Resolves to the tool results
+    """
+    context = contextvars.copy_context()
+    return _executor.submit(context.run, run_tool, function_name, arguments, db_conn)
+
+def run_tool_calls(calls, db_conn):
+    """
+    Run several independent tool calls concurrently.
+
+    Args:
+        calls (list): (function_name, arguments) tuples
+        db_conn: Database connection
+
+    Returns:
+        list: Tool results in the same order as calls
+    """
+    futures = [submit_tool_call(name, arguments, db_conn) for name, arguments in calls]
+    return [future.result() for future in futures]
+
+def submit_tool_call_to_loop(function_name, arguments, db_conn, loop):
+    """
+    Start run_tool_async() on an event loop from another thread.
+
+    The coroutine is scheduled from the caller's context, so its spans
+    belong to the caller's trace.
+
+    Args:
+        db_conn: AsyncMongoClient bound to loop
+        loop: Running event loop
+
+    Returns:
+        concurrent.futures.Future: Resolves to the tool results
+    """
+    return asyncio.run_coroutine_threadsafe(run_tool_async(function_name, arguments, db_conn), loop)
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+from config import config
+import threading
+import logging
+import time
+
+logger = logging.getLogger("llm_api")
+
+# Seconds a cached result stays valid, per tool
+DEFAULT_TOOL_CACHE_TTLS = {
+    "find_by_party": 300,
+    "find_by_date_range": 300,
+    "get_conversation_by_id": 900,
+    "search_in_milvus": 600,
+    "search_in_milvus_batch": 600,
+}
+
+TOOL_CACHE_TTLS = {**DEFAULT_TOOL_CACHE_TTLS, **dict(config.get("tool_cache_ttls", {}))}
+TOOL_CACHE_MAX_BYTES = int(config.get("tool_cache_max_bytes", 64 * 1024 * 1024))
+
+# Tools whose results are read from the vcons collection in Mongo
+MONGO_TOOLS = {"find_by_party", "find_by_date_range", "get_conversation_by_id"}
+
+# Tools whose results can only change when an existing vCon changes,
+# so inserts do not invalidate them
+UPDATE_SENSITIVE_TOOLS = {"get_conversation_by_id"}
+
+class ToolResultCache:
+    """
+    Process-wide cache of tool results keyed on the tool call hash.
+
+    Entries expire after a per-tool TTL, and the least recently used entries
+    are evicted once the estimated size of all results exceeds max_bytes.
+    Mongo-backed entries can also be invalidated from a change stream on the
+    vcons collection via watch_collection().
+    """
+
+    def __init__(self, ttls=None, max_bytes=TOOL_CACHE_MAX_BYTES):
+        self.ttls = ttls if ttls is not None else TOOL_CACHE_TTLS
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._watch_thread = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0
+        }
+
+    def get(self, call_hash):
+        """
+        Return the cached result for a call hash.
+
+        Returns:
+            tuple: (True, result) on a hit, (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(call_hash)
+            if entry is None:
+                self.stats["misses"] += 1
+                return False, None
+            function_name, result, expires_at, size = entry
+            if expires_at <= time.monotonic():
+                self._remove(call_hash)
+                self.stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(call_hash)
+            self.stats["hits"] += 1
+            return True, result
+
+    def put(self, call_hash, function_name, result):
+        """
+        Cache a tool result if its tool has a positive TTL.
+        """
+        ttl = self.ttls.get(function_name, 0)
+        if ttl <= 0:
+            return
+        # The result is sent to the model as str(result), so that is what we size
+        size = len(str(result))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if call_hash in self._entries:
+                self._remove(call_hash)
+            self._entries[call_hash] = (function_name, result, time.monotonic() + ttl, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, function_names=None):
+        """
+        Drop cached results for the given tools, or everything if none are given.
+        """
+        with self._lock:
+            stale = [
+                call_hash for call_hash, entry in self._entries.items()
+                if function_names is None or entry[0] in function_names
+            ]
+            for call_hash in stale:
+                self._remove(call_hash)
+            self.stats["invalidations"] += len(stale)
+
+    def get_stats(self):
+        """
+        Return hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._size
+        return stats
+
+    def watch_collection(self, collection):
+        """
+        Invalidate Mongo-backed results from a change stream on the collection.
+
+        Change streams need a replica set or sharded cluster. When they are
+        not available the cache falls back to TTL expiry alone. Safe to call
+        repeatedly; only one watcher is started per cache.
+        """
+        with self._lock:
+            if self._watch_thread is not None:
+                return
+            self._watch_thread = threading.Thread(
+                target=self._watch_loop, args=(collection,), name="tool-cache-watch", daemon=True
+            )
+        self._watch_thread.start()
+
+    def _watch_loop(self, collection):
+        resume_token = None
+        while True:
+            try:
+                with collection.watch(resume_after=resume_token) as stream:
+                    logger.info(f"Watching {collection.full_name} for tool cache invalidation")
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        if change.get("operationType") == "insert":
+                            self.invalidate(MONGO_TOOLS - UPDATE_SENSITIVE_TOOLS)
+                        else:
+                            self.invalidate(MONGO_TOOLS)
+            except Exception as e:
+                # Standalone servers do not support change streams; rely on TTLs
+                if "replica set" in str(e).lower() or getattr(e, "code", None) == 40573:
+                    logger.warning(f"Change streams unavailable, tool cache uses TTL expiry only: {str(e)}")
+                    return
+                if getattr(e, "code", None) in (260, 280, 286):
+                    # The resume point is gone, so changes may have been missed
+                    resume_token = None
+                    self.invalidate(MONGO_TOOLS)
+                logger.warning(f"Tool cache change stream interrupted, retrying: {str(e)}")
+                time.sleep(5)
+
+    def _remove(self, call_hash):
+        entry = self._entries.pop(call_hash)
+        self._size -= entry[3]
+
+# Shared cache for the whole process
+tool_result_cache = ToolResultCache()
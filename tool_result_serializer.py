@@ -0,0 +1,279 @@
+from config import config
+import datetime
+import logging
+import json
+
+logger = logging.getLogger("llm_api")
+
+# Approximate token budget for each tool's output in the prompt
+DEFAULT_TOOL_TOKEN_BUDGETS = {
+    "find_by_party": 1500,
+    "find_by_date_range": 1500,
+    "get_conversation_by_id": 6000,
+    "search_in_milvus": 3000,
+    "search_in_milvus_batch": 4000,
+}
+
+TOOL_TOKEN_BUDGETS = {**DEFAULT_TOOL_TOKEN_BUDGETS, **dict(config.get("tool_token_budgets", {}))}
+DEFAULT_TOKEN_BUDGET = int(config.get("default_tool_token_budget", 2000))
+
+# vCon sections the model can ask get_conversation_by_id for
+VCON_SECTIONS = ["parties", "dialog", "summary", "transcript", "analysis", "attachments"]
+DEFAULT_VCON_SECTIONS = ["parties", "summary"]
+
+# Fields kept by compact_vcon(), which is all get_conversation_by_id needs to fetch
+VCON_FIELDS = ("uuid", "created_at", "updated_at", "subject")
+PARTY_FIELDS = ("name", "tel", "mailto", "role")
+DIALOG_FIELDS = ("type", "start", "duration", "parties", "mimetype")
+ANALYSIS_FIELDS = ("type", "dialog", "vendor")
+ATTACHMENT_FIELDS = ("type", "mimetype", "encoding")
+
+# Progressively tighter caps applied to long strings when over budget
+STRING_CAPS = [2000, 800, 300, 120]
+# Opaque values the model passes back verbatim; a capped one would be useless
+UNCAPPED_KEYS = {"next_cursor"}
+
+# A uuid in a JSON list: 36 characters, the quotes and a comma
+UUID_ITEM_TOKENS = (len('"00000000-0000-0000-0000-000000000000",') + 3) // 4
+# Room a page needs besides its uuids: cursor, total, matched parties, truncation notes
+PAGE_OVERHEAD_TOKENS = 150
+
+def estimate_tokens(text):
+    """
+    Estimate the token count of a string (roughly four characters per token).
+    """
+    return (len(text) + 3) // 4
+
+def max_page_size(function_name):
+    """
+    Most uuids a page from this tool can hold within its token budget.
+
+    Paginated tools clamp their limit to this, so a page is never trimmed
+    after its next_cursor was computed.
+    """
+    token_budget = TOOL_TOKEN_BUDGETS.get(function_name, DEFAULT_TOKEN_BUDGET)
+    return max(1, (token_budget - PAGE_OVERHEAD_TOKENS) // UUID_ITEM_TOKENS)
+
+def _json_default(obj):
+    # ObjectId, Decimal128 and friends all have a sensible str()
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return f"<{len(obj)} bytes>"
+    return str(obj)
+
+def to_json(value):
+    """
+    Serialize a value as compact JSON, converting BSON types to strings.
+    """
+    return json.dumps(value, default=_json_default, separators=(",", ":"), ensure_ascii=False)
+
+def _omitted(value):
+    if is_omitted(value):
+        # Already replaced by a placeholder when it was fetched
+        return value
+    return {"omitted": True, "chars": len(value) if isinstance(value, str) else len(to_json(value))}
+
+def is_omitted(value):
+    """
+    Whether a value is an {"omitted": True, ...} placeholder.
+    """
+    return isinstance(value, dict) and value.get("omitted") is True
+
+def _is_encoded(item):
+    return str(item.get("encoding", "")).lower() in ("base64", "base64url")
+
+def _compact_party(party):
+    return {key: party[key] for key in PARTY_FIELDS if party.get(key)}
+
+def _compact_dialog(dialog, include_body):
+    compact = {
+        key: dialog[key] for key in DIALOG_FIELDS
+        if dialog.get(key) is not None
+    }
+    body = dialog.get("body")
+    if body is not None:
+        # Recordings and other encoded bodies are never useful to the model
+        if include_body and not _is_encoded(dialog) and dialog.get("type") == "text":
+            compact["body"] = body
+        else:
+            compact["body"] = _omitted(body)
+    return compact
+
+def _compact_analysis(analysis, sections):
+    analysis_type = str(analysis.get("type", ""))
+    compact = {
+        key: analysis[key] for key in ANALYSIS_FIELDS
+        if analysis.get(key) is not None
+    }
+    wanted = (
+        "analysis" in sections
+        or ("summary" in sections and "summary" in analysis_type)
+        or ("transcript" in sections and "transcript" in analysis_type)
+    )
+    body = analysis.get("body")
+    if body is not None:
+        if wanted and not _is_encoded(analysis):
+            compact["body"] = body
+        else:
+            compact["body"] = _omitted(body)
+    return compact
+
+def _compact_attachment(attachment, include_body):
+    compact = {
+        key: attachment[key] for key in ATTACHMENT_FIELDS
+        if attachment.get(key) is not None
+    }
+    body = attachment.get("body")
+    if body is not None:
+        if include_body and not _is_encoded(attachment):
+            compact["body"] = body
+        else:
+            compact["body"] = _omitted(body)
+    return compact
+
+def compact_vcon(vcon, sections=None):
+    """
+    Reduce a raw vCon document to the fields the model asked about.
+
+    Heavy fields (dialog bodies, attachments, analysis blobs) are replaced by
+    a placeholder recording their size unless their section was requested.
+
+    Args:
+        vcon (dict): Raw vCon document from MongoDB
+        sections (list): Sections to include in full (see VCON_SECTIONS)
+
+    Returns:
+        dict: Compact vCon
+    """
+    sections = set(sections or DEFAULT_VCON_SECTIONS)
+    compact = {
+        key: vcon[key] for key in VCON_FIELDS
+        if vcon.get(key) is not None
+    }
+    # Sections dropped for the document size cap stay as their placeholder
+    for key in ("parties", "dialog", "analysis", "attachments"):
+        if is_omitted(vcon.get(key)) and (key != "parties" or "parties" in sections):
+            compact[key] = vcon[key]
+    if "parties" in sections and vcon.get("parties") and "parties" not in compact:
+        compact["parties"] = [_compact_party(party) for party in vcon["parties"]]
+    if vcon.get("dialog") and "dialog" not in compact:
+        compact["dialog"] = [
+            _compact_dialog(dialog, "dialog" in sections) for dialog in vcon["dialog"]
+        ]
+    if vcon.get("analysis") and "analysis" not in compact:
+        compact["analysis"] = [
+            _compact_analysis(analysis, sections) for analysis in vcon["analysis"]
+        ]
+    if vcon.get("attachments") and "attachments" not in compact:
+        compact["attachments"] = [
+            _compact_attachment(attachment, "attachments" in sections)
+            for attachment in vcon["attachments"]
+        ]
+    return compact
+
+def _cap_strings(value, cap, counter):
+    if isinstance(value, str):
+        if len(value) > cap:
+            counter["strings"] += 1
+            return value[:cap] + "..."
+        return value
+    if isinstance(value, dict):
+        return {
+            key: item if key in UNCAPPED_KEYS else _cap_strings(item, cap, counter)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_cap_strings(item, cap, counter) for item in value]
+    return value
+
+def fit_to_budget(payload, token_budget):
+    """
+    Shrink a payload until its JSON fits the token budget.
+
+    Long strings are capped first, progressively tighter (never a
+    next_cursor); if that is not enough, trailing list items are dropped,
+    along with any next_cursor, which no longer matches the page.
+
+    Args:
+        payload: JSON-serializable value
+        token_budget (int): Approximate token budget
+
+    Returns:
+        tuple: (payload, truncation notes or None)
+    """
+    text = to_json(payload)
+    if estimate_tokens(text) <= token_budget:
+        return payload, None
+
+    notes = {"original_tokens": estimate_tokens(text)}
+    for cap in STRING_CAPS:
+        counter = {"strings": 0}
+        capped = _cap_strings(payload, cap, counter)
+        if counter["strings"]:
+            notes["strings_capped_at"] = cap
+            notes["strings_capped"] = counter["strings"]
+        if estimate_tokens(to_json(capped)) <= token_budget:
+            return capped, notes
+    payload = capped
+
+    if isinstance(payload, list) and payload:
+        payload = _trim_list(payload, lambda items: items, token_budget, notes)
+    elif isinstance(payload, dict):
+        # Trim the largest list in the result, e.g. the uuids of a page
+        lists = [key for key, value in payload.items() if isinstance(value, list) and value]
+        if lists:
+            key = max(lists, key=lambda key: len(to_json(payload[key])))
+            if payload.get("next_cursor"):
+                # The cursor points past the untrimmed page; following it would skip the cut items
+                payload = {**payload, "next_cursor": None}
+                notes["next_cursor_dropped"] = "page was trimmed; retry with a lower limit"
+            payload = _trim_list(
+                payload[key], lambda items: {**payload, key: items}, token_budget, notes
+            )
+    return payload, notes
+
+def _trim_list(items, wrap, token_budget, notes):
+    # Binary search for the longest prefix that fits
+    low, high = 0, len(items)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(to_json(wrap(items[:middle]))) <= token_budget:
+            low = middle
+        else:
+            high = middle - 1
+    notes["items_returned"] = low
+    notes["items_total"] = len(items)
+    return wrap(items[:low])
+
+def serialize_tool_result(function_name, results, arguments=None):
+    """
+    Serialize a tool result as compact JSON within the tool's token budget.
+
+    Error strings are passed through unchanged. When anything had to be cut,
+    the output is wrapped as {"results": ..., "truncated": {...}} so the model
+    knows what it is not seeing.
+
+    Args:
+        function_name (str): Name of the tool that produced the results
+        results: Raw tool results
+        arguments (dict): Tool arguments, used for requested vCon sections
+
+    Returns:
+        str: Content for the tool message
+    """
+    if isinstance(results, str):
+        return results
+
+    payload = results
+    if function_name == "get_conversation_by_id" and isinstance(results, list):
+        sections = (arguments or {}).get("sections")
+        payload = [compact_vcon(vcon, sections) for vcon in results]
+
+    token_budget = TOOL_TOKEN_BUDGETS.get(function_name, DEFAULT_TOKEN_BUDGET)
+    payload, notes = fit_to_budget(payload, token_budget)
+    if notes is None:
+        return to_json(payload)
+
+    logger.info(f"Tool {function_name} output truncated to fit {token_budget} tokens: {notes}")
+    return to_json({"results": payload, "truncated": notes})
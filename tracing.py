@@ -0,0 +1,260 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from config import config
+import threading
+import logging
+import time
+import uuid
+
+logger = logging.getLogger("llm_api")
+
+# Port for the Prometheus /metrics endpoint; unset to only collect in-process
+METRICS_PORT = config.get("metrics_port")
+# OTLP/HTTP traces endpoint, e.g. http://localhost:4318/v1/traces; unset to disable
+OTLP_ENDPOINT = config.get("otlp_endpoint")
+OTLP_SERVICE_NAME = config.get("otlp_service_name", "vcon-chat")
+
+# Latency buckets in seconds, from a fast cache hit to a slow completion
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PAYLOAD_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_current_span = ContextVar("current_span", default=None)
+
+class Span:
+    """
+    One timed operation: a turn, a loop iteration, a completion, a tool call
+    or a backend request.
+
+    Attributes such as token counts and payload sizes are added with set().
+    """
+
+    def __init__(self, name, kind, parent, trace, attributes):
+        self.name = name
+        self.kind = kind
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.trace = trace
+        self.attributes = dict(attributes)
+        self.start = time.perf_counter()
+        self.start_wall = time.time()
+        self.end = None
+        self.status = "ok"
+        self.otel_span = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    @property
+    def depth(self):
+        depth = 0
+        parent = self.parent
+        while parent is not None:
+            depth += 1
+            parent = parent.parent
+        return depth
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+class Trace:
+    """
+    The spans of one chat turn, in start order.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def waterfall(self):
+        """
+        Rows for a waterfall view: offsets and durations in milliseconds relative to the turn start.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        if not spans:
+            return []
+        origin = spans[0].start
+        return [{
+            "span": "  " * span.depth + span.name,
+            "kind": span.kind,
+            "start_ms": round((span.start - origin) * 1000, 1),
+            "end_ms": round((span.start - origin + span.duration) * 1000, 1),
+            "duration_ms": round(span.duration * 1000, 1),
+            "status": span.status,
+            **span.attributes
+        } for span in spans]
+
+    def totals(self):
+        """
+        Total time, token counts and payload bytes per span kind.
+        """
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            kind = totals.setdefault(span.kind, {"count": 0, "duration_ms": 0.0})
+            kind["count"] += 1
+            kind["duration_ms"] = round(kind["duration_ms"] + span.duration * 1000, 1)
+            for key in ("prompt_tokens", "completion_tokens", "request_bytes", "result_bytes"):
+                if isinstance(span.attributes.get(key), (int, float)):
+                    kind[key] = kind.get(key, 0) + span.attributes[key]
+        return totals
+
+class _Prometheus:
+    """
+    Prometheus counters and histograms, if prometheus_client is installed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        try:
+            from prometheus_client import Counter, Histogram, start_http_server
+        except ImportError:
+            if METRICS_PORT:
+                logger.warning("metrics_port is set but prometheus_client is not installed: pip install prometheus-client")
+            return
+        try:
+            self.spans = Counter("vcon_chat_spans_total", "Completed spans", ["kind", "name", "status"])
+            self.latency = Histogram("vcon_chat_span_seconds", "Span duration", ["kind", "name"], buckets=LATENCY_BUCKETS)
+            self.tokens = Counter("vcon_chat_llm_tokens_total", "LLM tokens", ["model", "type"])
+            self.payload = Histogram("vcon_chat_payload_bytes", "Request and result payload sizes",
+                                     ["kind", "name", "direction"], buckets=PAYLOAD_BUCKETS)
+        except ValueError as e:
+            # The metrics already exist if this module was reloaded in the same process
+            logger.warning(f"Prometheus metrics not registered: {str(e)}")
+            return
+        self.enabled = True
+        if METRICS_PORT:
+            try:
+                start_http_server(int(METRICS_PORT))
+                logger.info(f"Serving Prometheus metrics on port {METRICS_PORT}")
+            except OSError as e:
+                logger.warning(f"Could not serve Prometheus metrics on port {METRICS_PORT}: {str(e)}")
+
+    def record(self, span):
+        if not self.enabled:
+            return
+        # Tool, backend and queue names are a small fixed set; iterations are grouped by kind
+        name = span.name if span.kind in ("tool", "backend", "completion", "queue") else span.kind
+        self.spans.labels(span.kind, name, span.status).inc()
+        self.latency.labels(span.kind, name).observe(span.duration)
+        model = span.attributes.get("model", "")
+        for token_type in ("prompt_tokens", "completion_tokens"):
+            if isinstance(span.attributes.get(token_type), int):
+                self.tokens.labels(model, token_type[:-7]).inc(span.attributes[token_type])
+        for direction in ("request", "result"):
+            if isinstance(span.attributes.get(f"{direction}_bytes"), int):
+                self.payload.labels(span.kind, name, direction).observe(span.attributes[f"{direction}_bytes"])
+
+class _Otlp:
+    """
+    OTLP span export, if otlp_endpoint is set and opentelemetry is installed.
+    """
+
+    def __init__(self):
+        self.tracer = None
+        if not OTLP_ENDPOINT:
+            return
+        try:
+            from opentelemetry import trace as otel_trace
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError:
+            logger.warning("otlp_endpoint is set but OpenTelemetry is not installed: "
+                           "pip install opentelemetry-sdk opentelemetry-exporter-otlp-proto-http")
+            return
+        provider = TracerProvider(resource=Resource.create({"service.name": OTLP_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=OTLP_ENDPOINT)))
+        self._set_span_in_context = otel_trace.set_span_in_context
+        self.tracer = provider.get_tracer("vcon-chat")
+        logger.info(f"Exporting traces to {OTLP_ENDPOINT}")
+
+    def start(self, span):
+        if self.tracer is None:
+            return
+        parent = span.parent.otel_span if span.parent is not None else None
+        context = self._set_span_in_context(parent) if parent is not None else None
+        span.otel_span = self.tracer.start_span(
+            span.name, context=context, start_time=int(span.start_wall * 1e9), attributes={"kind": span.kind}
+        )
+
+    def end(self, span):
+        if span.otel_span is None:
+            return
+        for key, value in span.attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                span.otel_span.set_attribute(key, value)
+        span.otel_span.set_attribute("status", span.status)
+        span.otel_span.end(end_time=int((span.start_wall + span.duration) * 1e9))
+
+_prometheus = _Prometheus()
+_otlp = _Otlp()
+
+def current_span():
+    """
+    The innermost open span in this context, or None.
+    """
+    return _current_span.get()
+
+@contextmanager
+def _activate(current):
+    # Make the span current for the block and record it when the block ends
+    if current.trace is not None:
+        current.trace.add(current)
+    _otlp.start(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+        _prometheus.record(current)
+        _otlp.end(current)
+
+def span(name, kind, **attributes):
+    """
+    Time a block as a child of the current span.
+
+    Spans are recorded in the current trace (if a turn is being traced),
+    exported to Prometheus and OTLP when configured, and re-raise errors
+    after marking themselves failed.
+
+    Args:
+        name (str): Span name, e.g. the tool or backend name
+        kind (str): "turn", "iteration", "completion", "tool", "backend", ...
+        **attributes: Initial attributes such as model or request_bytes
+
+    Returns:
+        A context manager yielding the open Span, for adding attributes
+    """
+    parent = _current_span.get()
+    trace = parent.trace if parent is not None else None
+    return _activate(Span(name, kind, parent, trace, attributes))
+
+@contextmanager
+def trace_turn(name="turn", **attributes):
+    """
+    Start a new trace whose root span covers one chat turn.
+
+    Yields:
+        Trace: The trace collecting every span opened inside the block,
+        including those on executor threads that copied the context
+    """
+    trace = Trace(name)
+    with _activate(Span(name, "turn", None, trace, attributes)):
+        yield trace